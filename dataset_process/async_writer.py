@@ -0,0 +1,119 @@
+import json
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncWriter:
+    """
+    A bounded write-behind queue: images and label files are encoded and written by a thread pool
+    while the caller builds the next one.
+
+    At most max_pending writes are queued; submitting one more blocks until a write finishes, so
+    the memory held by pending images stays capped. flush() waits for all writes and re-raises the
+    first error of a failed write.
+    """
+
+    def __init__(self, threads=2, max_pending=2):
+        """
+        Args:
+            threads (int): The number of writer threads.
+            max_pending (int): The maximum number of queued and running writes.
+        """
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue a write, blocking while max_pending writes are already queued.
+
+        Args:
+            fn (callable): The function doing the write.
+            *args: Its positional arguments.
+            **kwargs: Its keyword arguments.
+        """
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    def save_image(self, image, path, **params):
+        """
+        Queue the encoding and writing of an image.
+
+        Args:
+            image (PIL.Image.Image): The image, which must not be modified afterwards.
+            path (str): The output path.
+            **params: The parameters of Image.save().
+        """
+        self.submit(image.save, path, **params)
+
+    def write_json(self, data, path):
+        """
+        Queue the writing of a JSON file.
+
+        Args:
+            data (dict): The data, which must not be modified afterwards.
+            path (str): The output path.
+        """
+        self.submit(_write_json, data, path)
+
+    def write_text(self, lines, path):
+        """
+        Queue the writing of a text file.
+
+        Args:
+            lines (list): The lines, with their line endings.
+            path (str): The output path.
+        """
+        self.submit(_write_text, lines, path)
+
+    def copy(self, src, dst):
+        """
+        Queue the copy of a file.
+
+        Args:
+            src (str): The source path.
+            dst (str): The destination path or directory.
+        """
+        self.submit(shutil.copy, src, dst)
+
+    def flush(self):
+        """
+        Wait for all queued writes and raise the first error if one failed.
+        """
+        futures, self.futures = self.futures, []
+        errors = [future.exception() for future in futures]
+        errors = [error for error in errors if error is not None]
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        """
+        Flush the queued writes and stop the writer threads.
+        """
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _write_json(data, path):
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+
+def _write_text(lines, path):
+    with open(path, 'w') as f:
+        f.writelines(lines)
@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from PIL import Image, ImageDraw
+
+from benchmark_placement import benchmark as benchmark_placement
+from check_json import check_json_files
+from labelme2yolo_detect import build_label_table, class_ids_of, convert_labelme_json_to_txt, list_labelme_files
+from synthesis import RandomSpeciesStrategy, synthesize
+
+# The size of the annotated specimen images, as check_json.py expects it
+specimen_width = 2320
+specimen_height = 1740
+
+
+def specimen_shapes(rng, label, width, height):
+    """
+    Get the LabelMe shapes of a synthetic specimen: a rectangle and its four keypoints inside it.
+
+    Returns:
+        tuple: The shapes and the rectangle (x, y, w, h).
+    """
+    w, h = rng.randint(100, 500), rng.randint(100, 400)
+    x, y = rng.randint(0, width - w - 1), rng.randint(0, height - h - 1)
+    shapes = [{'label': label, 'points': [[x + 0.5, y + 0.5], [x + w - 0.5, y + h - 0.5]],
+               'group_id': None, 'shape_type': 'rectangle', 'flags': {}}]
+    for i in range(4):
+        shapes.append({'label': str(i + 1), 'points': [[x + rng.randint(1, w - 1), y + rng.randint(1, h - 1)]],
+                       'group_id': None, 'shape_type': 'point', 'flags': {}})
+    return shapes, (x, y, w, h)
+
+
+def write_labelme(path, shapes, width, height):
+    """
+    Write the LabelMe JSON file of an image.
+    """
+    data = {'version': '5.4.1', 'flags': {}, 'shapes': shapes, 'imagePath': os.path.basename(path),
+            'imageData': None, 'imageHeight': height, 'imageWidth': width}
+    with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+        json.dump(data, f)
+
+
+def make_specimen_fixtures(root, background_path, species=7, per_species=20, seed=4399):
+    """
+    Build a synthetic init_dataset: specimen photos cut from the background image, each with a
+    drawn specimen in its annotated rectangle.
+
+    Args:
+        root (str): The fixture directory, the dataset goes to root/init_dataset.
+        background_path (str): The image the photos are cut from, e.g. ../background.jpg.
+        species (int): The number of species.
+        per_species (int): The number of specimens per species.
+        seed (int): The random seed.
+
+    Returns:
+        str: The dataset directory.
+    """
+    rng = random.Random(seed)
+    dataset_path = os.path.join(root, 'init_dataset')
+    with Image.open(background_path) as background:
+        background = background.convert('RGB').resize((specimen_width * 2, specimen_height * 2))
+    for s in range(species):
+        label = f'Genus{s} sp{s}'
+        os.makedirs(os.path.join(dataset_path, 'species', label), exist_ok=True)
+        for n in range(per_species):
+            x, y = rng.randint(0, specimen_width), rng.randint(0, specimen_height)
+            image = background.crop((x, y, x + specimen_width, y + specimen_height))
+            shapes, (bx, by, bw, bh) = specimen_shapes(rng, label, specimen_width, specimen_height)
+            color = tuple(rng.randint(0, 255) for _ in range(3))
+            ImageDraw.Draw(image).ellipse((bx + bw // 8, by + bh // 8, bx + bw * 7 // 8, by + bh * 7 // 8),
+                                          fill=color)
+            jpg = os.path.join(dataset_path, 'species', label, f'{n}.jpg')
+            image.save(jpg, quality=90)
+            write_labelme(jpg, shapes, specimen_width, specimen_height)
+    return dataset_path
+
+
+def make_file_fixtures(root, name, count, source_jpg, width, height, specimens=1, seed=4399):
+    """
+    Build count LabelMe files sharing one image (hard links), each with its own annotations.
+
+    Args:
+        root (str): The fixture directory, the files go to root/name.
+        name (str): The subdirectory.
+        count (int): The number of files.
+        source_jpg (str): The image linked by every file.
+        width (int): The imageWidth of the JSON files.
+        height (int): The imageHeight of the JSON files.
+        specimens (int): The number of annotated specimens per file.
+        seed (int): The random seed.
+
+    Returns:
+        str: The fixture directory.
+    """
+    rng = random.Random(seed)
+    path = os.path.join(root, name)
+    os.makedirs(path, exist_ok=True)
+    for i in range(count):
+        jpg = os.path.join(path, f'{i}.jpg')
+        try:
+            os.link(source_jpg, jpg)
+        except OSError:
+            shutil.copy(source_jpg, jpg)
+        shapes = []
+        for _ in range(specimens):
+            shapes.extend(specimen_shapes(rng, f'Genus{rng.randrange(7)} sp0', width, height)[0])
+        write_labelme(jpg, shapes, width, height)
+    return path
+
+
+def timed(fn, *args, **kwargs):
+    """
+    Run a function and get its wall time in seconds.
+    """
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def run_benchmarks(background_path='../background.jpg', files=1000, species=7, per_species=20,
+                   densities=(25, 100, 400), workers=1, fixture_path=None):
+    """
+    Time the hot paths of the dataset pipeline on synthetic fixtures.
+
+    Args:
+        background_path (str): The background image of the fixtures and composites.
+        files (int): The number of files of the conversion and check fixtures.
+        species (int): The number of species of the synthetic init_dataset.
+        per_species (int): The number of specimens per species.
+        densities (tuple): The numbers of specimens per canvas of the placement benchmark.
+        workers (int): The number of worker processes of the composite benchmark.
+        fixture_path (str): The fixture directory, kept afterwards, or None for a temporary one.
+
+    Returns:
+        dict: The seconds of every metric.
+    """
+    root = fixture_path or tempfile.mkdtemp(prefix='benchmark_')
+    results = {}
+    try:
+        # Placement: the is_overlap linear scan and the grid index, per canvas
+        for result in benchmark_placement(densities, canvases=3):
+            results[f"placement_linear_{result['specimens']}"] = result['linear']
+            results[f"placement_grid_{result['specimens']}"] = result['grid']
+
+        # Composites: a first run builds the catalog and crop library, the second one only synthesizes
+        dataset_path = make_specimen_fixtures(root, background_path, species, per_species)
+        paths = {name: os.path.join(root, name) for name in ['catalog.sqlite', 'crop_library', 'labelme', 'yolo']}
+        options = dict(workers=workers, dataset_path=dataset_path, library_path=paths['crop_library'],
+                       background_paths=(background_path,), labelme_path=paths['labelme'],
+                       yolo_path=paths['yolo'], catalog_path=paths['catalog.sqlite'], force=True)
+        synthesize(RandomSpeciesStrategy(), **options)
+        seconds = timed(synthesize, RandomSpeciesStrategy(), **options)
+        with open(os.path.join(paths['labelme'], 'species_composites.json'), 'r') as f:
+            results['composite_per_image'] = seconds / len(json.load(f))
+
+        # Conversion: composite-like LabelMe files with 20 specimens each, on a small shared image
+        source_jpg = os.path.join(root, 'small.jpg')
+        Image.new('RGB', (464, 348), (128, 128, 128)).save(source_jpg)
+        labelme_path = make_file_fixtures(root, 'composites', files, source_jpg, 4640, 3480, specimens=20)
+        output_path = os.path.join(root, 'converted')
+        for subdir in ['images', 'labels']:
+            os.makedirs(os.path.join(output_path, subdir, 'train'))
+
+        def convert():
+            file_list = list_labelme_files(labelme_path)
+            table = build_label_table(file_list)
+            class_ids = class_ids_of([label for boxes in table.values() if boxes for label, _ in boxes])
+            convert_labelme_json_to_txt(file_list, output_path, 'train', table, class_ids)
+        results['convert_per_1k'] = timed(convert) * 1000 / files
+
+        # Annotation check: specimen files sharing one photo of the synthetic dataset, no state
+        specimen_jpg = os.path.join(dataset_path, 'species', 'Genus0 sp0', '0.jpg')
+        check_path = make_file_fixtures(root, 'specimens', files, specimen_jpg, specimen_width, specimen_height)
+        results['check_json_per_1k'] = timed(check_json_files, check_path) * 1000 / files
+    finally:
+        if fixture_path is None:
+            shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def git_commit():
+    """
+    Get the current git commit, or None outside a git repository.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold=0.1):
+    """
+    Compare the results of a run with a baseline run.
+
+    Args:
+        results (dict): The seconds of every metric.
+        baseline (dict): The seconds of every metric of the baseline.
+        threshold (float): The relative slowdown counted as a regression.
+
+    Returns:
+        list: (metric, baseline seconds, seconds, ratio, regression) tuples of the common metrics.
+    """
+    rows = []
+    for metric in sorted(set(results) & set(baseline)):
+        ratio = results[metric] / baseline[metric] if baseline[metric] else float('inf')
+        rows.append((metric, baseline[metric], results[metric], ratio, ratio > 1 + threshold))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark placement, composite synthesis, LabelMe conversion "
+                                                 "and annotation checks on synthetic fixtures.")
+    parser.add_argument('--background', default='../background.jpg', help="Background image of the fixtures")
+    parser.add_argument('--files', type=int, default=1000, help="Files of the conversion and check benchmarks")
+    parser.add_argument('--species', type=int, default=7, help="Species of the synthetic dataset")
+    parser.add_argument('--per-species', type=int, default=20, help="Specimens per species")
+    parser.add_argument('--densities', type=int, nargs='+', default=[25, 100, 400],
+                        help="Specimens per canvas of the placement benchmark")
+    parser.add_argument('--workers', type=int, default=1, help="Worker processes of the composite benchmark")
+    parser.add_argument('--fixtures', default=None, help="Keep the fixtures in this directory")
+    parser.add_argument('--history', default='../benchmark_history.json', help="JSON history of the runs")
+    parser.add_argument('--name', default='', help="Name of this run in the history")
+    parser.add_argument('--set-baseline', action='store_true', help="Make this run the baseline")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Relative slowdown counted as a regression")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.background, args.files, args.species, args.per_species, tuple(args.densities),
+                             args.workers, args.fixtures)
+
+    history = {'baseline': None, 'runs': []}
+    if os.path.exists(args.history):
+        with open(args.history, 'r') as f:
+            history = json.load(f)
+    history['runs'].append({'name': args.name, 'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                            'commit': git_commit(), 'results': results})
+    if args.set_baseline or history['baseline'] is None:
+        history['baseline'] = len(history['runs']) - 1
+    with open(args.history, 'w') as f:
+        json.dump(history, f, indent=1)
+
+    baseline = history['runs'][history['baseline']]
+    print(f"Baseline: run {history['baseline']} {baseline['name']} ({baseline['created']}, {baseline['commit']})")
+    print(f"{'metric':>24} {'baseline (ms)':>14} {'now (ms)':>10} {'ratio':>7}")
+    rows = compare(results, baseline['results'], args.threshold)
+    for metric, before, after, ratio, regression in rows:
+        print(f"{metric:>24} {before * 1000:>14.2f} {after * 1000:>10.2f} {ratio:>6.2f}x"
+              f"{'  REGRESSION' if regression else ''}")
+    exit(1 if any(regression for *_, regression in rows) else 0)
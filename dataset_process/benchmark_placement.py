@@ -0,0 +1,92 @@
+import random
+import time
+
+from placement import is_overlap, OccupiedPositions
+
+image_width = 4640
+image_height = 3480
+
+
+def place_specimens(sizes, occupied_positions, overlaps, seed):
+    """
+    Place specimens on one canvas with the retry loop of the synthesis scripts.
+
+    Args:
+        sizes (list): The (w, h) sizes of the specimens to place.
+        occupied_positions: The container of already pasted boxes.
+        overlaps (callable): overlaps(occupied_positions, position, size) -> bool.
+        seed (int): The random seed.
+
+    Returns:
+        list: The positions found, None for a specimen that did not fit in 1000 tries.
+    """
+    rng = random.Random(seed)
+    positions = []
+    for w, h in sizes:
+        position = None
+        for _ in range(1000):
+            new_position = (rng.randint(0, image_width - w), rng.randint(0, image_height - h))
+            if not overlaps(occupied_positions, new_position, (w, h)):
+                occupied_positions.append((new_position, (w, h)))
+                position = new_position
+                break
+        positions.append(position)
+    return positions
+
+
+def linear_overlaps(occupied_positions, position, size):
+    """
+    The linear scan the synthesis scripts used before the grid index.
+    """
+    for occupied_position in occupied_positions:
+        if is_overlap(position, size, occupied_position[0], occupied_position[1]):
+            return True
+    return False
+
+
+def grid_overlaps(occupied_positions, position, size):
+    return occupied_positions.overlaps(position, size)
+
+
+def benchmark(specimen_counts=(10, 25, 50, 100, 200, 400), canvases=5, seed=4399, repeats=3):
+    """
+    Time placement per canvas for the linear scan and the grid index.
+
+    Args:
+        specimen_counts (tuple): The numbers of specimens per canvas to measure.
+        canvases (int): The number of canvases averaged for each count.
+        seed (int): The random seed.
+        repeats (int): The number of timed runs of each method, the fastest is kept.
+
+    Returns:
+        list: One dict per specimen count with the mean seconds per canvas of both methods.
+    """
+    results = []
+    for count in specimen_counts:
+        rng = random.Random(seed + count)
+        layouts = [[(rng.randint(60, 260), rng.randint(60, 260)) for _ in range(count)] for _ in range(canvases)]
+
+        timings = {}
+        placed = {}
+        for name, container, overlaps in [('linear', list, linear_overlaps),
+                                          ('grid', OccupiedPositions, grid_overlaps)]:
+            # The best of repeats runs, the small counts take well under a millisecond per canvas
+            runs = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                placed[name] = [place_specimens(sizes, container(), overlaps, seed + i)
+                                for i, sizes in enumerate(layouts)]
+                runs.append((time.perf_counter() - start) / canvases)
+            timings[name] = min(runs)
+
+        # The index must not change a single position for the same seed
+        assert placed['linear'] == placed['grid'], "Grid index placement differs from the linear scan"
+        results.append({'specimens': count, 'linear': timings['linear'], 'grid': timings['grid']})
+    return results
+
+
+if __name__ == "__main__":
+    print(f"{'specimens':>10} {'linear (ms)':>12} {'grid (ms)':>10} {'speedup':>8}")
+    for result in benchmark():
+        print(f"{result['specimens']:>10} {result['linear'] * 1000:>12.2f} {result['grid'] * 1000:>10.2f} "
+              f"{result['linear'] / result['grid']:>8.1f}x")
@@ -0,0 +1,259 @@
+import os
+import json
+import sqlite3
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from crop_library import file_hash, file_stat
+
+# The columns of the specimens table, in order
+columns = ['key', 'subset', 'directory1', 'directory2', 'family', 'genus', 'species',
+           'image_width', 'image_height', 'jpeg_width', 'jpeg_height', 'rectangle_count',
+           'x1', 'y1', 'x2', 'y2', 'keypoints', 'hash', 'stat']
+
+
+def is_rectangle(shape):
+    """
+    Whether a LabelMe shape is the specimen rectangle: a rectangle with a Latin label.
+    """
+    return shape['shape_type'] == 'rectangle' and any(char.isascii() for char in shape['label'])
+
+
+def is_keypoint(shape):
+    """
+    Whether a LabelMe shape is a keypoint: a point with a digit label.
+    """
+    return shape['shape_type'] == 'point' and shape['label'].strip().isdigit()
+
+
+def family_of(directories):
+    """
+    Get the Latin family name of a specimen from its directories, e.g. '<Chinese name> Entomobryidae'.
+
+    Args:
+        directories (list): The directories of the image, relative to the dataset.
+
+    Returns:
+        str: The second word of the first directory containing Chinese characters, or None.
+    """
+    for directory in directories:
+        if any('\u4e00' <= char <= '\u9fff' for char in directory):
+            words = directory.split()
+            return words[1] if len(words) > 1 else None
+    return None
+
+
+def read_record(args):
+    """
+    Read the catalog record of an annotated image: its directories, taxonomy, image sizes,
+    rectangle and keypoints. Only the JPEG header is read, the image is not decoded.
+
+    Args:
+        args (tuple): The catalog key, the image path, its content hash and its stat.
+
+    Returns:
+        tuple: The values of the columns.
+    """
+    key, jpg, content_hash, stat = args
+    with open(f'{os.path.splitext(jpg)[0]}.json', 'r') as f:
+        data = json.load(f)
+    with Image.open(jpg) as image:
+        jpeg_width, jpeg_height = image.size
+
+    directories = key.split('/')[:-1]
+    shapes = data.get('shapes', [])
+    rectangles = [shape for shape in shapes if is_rectangle(shape)]
+    (x1, y1), (x2, y2) = rectangles[0]['points'] if rectangles else ((None, None), (None, None))
+    species = rectangles[0]['label'] if rectangles else None
+    keypoints = [[shape['label'].strip(), *shape['points'][0]] for shape in shapes if is_keypoint(shape)]
+
+    return (key, directories[0] if directories else '',
+            directories[1] if len(directories) > 1 else None, directories[2] if len(directories) > 2 else None,
+            family_of(directories), species.split()[0] if species else None, species,
+            data.get('imageWidth'), data.get('imageHeight'), jpeg_width, jpeg_height, len(rectangles),
+            x1, y1, x2, y2, json.dumps(keypoints), content_hash, json.dumps(stat))
+
+
+def build_catalog(dataset_path, catalog_path, workers=1):
+    """
+    Index every annotated specimen of a dataset once into an SQLite catalog.
+
+    The catalog has one row per image with its subset ('species' or 'family'), the two directory
+    levels below the subset, its family, genus and species, the image size of the JSON file and of
+    the JPEG header, its rectangle and keypoints, and the content hash of the image and JSON file.
+    Rows whose files did not change (same sizes and mtimes, or same content hash) are kept as they are.
+
+    Args:
+        dataset_path (str): The annotated dataset directory (init_dataset).
+        catalog_path (str): The SQLite file of the catalog.
+        workers (int): The number of worker processes reading new or changed images.
+
+    Returns:
+        Catalog: The up-to-date catalog.
+    """
+    connection = sqlite3.connect(catalog_path)
+    connection.execute(f"CREATE TABLE IF NOT EXISTS specimens ({', '.join(columns)}, PRIMARY KEY (key))")
+    connection.execute("CREATE TABLE IF NOT EXISTS meta (name PRIMARY KEY, value)")
+    connection.execute("INSERT OR REPLACE INTO meta VALUES ('dataset_path', ?)",
+                       (os.path.relpath(dataset_path, os.path.dirname(os.path.abspath(catalog_path))),))
+    old_rows = {key: (content_hash, json.loads(stat))
+                for key, content_hash, stat in connection.execute("SELECT key, hash, stat FROM specimens")}
+
+    # Collect all JPG files in the dataset folder
+    sources = {}
+    for root, dirs, files in os.walk(dataset_path):
+        for file in files:
+            if file.lower().endswith(".jpg"):
+                jpg = os.path.join(root, file)
+                sources[os.path.relpath(jpg, dataset_path).replace(os.path.sep, '/')] = jpg
+
+    # Read the images whose files changed
+    jobs = []
+    for key in sorted(sources):
+        stat = file_stat(sources[key])
+        old_row = old_rows.get(key)
+        if old_row and old_row[1] == stat:
+            continue
+        content_hash = file_hash(sources[key])
+        if old_row and old_row[0] == content_hash:
+            connection.execute("UPDATE specimens SET stat = ? WHERE key = ?", (json.dumps(stat), key))
+            continue
+        jobs.append((key, sources[key], content_hash, stat))
+
+    if workers <= 1:
+        records = map(read_record, jobs)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        records = executor.map(read_record, jobs, chunksize=32)
+    connection.executemany(f"INSERT OR REPLACE INTO specimens VALUES ({', '.join('?' * len(columns))})",
+                           tqdm(records, total=len(jobs), desc="Cataloging specimens"))
+    if workers > 1:
+        executor.shutdown()
+
+    connection.executemany("DELETE FROM specimens WHERE key = ?", [(key,) for key in old_rows if key not in sources])
+    connection.commit()
+    connection.close()
+    return Catalog(catalog_path)
+
+
+class Catalog:
+    """
+    Read access to the catalog written by build_catalog().
+
+    select() returns columns as NumPy arrays, so selections over all specimens are vectorized
+    instead of walking the dataset and parsing every JSON file again.
+    """
+
+    def __init__(self, catalog_path):
+        """
+        Args:
+            catalog_path (str): The SQLite file of the catalog.
+        """
+        self.catalog_path = catalog_path
+        self.connection = sqlite3.connect(catalog_path)
+        dataset_path, = self.connection.execute("SELECT value FROM meta WHERE name = 'dataset_path'").fetchone()
+        self.dataset_path = os.path.normpath(os.path.join(os.path.dirname(catalog_path), dataset_path))
+
+    def path(self, key):
+        """
+        Get the image path of a catalog key.
+        """
+        return os.path.join(self.dataset_path, key)
+
+    def key(self, jpg):
+        """
+        Get the catalog key of an image: its path relative to the dataset directory, with forward slashes.
+        """
+        return os.path.relpath(os.path.abspath(jpg), os.path.abspath(self.dataset_path)).replace(os.path.sep, '/')
+
+    def select(self, names, where='1', params=()):
+        """
+        Select columns of the specimens, ordered by key.
+
+        Args:
+            names (list): The column names.
+            where (str): An SQL condition, e.g. "subset = ?".
+            params (tuple): The parameters of the condition.
+
+        Returns:
+            dict: A NumPy array per column.
+        """
+        rows = self.connection.execute(f"SELECT {', '.join(names)} FROM specimens WHERE {where} ORDER BY key",
+                                       params).fetchall()
+        values = list(zip(*rows)) if rows else [()] * len(names)
+        return {name: np.array(column, dtype=object if name in ('key', 'keypoints', 'stat') else None)
+                for name, column in zip(names, values)}
+
+    def sources(self, subset=''):
+        """
+        List the images of the catalog.
+
+        Args:
+            subset (str): Only list the images of this subset, e.g. 'species'.
+
+        Returns:
+            list: The sorted image paths.
+        """
+        where, params = ("subset = ?", (subset,)) if subset else ('1', ())
+        return [self.path(key) for key in self.select(['key'], where, params)['key']]
+
+    def groups(self, subset, depth):
+        """
+        Group the images of a subset by their directories.
+
+        Args:
+            subset (str): The subset to group, e.g. 'family'.
+            depth (int): 1 to group by the first directory level, 2 to group by the first two levels.
+
+        Returns:
+            list: depth 1: a list of image lists; depth 2: a list of lists of image lists, all sorted
+                by directory name.
+        """
+        names = ['key', 'directory1', 'directory2'][:depth + 1]
+        rows = self.connection.execute(f"SELECT {', '.join(names)} FROM specimens WHERE subset = ? AND "
+                                       f"{' AND '.join(f'{name} IS NOT NULL' for name in names[1:])} ORDER BY key",
+                                       (subset,)).fetchall()
+        groups = {}
+        for key, *directories in rows:
+            group = groups
+            for directory in directories[:-1]:
+                group = group.setdefault(directory, {})
+            group.setdefault(directories[-1], []).append(self.path(key))
+
+        def to_lists(group):
+            return [to_lists(group[name]) if isinstance(group[name], dict) else group[name] for name in sorted(group)]
+        return to_lists(groups)
+
+    def species(self, jpg):
+        """
+        Get the species label of an image, the label of its rectangle.
+        """
+        row = self.connection.execute("SELECT species FROM specimens WHERE key = ?", (self.key(jpg),)).fetchone()
+        return row[0]
+
+    def fingerprint(self):
+        """
+        Get the keys and content hashes of all images, a fingerprint of the whole dataset.
+
+        Returns:
+            list: The (key, hash) pairs, ordered by key.
+        """
+        return self.connection.execute("SELECT key, hash FROM specimens ORDER BY key").fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the catalog of the annotated specimens.")
+    parser.add_argument('--dataset', default='../init_dataset', help="Annotated dataset directory")
+    parser.add_argument('--output', default='../catalog.sqlite', help="Catalog file")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes")
+    args = parser.parse_args()
+    catalog = build_catalog(args.dataset, args.output, args.workers)
+    species = catalog.select(['species'])['species']
+    print(f"{len(species)} specimens of {len(set(species))} species in {args.output}")
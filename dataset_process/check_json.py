@@ -1,81 +1,190 @@
 import os
 import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 
-def check_json_files(directory):
+from PIL import Image
+from tqdm import tqdm
+
+from catalog import is_keypoint, is_rectangle
+from crop_library import file_hash, file_stat
+
+
+def check_json_file(jpg):
+    """
+    Check an annotated image and its JSON file for annotation errors.
+
+    The image size is read from the JPEG header only, the image is not decoded. The content hash of
+    a valid file is computed here too, in the worker, for the state of check_json_files().
+
+    Args:
+        jpg (str): The path of the image.
+
+    Returns:
+        tuple: One dict per error with the file, the rule broken and a message, empty if the file is
+            valid, and the content hash of a valid file (see file_hash()), else None.
+    """
+    json_path = os.path.splitext(jpg)[0] + ".json"
+    errors = []
+
+    def error(rule, message):
+        errors.append({'file': json_path, 'rule': rule, 'message': message})
+
+    if not os.path.exists(json_path):
+        error('missing_json', f"No such JSON file: {json_path}")
+        return errors, None
+
+    try:
+        with open(json_path, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        error('invalid_json', f"Unreadable JSON file: {json_path}: {e}")
+        return errors, None
+    if not isinstance(data, dict):
+        error('invalid_json', f"The JSON file is not a LabelMe object: {json_path}")
+        return errors, None
+
+    image_height = data.get('imageHeight')
+    image_width = data.get('imageWidth')
+    # Check if the image dimensions are standard: imageHeight=1740, imageWidth=2320
+    if not (image_height == 1740 and image_width == 2320):
+        error('image_size', f"Invalid imageHeight or imageWidth in JSON file: {json_path}")
+
+    # Check if the JPEG header dimensions match the JSON file
+    try:
+        with Image.open(jpg) as image:
+            jpeg_width, jpeg_height = image.size
+    except (OSError, SyntaxError, ValueError) as e:
+        error('unreadable_image', f"Unreadable image {jpg}: {e}")
+    else:
+        if (jpeg_width, jpeg_height) != (image_width, image_height):
+            error('jpeg_size', f"Image size {jpeg_width}x{jpeg_height} does not match the JSON file: {json_path}")
+
+    try:
+        check_shapes(data.get('shapes', []), error, json_path)
+    except (KeyError, IndexError, TypeError, ValueError, AttributeError) as e:
+        error('malformed_shape', f"Malformed shape in JSON file: {json_path}: {e!r}")
+    return errors, None if errors else file_hash(jpg)
+
+
+def check_shapes(shapes, error, json_path):
+    """
+    Check the rectangle and the points of an annotated image.
+
+    Args:
+        shapes (list): The LabelMe shapes.
+        error (callable): error(rule, message) records an error.
+        json_path (str): The JSON file, for the messages.
+    """
+    rectangle = [shape for shape in shapes if is_rectangle(shape)]
+    points = [shape for shape in shapes if is_keypoint(shape)]
+
+    # Check if there is exactly one rectangle
+    if len(rectangle) != 1:
+        error('rectangle_count', f"Invalid rectangle in JSON file: {json_path}")
+
+    # Check if there are exactly 4 points
+    if len(points) != 4:
+        error('point_count', f"Invalid points in JSON file: {json_path}")
+
+    if rectangle:
+        # Check if the rectangle coordinates are from top-left to bottom-right
+        rectangle_points = rectangle[0]['points']
+        if rectangle_points[0][0] > rectangle_points[1][0] or rectangle_points[0][1] > rectangle_points[1][1]:
+            error('rectangle_order', f"Invalid rectangle coordinates in file: {json_path}")
+
+        # Check if the point coordinates are within the rectangle
+        rect_x1, rect_y1 = rectangle_points[0]
+        rect_x2, rect_y2 = rectangle_points[1]
+        for point in points:
+            px, py = point['points'][0]
+            if not (rect_x1 <= px <= rect_x2 and rect_y1 <= py <= rect_y2):
+                error('point_outside',
+                      f"Point: {point['label']} coordinates are not within the rectangle in file: {json_path}")
+
+    # Check if point labels are not repeated
+    point_labels = []
+    for point in points:
+        if point['label'] in point_labels:
+            error('point_repeated', f"Point: {point['label']} is repeated with other points in file: {json_path}")
+        point_labels.append(point['label'])
+
+
+def check_json_files(directory, workers=1, report_path=None, state_path=None):
     """
-    Check if each annotated JSON file has any annotation errors.
+    Check if each annotated JSON file has any annotation errors, and collect all of them.
+
+    Files whose sizes and mtimes, or content hash, did not change since they last passed the check
+    are skipped.
 
     Args:
         directory (str): The directory path containing images and JSON files.
+        workers (int): The number of worker processes.
+        report_path (str): A JSON file to write the errors to, or None.
+        state_path (str): A JSON file recording the files that passed the check, or None to check
+            every file.
+
+    Returns:
+        list: One dict per error with the file, the rule broken and a message.
     """
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if file.endswith(".jpg"):
-                # Construct the corresponding JSON file path
-                json_file = os.path.splitext(file)[0] + ".json"
-                json_path = os.path.join(root, json_file)
-                print(json_path)
-
-                if not os.path.exists(json_path):
-                    print(f"No such JSON file: {json_path}")
-                    exit(0)
-
-                with open(json_path, 'r') as f:
-                    data = json.load(f)
-
-                    image_height = data.get('imageHeight')
-                    image_width = data.get('imageWidth')
-                    # Check if the image dimensions are standard: imageHeight=1740, imageWidth=2320
-                    if not (image_height == 1740 and image_width == 2320):
-                        print(f"Invalid imageHeight or imageWidth in JSON file: {json_path}")
-                        exit(0)
-
-                    shapes = data.get('shapes', [])
-
-                    rectangle_count = sum(1 for shape in shapes if
-                                          shape['shape_type'] == 'rectangle' and any(
-                                              char.isascii() for char in shape['label']))
-                    points_count = sum(
-                        1 for shape in shapes if shape['shape_type'] == 'point' and shape['label'].strip().isdigit())
-
-                    # Check if there is exactly one rectangle
-                    if rectangle_count != 1:
-                        print(f"Invalid rectangle in JSON file: {json_path}")
-                        exit(0)
-
-                    # Check if there are exactly 4 points
-                    if points_count != 4:
-                        print(f"Invalid points in JSON file: {json_path}")
-                        exit(0)
-
-                    rectangle = [shape for shape in shapes if
-                                 shape['shape_type'] == 'rectangle' and any(char.isascii() for char in shape['label'])]
-                    points = [shape for shape in shapes if
-                              shape['shape_type'] == 'point' and shape['label'].strip().isdigit()]
-
-                    # Check if the rectangle coordinates are from top-left to bottom-right
-                    rectangle_points = rectangle[0]['points']
-                    if rectangle_points[0][0] > rectangle_points[1][0] or rectangle_points[0][1] > rectangle_points[1][1]:
-                        print(f"Invalid rectangle coordinates in file: {json_path}")
-                        exit(0)
-
-                    # Check if the point coordinates are within the rectangle
-                    rect_x1, rect_y1 = rectangle_points[0]
-                    rect_x2, rect_y2 = rectangle_points[1]
-                    for point in points:
-                        px, py = point['points'][0]
-                        if not (rect_x1 <= px <= rect_x2 and rect_y1 <= py <= rect_y2):
-                            print(f"Point: {point['label']} coordinates are not within the rectangle in file: {json_path}")
-                            exit(0)
-
-                    # Check if point labels are not repeated
-                    point_labels = []
-                    for point in points:
-                        if point['label'] in point_labels:
-                            print(f"Point: {point['label']} is repeated with other points in file: {json_path}")
-                            exit(0)
-                        point_labels.append(point['label'])
+    passed = {}
+    if state_path and os.path.exists(state_path):
+        with open(state_path, 'r') as f:
+            passed = json.load(f)
+
+    jpgs = sorted(os.path.join(root, file) for root, dirs, files in os.walk(directory)
+                  for file in files if file.endswith(".jpg"))
+
+    # Skip the files that did not change since they passed
+    stats = {}
+    jobs = []
+    for jpg in jpgs:
+        if not os.path.exists(os.path.splitext(jpg)[0] + ".json"):
+            jobs.append(jpg)
+            continue
+        stats[jpg] = file_stat(jpg)
+        if jpg in passed and (passed[jpg]['stat'] == stats[jpg] or passed[jpg]['hash'] == file_hash(jpg)):
+            passed[jpg]['stat'] = stats[jpg]
+            continue
+        jobs.append(jpg)
+
+    if workers <= 1:
+        results = map(check_json_file, jobs)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(check_json_file, jobs, chunksize=32)
+    errors = []
+    for jpg, (file_errors, content_hash) in tqdm(zip(jobs, results), total=len(jobs), desc="Checking annotations"):
+        errors.extend(file_errors)
+        if not file_errors:
+            passed[jpg] = {'stat': stats[jpg], 'hash': content_hash}
+        else:
+            passed.pop(jpg, None)
+    if workers > 1:
+        executor.shutdown()
+
+    if state_path:
+        # Forget the deleted files
+        passed = {jpg: passed[jpg] for jpg in jpgs if jpg in passed}
+        with open(state_path, 'w') as f:
+            json.dump(passed, f)
+    if report_path:
+        with open(report_path, 'w') as f:
+            json.dump({'checked': len(jobs), 'skipped': len(jpgs) - len(jobs), 'errors': errors}, f, indent=2)
+    return errors
+
 
 if __name__ == "__main__":
-    directory = r'../init_dataset'
-    check_json_files(directory)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Check the annotations of the labeled dataset.")
+    parser.add_argument('--dataset', default='../init_dataset', help="Directory of the images and JSON files")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes")
+    parser.add_argument('--report', default='../check_json_report.json', help="JSON report of all errors")
+    parser.add_argument('--state', default='../check_json_state.json',
+                        help="Files that passed the last check, skipped while unchanged")
+    args = parser.parse_args()
+
+    errors = check_json_files(args.dataset, args.workers, args.report, args.state)
+    for error in errors:
+        print(error['message'])
+    print(f"{len(errors)} errors, report written to {args.report}")
+    exit(1 if errors else 0)
@@ -0,0 +1,183 @@
+import os
+import json
+import random
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+from tqdm import tqdm
+
+from catalog import build_catalog
+from labelme2yolo_detect import place_file, split_list_into_equal_chunks
+
+
+def crop_name(key):
+    """
+    Get the file name of the crop of a catalog key, unique within its species directory.
+    """
+    return os.path.splitext(key)[0].replace('/', '_') + '.jpg'
+
+
+def crop_specimen(args):
+    """
+    Crop the rectangle of an annotated image and resize it so its short side is the classifier size.
+
+    The JPEG is decoded at the smallest DCT scale (1/2, 1/4 or 1/8) that still gives the crop at
+    least that size, so most of a 2320x1740 image is never decoded at full resolution.
+
+    Args:
+        args (tuple): The image path, the rectangle (x1, y1, x2, y2), the output path and the size.
+    """
+    jpg, rectangle, out_path, size = args
+    x1, y1, x2, y2 = min(rectangle[0], rectangle[2]), min(rectangle[1], rectangle[3]), \
+        max(rectangle[0], rectangle[2]), max(rectangle[1], rectangle[3])
+    with Image.open(jpg) as image:
+        width, height = image.size
+        ratio = size / max(min(x2 - x1, y2 - y1), 1)
+        if ratio < 1:
+            image.draft('RGB', (max(round(width * ratio), 1), max(round(height * ratio), 1)))
+        sx, sy = image.size[0] / width, image.size[1] / height
+        crop = image.convert('RGB').crop((x1 * sx, y1 * sy, x2 * sx, y2 * sy))
+    ratio = size / min(crop.size)
+    crop = crop.resize((max(round(crop.width * ratio), 1), max(round(crop.height * ratio), 1)), Image.BILINEAR)
+    crop.save(out_path, quality=95)
+
+
+def stratified_chunks(species_keys, folds, seed=4399):
+    """
+    Split the specimens into folds chunks with every species spread over all chunks.
+
+    The specimens of each species are shuffled and split with split_list_into_equal_chunks(), the
+    same split as labelme2yolo_detect.py. The chunks of each species start where the last species
+    stopped, so the chunks stay balanced and a rare species is not always missing from the same chunks.
+
+    Args:
+        species_keys (dict): The catalog keys of every species.
+        folds (int): The number of chunks.
+        seed (int): The shuffling seed.
+
+    Returns:
+        list: The chunks, lists of (species, key) pairs.
+    """
+    chunks = [[] for _ in range(folds)]
+    start = 0
+    for species in sorted(species_keys):
+        keys = sorted(species_keys[species])
+        random.Random(f'{seed}_{species}').shuffle(keys)
+        for i, species_chunk in enumerate(split_list_into_equal_chunks(keys, folds)):
+            chunks[(start + i) % folds].extend((species, key) for key in species_chunk)
+        # The larger first chunks of the next species go to the chunks that got the smaller ones
+        start += len(keys) % folds
+    return chunks
+
+
+def build_cls_dataset(dataset_path, output_path, size=224, folds=10, layout='hardlink', workers=1,
+                      catalog_path='../catalog.sqlite', seed=4399):
+    """
+    Generate the k-fold ImageFolder datasets of the specimen crops for the classifier.
+
+    Every species-level specimen is cropped once into <output>/pool/<species>/, then fold k gets
+    <output>/<k>/train|val|test/<species>/ with the test set on chunk k, the val set on chunk k + 1
+    and the train set on the other chunks, like labelme2yolo_detect.py. The crops are hard links
+    or symbolic links to the pool, or copies.
+
+    Crops are only made again for new or changed images (content hash of the catalog) or a new
+    size; the crops of deleted images are removed.
+
+    Args:
+        dataset_path (str): The annotated dataset directory (init_dataset).
+        output_path (str): The output directory.
+        size (int): The short side of the crops, the classifier imgsz.
+        folds (int): The number of folds.
+        layout (str): 'copy', 'hardlink' or 'symlink'.
+        workers (int): The number of worker processes cropping the images.
+        catalog_path (str): The SQLite file of the specimen catalog, updated first.
+        seed (int): The seed of the fold split.
+
+    Returns:
+        int: The number of crops made in this run.
+    """
+    catalog = build_catalog(dataset_path, catalog_path, workers)
+    selection = catalog.select(['key', 'species', 'x1', 'y1', 'x2', 'y2', 'hash'],
+                               "subset = 'species' AND rectangle_count = 1")
+
+    pool_path = os.path.join(output_path, 'pool')
+    index_path = os.path.join(pool_path, 'index.json')
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+
+    # Crop the specimens whose image, rectangle or size changed
+    entries = {}
+    species_keys = {}
+    jobs = []
+    for key, species, x1, y1, x2, y2, content_hash in zip(*selection.values()):
+        out_path = os.path.join(pool_path, species, crop_name(key))
+        entry = {'species': species, 'hash': content_hash, 'rectangle': [x1, y1, x2, y2], 'size': size}
+        entries[key] = entry
+        species_keys.setdefault(species, []).append(key)
+        if index.get(key) == entry and os.path.exists(out_path):
+            continue
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        jobs.append((catalog.path(key), [x1, y1, x2, y2], out_path, size))
+    catalog.close()
+
+    if workers <= 1:
+        results = map(crop_specimen, jobs)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(crop_specimen, jobs, chunksize=8)
+    for _ in tqdm(results, total=len(jobs), desc=f"Cropping specimens ({size})"):
+        pass
+    if workers > 1:
+        executor.shutdown()
+
+    for key, entry in index.items():
+        if key not in entries or entry['species'] != entries[key]['species']:
+            old_path = os.path.join(pool_path, entry['species'], crop_name(key))
+            if os.path.exists(old_path):
+                os.remove(old_path)
+    with open(index_path, 'w') as f:
+        json.dump(entries, f)
+
+    # Link the folds, which is cheap, so they are rebuilt from the pool every run
+    chunks = stratified_chunks(species_keys, folds, seed)
+    for k in range(folds):
+        output_path_k = os.path.join(output_path, str(k))
+        shutil.rmtree(output_path_k, ignore_errors=True)
+        kinds = {'test': chunks[k], 'val': chunks[(k + 1) % folds],
+                 'train': [item for i, chunk in enumerate(chunks) if i not in [k, (k + 1) % folds] for item in chunk]}
+        for kind, items in kinds.items():
+            for species, key in items:
+                os.makedirs(os.path.join(output_path_k, kind, species), exist_ok=True)
+                src = os.path.join(pool_path, species, crop_name(key))
+                dst = os.path.join(output_path_k, kind, species, crop_name(key))
+                if layout == 'copy':
+                    shutil.copy(src, dst)
+                else:
+                    place_file(src, dst, layout)
+            missing = sorted(set(species_keys) - {species for species, _ in items})
+            if missing:
+                # torchvision's ImageFolder numbers the classes of each split from its directories
+                print(f"Warning: fold {k} {kind} has no specimen of {', '.join(missing)}")
+    return len(jobs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crop the species-level specimens into k-fold ImageFolder "
+                                                 "datasets for the classifier.")
+    parser.add_argument('--dataset', default='../init_dataset', help="Annotated dataset directory")
+    parser.add_argument('--output', default='../cls_dataset(cls_crop)', help="Output directory")
+    parser.add_argument('--size', type=int, default=224, help="Short side of the crops (classifier imgsz)")
+    parser.add_argument('--folds', type=int, default=10, help="Number of folds")
+    parser.add_argument('--layout', choices=['copy', 'hardlink', 'symlink'], default='hardlink',
+                        help="How the folds store the crops")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes")
+    parser.add_argument('--catalog', default='../catalog.sqlite', help="Specimen catalog")
+    args = parser.parse_args()
+
+    count = build_cls_dataset(args.dataset, args.output, args.size, args.folds, args.layout, args.workers,
+                              args.catalog)
+    print(f"{count} specimens cropped into {args.output}")
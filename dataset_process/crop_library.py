@@ -0,0 +1,316 @@
+import os
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+import instrument
+
+# The LabelMe JSON fields synthesis needs, the library does not store the others (e.g. imageData,
+# the whole photo in base64)
+annotation_fields = ('shapes', 'imagePath', 'imageWidth', 'imageHeight')
+
+
+def file_hash(jpg):
+    """
+    Hash the content of an image and its LabelMe JSON file.
+
+    Args:
+        jpg (str): The path of the image.
+
+    Returns:
+        str: The SHA-1 hex digest of both files.
+    """
+    sha1 = hashlib.sha1()
+    for path in [jpg, f'{os.path.splitext(jpg)[0]}.json']:
+        with open(path, 'rb') as f:
+            sha1.update(f.read())
+    return sha1.hexdigest()
+
+
+def file_stat(jpg):
+    """
+    Get the size and mtime of an image and its LabelMe JSON file.
+
+    Args:
+        jpg (str): The path of the image.
+
+    Returns:
+        list: [image size, image mtime, JSON size, JSON mtime].
+    """
+    stat = []
+    for path in [jpg, f'{os.path.splitext(jpg)[0]}.json']:
+        file_stat = os.stat(path)
+        stat.extend([file_stat.st_size, file_stat.st_mtime])
+    return stat
+
+
+def trim_annotation(data):
+    """
+    Keep the fields of LabelMe JSON data that synthesis needs.
+
+    Args:
+        data (dict): The LabelMe JSON data.
+
+    Returns:
+        dict: The annotation_fields of the data.
+    """
+    return {field: data[field] for field in annotation_fields if field in data}
+
+
+def extract_crop(jpg):
+    """
+    Decode an annotated image and crop its rectangle annotation.
+
+    Args:
+        jpg (str): The path of the image.
+
+    Returns:
+        tuple: The RGB crop as a uint8 array and the trimmed LabelMe JSON data.
+    """
+    with open(f'{os.path.splitext(jpg)[0]}.json', 'r') as f:
+        data = json.load(f)
+    # check_json.py makes sure there is exactly one rectangle
+    rectangle = next(annotation for annotation in data['shapes'] if annotation['shape_type'] == 'rectangle')
+    (x1, y1), (x2, y2) = rectangle['points']
+    with instrument.timer('decode_crop'):
+        cropped_image = Image.open(jpg).convert('RGB').crop((x1, y1, x2, y2))
+    return np.asarray(cropped_image), trim_annotation(data)
+
+
+def _extract_entry(args):
+    """
+    Process pool wrapper of extract_crop().
+    """
+    key, jpg = args
+    pixels, data = extract_crop(jpg)
+    return key, pixels, data
+
+
+def build_crop_library(dataset_path, library_path, workers=1, catalog=None):
+    """
+    Decode every annotated specimen once and store its crop in a memory-mapped library.
+
+    The library is a directory with crops.bin (the RGB pixels of all crops, back to back) and
+    index.json (for every source image its offset, crop size, content hash and LabelMe shapes, see
+    annotation_fields).
+    Images whose sizes and mtimes or content hash did not change since the last build are copied from
+    the previous library instead of being decoded again.
+
+    Args:
+        dataset_path (str): The annotated dataset directory (init_dataset).
+        library_path (str): The output directory of the library.
+        workers (int): The number of worker processes decoding new or changed images.
+        catalog (Catalog): The catalog of the dataset, whose images, stats and content hashes are
+            used instead of walking and hashing the dataset again, or None.
+
+    Returns:
+        CropLibrary: The up-to-date library.
+    """
+    os.makedirs(library_path, exist_ok=True)
+    old_library = CropLibrary(library_path) if os.path.exists(os.path.join(library_path, 'index.json')) else None
+
+    # Collect all JPG files in the dataset folder
+    sources = {}
+    cataloged = {}
+    if catalog:
+        selection = catalog.select(['key', 'hash', 'stat'])
+        for key, content_hash, stat in zip(selection['key'], selection['hash'], selection['stat']):
+            sources[key] = catalog.path(key)
+            cataloged[key] = (content_hash, json.loads(stat))
+    else:
+        for root, dirs, files in os.walk(dataset_path):
+            for file in files:
+                if file.lower().endswith(".jpg"):
+                    jpg = os.path.join(root, file)
+                    sources[os.path.relpath(jpg, dataset_path).replace(os.path.sep, '/')] = jpg
+
+    # Reuse the crops whose sources did not change
+    entries = {}
+    stale = []
+    untrimmed = False
+    for key in sorted(sources):
+        jpg = sources[key]
+        content_hash, stat = cataloged[key] if catalog else (None, file_stat(jpg))
+        old_entry = old_library.entries.get(key) if old_library else None
+        if old_entry:
+            # Libraries built before the JSON data was trimmed are rewritten without the other fields
+            untrimmed = untrimmed or bool(set(old_entry['data']) - set(annotation_fields))
+            old_entry = dict(old_entry, data=trim_annotation(old_entry['data']))
+        if old_entry and old_entry['stat'] == stat:
+            entries[key] = dict(old_entry)
+            continue
+        content_hash = content_hash or file_hash(jpg)
+        if old_entry and old_entry['hash'] == content_hash:
+            entries[key] = dict(old_entry, stat=stat)
+            continue
+        entries[key] = {'hash': content_hash, 'stat': stat}
+        stale.append(key)
+
+    if old_library and not stale and not untrimmed and set(entries) == set(old_library.entries):
+        return old_library
+
+    # Write the pixels of all crops back to back as they come, only one crop is held at a time,
+    # then the index pointing into them
+    offset = 0
+    with open(os.path.join(library_path, 'crops.bin.tmp'), 'wb') as f:
+        jobs = [(key, sources[key]) for key in stale]
+        if workers <= 1:
+            results = map(_extract_entry, jobs)
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            results = executor.map(_extract_entry, jobs, chunksize=8)
+        for key, pixels, data in tqdm(results, total=len(jobs), desc="Extracting specimen crops"):
+            f.write(np.ascontiguousarray(pixels).tobytes())
+            entries[key].update(data=data, width=pixels.shape[1], height=pixels.shape[0], offset=offset)
+            offset += pixels.nbytes
+        if workers > 1:
+            executor.shutdown()
+
+        # The unchanged crops are copied from the previous library
+        stale = set(stale)
+        for key in sorted(entries):
+            if key not in stale:
+                pixels = old_library.pixels(key)
+                f.write(np.ascontiguousarray(pixels).tobytes())
+                entries[key]['offset'] = offset
+                offset += pixels.nbytes
+        pixels = None
+    if old_library:
+        old_library.close()
+    os.replace(os.path.join(library_path, 'crops.bin.tmp'), os.path.join(library_path, 'crops.bin'))
+
+    index = {'dataset_path': os.path.relpath(dataset_path, library_path).replace(os.path.sep, '/'),
+             'entries': entries}
+    with open(os.path.join(library_path, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    return CropLibrary(library_path)
+
+
+class CropLibrary:
+    """
+    Read-only access to the specimen crops written by build_crop_library().
+
+    Crops are looked up by the path of their source image (any path inside the dataset directory
+    the library was built from) and returned without decoding the source image.
+    """
+
+    def __init__(self, library_path):
+        """
+        Args:
+            library_path (str): The directory of the library.
+        """
+        self.library_path = library_path
+        with open(os.path.join(library_path, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.dataset_path = os.path.normpath(os.path.join(library_path, index['dataset_path']))
+        self.entries = index['entries']
+        self._buffer = None
+
+    def __getstate__(self):
+        # The memory map is opened again in each worker process
+        state = self.__dict__.copy()
+        state['_buffer'] = None
+        return state
+
+    def key(self, jpg):
+        """
+        Get the library key of a source image.
+
+        Args:
+            jpg (str): The path of the source image.
+
+        Returns:
+            str: The path relative to the dataset directory, with forward slashes.
+        """
+        return os.path.relpath(os.path.abspath(jpg), os.path.abspath(self.dataset_path)).replace(os.path.sep, '/')
+
+    def __contains__(self, jpg):
+        return self.key(jpg) in self.entries
+
+    def sources(self, subdirectory=''):
+        """
+        List the source images of the library.
+
+        Args:
+            subdirectory (str): Only list the images under this subdirectory of the dataset, e.g. 'species'.
+
+        Returns:
+            list: The sorted paths of the source images.
+        """
+        prefix = subdirectory.strip('/') + '/' if subdirectory else ''
+        return [os.path.join(self.dataset_path, key) for key in sorted(self.entries) if key.startswith(prefix)]
+
+    def pixels(self, key):
+        """
+        Get the crop pixels of a library key.
+
+        Args:
+            key (str): The library key.
+
+        Returns:
+            numpy.ndarray: A read-only (h, w, 3) uint8 view into the memory map.
+        """
+        if self._buffer is None:
+            self._buffer = np.memmap(os.path.join(self.library_path, 'crops.bin'), dtype=np.uint8, mode='r')
+        entry = self.entries[key]
+        size = entry['height'] * entry['width'] * 3
+        return self._buffer[entry['offset']:entry['offset'] + size].reshape(entry['height'], entry['width'], 3)
+
+    def crop(self, jpg):
+        """
+        Get the cropped rectangle annotation of a source image.
+
+        Args:
+            jpg (str): The path of the source image.
+
+        Returns:
+            PIL.Image.Image: The crop.
+        """
+        return Image.fromarray(self.pixels(self.key(jpg)))
+
+    def crop_size(self, jpg):
+        """
+        Get the size of the cropped rectangle annotation of a source image.
+
+        Args:
+            jpg (str): The path of the source image.
+
+        Returns:
+            tuple: The size of the crop (w, h).
+        """
+        entry = self.entries[self.key(jpg)]
+        return entry['width'], entry['height']
+
+    def annotation(self, jpg):
+        """
+        Get the LabelMe JSON data of a source image, its annotation_fields.
+
+        Args:
+            jpg (str): The path of the source image.
+
+        Returns:
+            dict: The data with copies of its shape dicts, whose fields are free to reassign.
+        """
+        data = self.entries[self.key(jpg)]['data']
+        return dict(data, shapes=[dict(shape) for shape in data['shapes']])
+
+    def close(self):
+        """
+        Release the memory map.
+        """
+        self._buffer = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the specimen crop library used by the synthesis scripts.")
+    parser.add_argument('--dataset', default='../init_dataset', help="Annotated dataset directory")
+    parser.add_argument('--output', default='../crop_library', help="Crop library directory")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes")
+    args = parser.parse_args()
+    library = build_crop_library(args.dataset, args.output, args.workers)
+    print(f"{len(library.entries)} specimens in {args.output}")
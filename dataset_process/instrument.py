@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import threading
+import multiprocessing.util
+from contextlib import contextmanager, nullcontext
+
+# The JSON-lines file of the metrics, inherited by the worker processes through the environment
+environment_variable = 'DATASET_METRICS'
+
+# The recorder of this process, None while disabled
+_recorder = None
+_disabled_timer = nullcontext()
+
+
+class Recorder:
+    """
+    Accumulate the timers, counters and histograms of a process and append them to a JSON-lines
+    file on flush(), one summary line per flush plus one line per event. The writer threads of a
+    process share its recorder.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): The JSON-lines file.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.reset()
+        self.flush_at_exit()
+        multiprocessing.util.register_after_fork(self, Recorder.after_fork)
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.timers = {}
+        self.counters = {}
+        self.histograms = {}
+        self.lines = []
+
+    def flush_at_exit(self):
+        # Worker processes exit without running the atexit handlers, but with the multiprocessing finalizers
+        multiprocessing.util.Finalize(self, self.flush, exitpriority=0)
+
+    def after_fork(self):
+        # A forked worker starts with a copy of the values of its parent, which the parent reports itself,
+        # and of its lock, which a writer thread of the parent may have held
+        self.lock = threading.Lock()
+        self.reset()
+        self.flush_at_exit()
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                total, calls = self.timers.get(stage, (0.0, 0))
+                self.timers[stage] = (total + seconds, calls + 1)
+
+    def count(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        # Power-of-two buckets: 1, 2, 4, 8, ... hold the values up to them
+        bucket = str(1 << max(int(value) - 1, 0).bit_length())
+        with self.lock:
+            histogram = self.histograms.setdefault(name, {})
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+
+    def event(self, name, fields):
+        line = json.dumps(dict(fields, event=name, pid=self.pid, time=time.time()))
+        with self.lock:
+            self.lines.append(line)
+
+    def flush(self):
+        with self.lock:
+            lines = self.lines
+            if self.timers or self.counters or self.histograms:
+                lines.append(json.dumps({
+                    'event': 'summary', 'pid': self.pid, 'time': time.time(),
+                    'timers': {stage: {'seconds': seconds, 'calls': calls}
+                               for stage, (seconds, calls) in self.timers.items()},
+                    'counters': self.counters, 'histograms': self.histograms}))
+            self.reset()
+        if lines:
+            # One write per flush, so the lines of concurrent worker processes do not interleave
+            with open(self.path, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+
+
+def enable(path):
+    """
+    Record the metrics of this process and of the worker processes it starts into a JSON-lines file.
+
+    Args:
+        path (str): The JSON-lines file, appended to.
+    """
+    global _recorder
+    os.environ[environment_variable] = os.path.abspath(path)
+    _recorder = Recorder(os.path.abspath(path))
+
+
+def enabled():
+    """
+    Whether the metrics are recorded, to skip computing a value that is only recorded.
+    """
+    return _recorder is not None
+
+
+def timer(stage):
+    """
+    Time a stage: with instrument.timer('encode'): ...
+
+    Args:
+        stage (str): The stage name, its seconds and calls add up until the next flush.
+
+    Returns:
+        A context manager, a shared one doing nothing while disabled.
+    """
+    return _disabled_timer if _recorder is None else _recorder.timer(stage)
+
+
+def count(name, value=1):
+    """
+    Add to a counter, e.g. the bytes written.
+    """
+    if _recorder is not None:
+        _recorder.count(name, value)
+
+
+def observe(name, value):
+    """
+    Add a value to a histogram of power-of-two buckets, e.g. the placement attempts.
+    """
+    if _recorder is not None:
+        _recorder.observe(name, value)
+
+
+def event(name, **fields):
+    """
+    Record an event with its fields as its own line, e.g. the fill ratio of a canvas.
+    """
+    if _recorder is not None:
+        _recorder.event(name, fields)
+
+
+def flush():
+    """
+    Append the events and a summary of the values since the last flush to the file.
+    """
+    if _recorder is not None:
+        _recorder.flush()
+
+
+if os.environ.get(environment_variable):
+    # A worker process of an instrumented run
+    _recorder = Recorder(os.environ[environment_variable])
@@ -3,10 +3,15 @@ import json
 import shutil
 import random
 import sys
+import argparse
 
+import yaml
 from tqdm import tqdm
 from PIL import Image
 
+import instrument
+from async_writer import AsyncWriter
+
 random.seed(4399)
 
 def split_list_into_equal_chunks(lst, num_chunks):
@@ -90,88 +95,243 @@ def convert_poly_to_rect(coordinate_list):
         flag = True
     return [Xmin, Ymin, Xmax - Xmin, Ymax - Ymin], flag
 
-def convert_labelme_json_to_txt(files, out_txt_path, kind):
+def convert_shape_to_bbox(points, img_w, img_h):
     """
-    Convert LabelMe JSON files to YOLO format TXT files.
+    Convert the points of a LabelMe shape to a normalized YOLO box.
 
     Args:
-        files (list): List of file names without extensions.
-        out_txt_path (str): Output directory path.
-        kind (str): Type of dataset (train, val, test).
+        points (list): The points of the shape (2 for a rectangle, at least 4 for a polygon).
+        img_w (int): The image width.
+        img_h (int): The image height.
+
+    Returns:
+        list: The normalized [x_center, y_center, w, h], or None if the shape is not a valid box.
+    """
+    if len(points) < 2:
+        return None
+
+    if len(points) == 2:
+        x1, y1 = points[0]
+        x2, y2 = points[1]
+        points = [[x1, y1], [x2, y1], [x2, y2], [x1, y2]]
+    elif len(points) < 4:
+        return None
+
+    segmentation = []
+    for p in points:
+        segmentation.extend([int(p[0]), int(p[1])])
+
+    bbox, flag = convert_poly_to_rect(segmentation)
+    x1, y1, w, h = bbox
+
+    if flag:
+        return None
+
+    x_center = x1 + w / 2
+    y_center = y1 + h / 2
+    return [x_center / img_w, y_center / img_h, w / img_w, h / img_h]
+
+def class_ids_of(labels, names_path=None):
     """
-    global bbox_id
+    Get a deterministic YOLO class id for each label.
 
-    json_list = [file + '.json' for file in files]
-    for json_path in tqdm(json_list, desc=f"Processing {kind}: {len(json_list)}"):
-        shutil.copy(f'{os.path.splitext(json_path)[0]}.jpg', os.path.join(out_txt_path, 'images', kind))
+    Args:
+        labels (iterable): The labels of the rectangle annotations.
+        names_path (str): A dataset YAML file whose names give the class ids, or None to number
+            the sorted labels.
 
-        with open(json_path, "r") as f_json:
+    Returns:
+        dict: The class id of each label.
+    """
+    if names_path is None:
+        return {label: class_id for class_id, label in enumerate(sorted(set(labels)))}
+
+    with open(names_path, 'r') as f:
+        names = yaml.safe_load(f)['names']
+    class_ids = {name: class_id for class_id, name in names.items()}
+    missing = set(labels) - set(class_ids)
+    if missing:
+        raise ValueError(f"Labels missing from the names of {names_path}: {sorted(missing)}")
+    return class_ids
+
+def build_label_table(files):
+    """
+    Parse the LabelMe JSON files once and normalize their boxes.
+
+    Args:
+        files (list): List of file names without extensions.
+
+    Returns:
+        dict: For each file, None if it has no shapes, else the list of its (label, normalized box) pairs.
+    """
+    table = {}
+    for file in tqdm(files, desc=f"Parsing labels: {len(files)}"):
+        with instrument.timer('parse_labels'), open(file + '.json', "r") as f_json:
             json_data = json.load(f_json)
 
         infos = json_data['shapes']
         if not infos:
+            table[file] = None
             continue
 
         img_w = json_data['imageWidth']
         img_h = json_data['imageHeight']
-        image_name = json_data['imagePath']
-        txt_name = os.path.basename(json_path).split('.')[0] + '.txt'
-        txt_path = os.path.join(os.path.join(out_txt_path, 'labels', kind), txt_name)
-
-        with open(txt_path, 'w') as f:
-            for label in infos:
-                points = label['points']
-                if len(points) < 2:
-                    continue
-
-                if len(points) == 2:
-                    x1, y1 = points[0]
-                    x2, y2 = points[1]
-                    points = [[x1, y1], [x2, y1], [x2, y2], [x1, y2]]
-                elif len(points) < 4:
-                    continue
-
-                segmentation = []
-                for p in points:
-                    segmentation.extend([int(p[0]), int(p[1])])
-
-                bbox, flag = convert_poly_to_rect(segmentation)
-                x1, y1, w, h = bbox
-
-                if flag:
-                    continue
-
-                x_center = x1 + w / 2
-                y_center = y1 + h / 2
-                norm_x = x_center / img_w
-                norm_y = y_center / img_h
-                norm_w = w / img_w
-                norm_h = h / img_h
-
-                family = label['label']
-                if family not in bbox_class:
-                    bbox_class[family] = bbox_id
-                    bbox_id += 1
-
-                obj_cls = bbox_class[family]
-                line = [obj_cls, norm_x, norm_y, norm_w, norm_h]
-                line = [str(ll) for ll in line]
-                line = ' '.join(line) + '\n'
-                f.write(line)
-
-bbox_id = 0
-bbox_class = {}
+        boxes = []
+        for label in infos:
+            bbox = convert_shape_to_bbox(label['points'], img_w, img_h)
+            if bbox is not None:
+                boxes.append((label['label'], bbox))
+        table[file] = boxes
+    return table
+
+def convert_labelme_json_to_txt(files, out_txt_path, kind, table, class_ids):
+    """
+    Write the images and YOLO format TXT files of LabelMe files from their label table.
 
-if __name__ == "__main__":
-    init_dataset = r'../init_dataset/species'
-    dataset_path = r'../labelme_output_images/species'
-    output_path = r'../yolo_output_images/species'
+    Args:
+        files (list): List of file names without extensions.
+        out_txt_path (str): Output directory path.
+        kind (str): Type of dataset (train, val, test).
+        table (dict): The label table of build_label_table().
+        class_ids (dict): The YOLO class id of each label.
+    """
+    # The image copies and label files are written behind while the next lines are built
+    with AsyncWriter(threads=4, max_pending=64) as writer:
+        for file in tqdm(files, desc=f"Processing {kind}: {len(files)}"):
+            writer.copy(f'{file}.jpg', os.path.join(out_txt_path, 'images', kind))
+            if instrument.enabled():
+                instrument.count('bytes_written', os.path.getsize(f'{file}.jpg'))
+
+            boxes = table[file]
+            if boxes is None:
+                continue
+
+            txt_path = os.path.join(out_txt_path, 'labels', kind, os.path.basename(file).split('.')[0] + '.txt')
+            lines = []
+            with instrument.timer('convert'):
+                for family, bbox in boxes:
+                    line = [class_ids[family]] + bbox
+                    line = [str(ll) for ll in line]
+                    lines.append(' '.join(line) + '\n')
+            instrument.count('bytes_written', sum(len(line) for line in lines))
+            writer.write_text(lines, txt_path)
+
+def list_labelme_files(dataset_path):
+    """
+    List the LabelMe JSON files of a dataset in image id order.
 
+    Args:
+        dataset_path (str): The directory of the LabelMe JSON and JPG files.
+
+    Returns:
+        list: The file paths without extensions.
+    """
+    stems = [file.split('.')[0] for file in os.listdir(dataset_path) if file.endswith('.json')]
+    stems.sort(key=stem_order)
+    return [os.path.join(dataset_path, stem) for stem in stems]
+
+def stem_order(stem):
+    """
+    Sort key of the file stems: the numeric image ids in numeric order, then the other names.
+    """
+    return not stem.isdigit(), int(stem) if stem.isdigit() else 0, stem
+
+def place_file(src, dst, layout):
+    """
+    Put a pool file into a fold directory.
+
+    Args:
+        src (str): The pool file.
+        dst (str): The path in the fold directory.
+        layout (str): 'hardlink' or 'symlink'. A hard link falls back to a copy when the file
+            system does not support it.
+    """
+    if layout == 'symlink':
+        os.symlink(os.path.relpath(src, os.path.dirname(dst)), dst)
+        return
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+def write_fold_yaml(output_path_k, layout, class_ids):
+    """
+    Write the dataset YAML file of a fold.
+
+    Args:
+        output_path_k (str): The fold directory.
+        layout (str): The fold layout, 'list' points to the train.txt/val.txt/test.txt image lists.
+        class_ids (dict): The YOLO class id of each label.
+    """
+    data = {'path': os.path.abspath(output_path_k)}
+    for kind in ['train', 'val', 'test']:
+        data[kind] = f'{kind}.txt' if layout == 'list' else f'images/{kind}'
+    data['names'] = {class_id: label for label, class_id in sorted(class_ids.items(), key=lambda item: item[1])}
+    with open(os.path.join(output_path_k, 'data.yaml'), 'w') as f:
+        yaml.dump(data, f, allow_unicode=True)
+
+def convert_dataset(dataset_path, output_path, folds=10, layout='copy', names_path=None, group_of=None,
+                    groups_path=None):
+    """
+    Generate the k-fold cross-validation YOLO datasets of a LabelMe dataset.
+
+    Fold k tests on chunk k, validates on chunk k + 1 and trains on the other chunks. Every fold
+    gets a data.yaml file to train and validate on.
+
+    With the 'copy' layout every fold holds its own copy of the images and labels. The other
+    layouts convert every image once into a shared pool (images/pool and labels/pool) and
+    express the folds as hard links ('hardlink'), symbolic links ('symlink') or image lists
+    ('list': train.txt, val.txt and test.txt, Ultralytics finds the labels next to the pool images).
+
+    Every JSON file is parsed once into a label table, the label files of all folds are written from it.
+
+    Args:
+        dataset_path (str): The directory of the LabelMe JSON and JPG files.
+        output_path (str): The output directory, fold k goes to its k folder.
+        folds (int): The number of folds.
+        layout (str): 'copy', 'hardlink', 'symlink' or 'list'.
+        names_path (str): A dataset YAML file whose names give the class ids, or None to number
+            the sorted labels.
+        group_of (callable): Maps a file name without extension to its group, the files of a group
+            always land in the same chunk (e.g. the tiles of one image), or None to split the files.
+        groups_path (str): The LabelMe dataset whose files are the groups (e.g. the community images
+            the tiles were cut from): the groups are split into chunks exactly like that dataset, so
+            fold k of both datasets tests on the same images. None to split the groups found, in
+            stem_order().
+    """
     print("Dataset path:", dataset_path)
     print("Output path:", output_path)
 
+    files_without_ext = list_labelme_files(dataset_path)
+    if group_of is None:
+        k_files = split_list_into_equal_chunks(files_without_ext, folds)
+    else:
+        groups = {}
+        for file in files_without_ext:
+            groups.setdefault(group_of(os.path.basename(file)), []).append(file)
+        if groups_path is None:
+            group_names = sorted(groups, key=stem_order)
+        else:
+            group_names = [os.path.basename(file) for file in list_labelme_files(groups_path)]
+            unknown = sorted(set(groups) - set(group_names))
+            if unknown:
+                raise ValueError(f"The groups {unknown[:5]} are not files of {groups_path}")
+        # A group without files (an image without tiles) keeps its place in the split
+        k_files = [[file for group in chunk for file in groups.get(group, [])]
+                   for chunk in split_list_into_equal_chunks(group_names, folds)]
+
+    table = build_label_table(files_without_ext)
+    class_ids = class_ids_of([label for boxes in table.values() if boxes for label, _ in boxes], names_path)
+
+    if layout != 'copy':
+        # Convert every image once into the shared pool
+        for subdir in ['images', 'labels']:
+            shutil.rmtree(os.path.join(output_path, subdir), ignore_errors=True)
+            os.makedirs(os.path.join(output_path, subdir, 'pool'))
+        convert_labelme_json_to_txt(files_without_ext, output_path, 'pool', table, class_ids)
+
     # Generate k-fold cross-validation data
-    for k in range(10):
+    for k in range(folds):
         output_path_k = os.path.join(output_path, str(k))
 
         # Delete all files and folders in the target output folder recursively
@@ -179,28 +339,51 @@ if __name__ == "__main__":
             shutil.rmtree(output_path_k)
         os.makedirs(output_path_k)
 
-        for subdir in ['images', 'labels']:
-            for kind in ['train', 'val', 'test']:
-                os.makedirs(os.path.join(output_path_k, subdir, kind))
+        if layout != 'list':
+            for subdir in ['images', 'labels']:
+                for kind in ['train', 'val', 'test']:
+                    os.makedirs(os.path.join(output_path_k, subdir, kind))
 
         # Select training and validation sets
-        os.chdir(dataset_path)
-
-        json_files = [file for file in os.listdir() if file.endswith('.json')]
-        files_without_ext = [file.split('.')[0] for file in json_files]
-
-        frac = 0.1
-        fold_num = int(len(files_without_ext) * frac)
-        k_files = split_list_into_equal_chunks(files_without_ext, 10)
-
         test_files = k_files[k]
-        val_files = k_files[(k + 1) % 10]
-        train_files = [file for i, files in enumerate(k_files) if i not in [k, (k + 1) % 10] for file in files]
+        val_files = k_files[(k + 1) % folds]
+        train_files = [file for i, files in enumerate(k_files) if i not in [k, (k + 1) % folds] for file in files]
 
         print(f"This is {k} fold, Total: {len(files_without_ext)}")
-        convert_labelme_json_to_txt(train_files, output_path_k, 'train')
-        convert_labelme_json_to_txt(val_files, output_path_k, 'val')
-        convert_labelme_json_to_txt(test_files, output_path_k, 'test')
+        for kind, files in [('train', train_files), ('val', val_files), ('test', test_files)]:
+            if layout == 'copy':
+                convert_labelme_json_to_txt(files, output_path_k, kind, table, class_ids)
+                continue
+
+            pool_images = [os.path.join(output_path, 'images', 'pool', f'{os.path.basename(file)}.jpg')
+                           for file in files]
+            if layout == 'list':
+                with open(os.path.join(output_path_k, f'{kind}.txt'), 'w') as f:
+                    f.writelines(f'{os.path.abspath(image)}\n' for image in pool_images)
+                continue
+            for image in pool_images:
+                name = os.path.splitext(os.path.basename(image))[0]
+                place_file(image, os.path.join(output_path_k, 'images', kind, f'{name}.jpg'), layout)
+                label = os.path.join(output_path, 'labels', 'pool', f'{name}.txt')
+                if os.path.exists(label):
+                    place_file(label, os.path.join(output_path_k, 'labels', kind, f'{name}.txt'), layout)
+
+        write_fold_yaml(output_path_k, layout, class_ids)
+        print(f"Successful: {k}")
+    instrument.flush()
 
-        print({v: k for k, v in bbox_class.items()})
-        print(f"Successful: {k}")
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a LabelMe dataset to k-fold YOLO datasets.")
+    parser.add_argument('--dataset', default='../labelme_output_images/species', help="LabelMe dataset directory")
+    parser.add_argument('--output', default='../yolo_output_images/species', help="YOLO output directory")
+    parser.add_argument('--folds', type=int, default=10, help="Number of folds")
+    parser.add_argument('--names', default=None, help="Dataset YAML file whose names give the class ids")
+    parser.add_argument('--layout', choices=['copy', 'hardlink', 'symlink', 'list'], default='hardlink',
+                        help="Copy the images into every fold, or store them once and link or list them")
+    parser.add_argument('--metrics', default=None, help="Append timers and counters to this JSON-lines file")
+    args = parser.parse_args()
+
+    if args.metrics:
+        instrument.enable(args.metrics)
+
+    convert_dataset(args.dataset, args.output, args.folds, args.layout, args.names)
@@ -0,0 +1,208 @@
+import os
+import json
+import hashlib
+import argparse
+
+import instrument
+from catalog import build_catalog
+from check_json import check_json_files
+from crop_library import build_crop_library
+from labelme2yolo_detect import convert_dataset
+from synthesis import strategies, synthesize
+
+
+class PipelineState:
+    """
+    The state of the dataset pipeline between runs: the fingerprint of every finished stage and the
+    content hashes of the other files they read (backgrounds, YAML files), so unchanged files are
+    not hashed again.
+    """
+
+    def __init__(self, state_path):
+        """
+        Args:
+            state_path (str): The JSON file of the state.
+        """
+        self.state_path = state_path
+        self.stages = {}
+        self.hashes = {}
+        if os.path.exists(state_path):
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+            self.stages = state['stages']
+            self.hashes = state['hashes']
+
+    def file_hash(self, path):
+        """
+        Hash a file, reusing the last hash while its size and mtime do not change.
+
+        Args:
+            path (str): The file path.
+
+        Returns:
+            str: The SHA-1 hex digest.
+        """
+        stat = os.stat(path)
+        stat = [stat.st_size, stat.st_mtime]
+        cached = self.hashes.get(path)
+        if cached and cached['stat'] == stat:
+            return cached['hash']
+        with open(path, 'rb') as f:
+            content_hash = hashlib.sha1(f.read()).hexdigest()
+        self.hashes[path] = {'stat': stat, 'hash': content_hash}
+        return content_hash
+
+    def run(self, name, fingerprint, outputs, fn, force=False):
+        """
+        Run a stage unless it already ran with the same fingerprint and its outputs still exist.
+
+        Args:
+            name (str): The stage name.
+            fingerprint (str): The fingerprint of everything the stage reads.
+            outputs (list): The paths the stage writes.
+            fn (callable): The stage.
+            force (bool): Whether to run the stage anyway.
+
+        Returns:
+            bool: Whether the stage ran.
+        """
+        if not force and self.stages.get(name) == fingerprint and all(os.path.exists(path) for path in outputs):
+            print(f"Skipping {name}: up to date")
+            return False
+        print(f"Running {name}")
+        fn()
+        self.stages[name] = fingerprint
+        self.save()
+        return True
+
+    def save(self):
+        with open(self.state_path, 'w') as f:
+            json.dump({'stages': self.stages, 'hashes': self.hashes}, f)
+
+
+def check_annotations(dataset_path, workers=1):
+    """
+    Run check_json_files() and stop the pipeline if any annotation is invalid.
+    """
+    errors = check_json_files(dataset_path, workers, '../check_json_report.json', '../check_json_state.json')
+    if errors:
+        raise RuntimeError(f"{len(errors)} annotation errors, see ../check_json_report.json")
+
+
+def fingerprint_of(*values):
+    """
+    Hash values into a stage fingerprint, values JSON cannot encode (e.g. ranges) by their repr().
+
+    Returns:
+        str: The SHA-1 hex digest.
+    """
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=repr).encode()).hexdigest()
+
+
+def run_pipeline(levels=('species',), workers=1, output_format='labelme', names_path=None,
+                 dataset_path='../init_dataset', library_path='../crop_library',
+                 background_paths=('../4640_3480.jpg',), labelme_path='../labelme_output_images',
+                 yolo_path='../yolo_output_images', state_path='../pipeline_state.json', force=False,
+                 catalog_path='../catalog.sqlite', layout='hardlink', folds=10):
+    """
+    Run the dataset pipeline, annotation check -> crop library -> synthesis -> YOLO k-fold datasets,
+    skipping every stage whose inputs did not change since its last run.
+
+    The dataset fingerprint is read from the catalog, which is updated first and only reads the
+    changed files.
+
+    Synthesis itself only regenerates the composite images whose sources changed.
+
+    Args:
+        levels (tuple): The levels to synthesize: species, family and/or order.
+        workers (int): The number of worker processes.
+        output_format (str): The synthesis output format: 'labelme', 'yolo' or 'both'. The
+            labelme2yolo stage runs for 'labelme' only, the other formats write YOLO labels directly.
+        names_path (str): Dataset YAML file whose names give the YOLO class ids, or None.
+        dataset_path (str): The annotated dataset directory (init_dataset).
+        library_path (str): The crop library directory.
+        background_paths (tuple): The background images.
+        labelme_path (str): The LabelMe output directory.
+        yolo_path (str): The YOLO output directory.
+        state_path (str): The JSON file of the pipeline state.
+        force (bool): Whether to run every stage again.
+        catalog_path (str): The catalog of the dataset.
+        layout (str): The fold layout of the YOLO datasets, see convert_dataset().
+        folds (int): The number of folds of the YOLO datasets.
+    """
+    state = PipelineState(state_path)
+    catalog = build_catalog(dataset_path, catalog_path, workers)
+    dataset_fingerprint = fingerprint_of(catalog.fingerprint())
+    background_hashes = [state.file_hash(path) for path in background_paths]
+    names_hash = state.file_hash(names_path) if names_path else None
+    state.save()
+
+    state.run('check_json', dataset_fingerprint, [], lambda: check_annotations(dataset_path, workers), force)
+    state.run('crop_library', dataset_fingerprint, [os.path.join(library_path, 'index.json')],
+              lambda: build_crop_library(dataset_path, library_path, workers, catalog), force)
+
+    for level in levels:
+        strategy = strategies[level]()
+        synthesis_fingerprint = fingerprint_of(dataset_fingerprint, background_hashes, names_hash, output_format,
+                                               vars(strategy))
+        save_root = os.path.join(labelme_path, level)
+        outputs = [save_root] if output_format != 'yolo' else [os.path.join(yolo_path, f'{level}_stream')]
+        state.run(f'synthesize:{level}', synthesis_fingerprint, outputs,
+                  lambda: synthesize(strategy, workers, output_format, names_path, dataset_path, library_path,
+                                     background_paths, labelme_path, yolo_path, force, catalog_path),
+                  force)
+
+        if output_format != 'labelme':
+            continue
+        # The YOLO datasets also depend on how they are converted, and on the class names file
+        conversion_fingerprint = fingerprint_of(synthesis_fingerprint, layout, folds, names_path, names_hash)
+        # The random species dataset is one flat folder, the design levels have one folder per dataset
+        if level == 'species':
+            conversions = [(save_root, os.path.join(yolo_path, level))]
+        else:
+            conversions = [(os.path.join(save_root, name), os.path.join(yolo_path, level, name))
+                           for name in sorted(os.listdir(save_root))]
+        for dataset_dir, output_dir in conversions:
+            state.run(f'labelme2yolo:{os.path.relpath(dataset_dir, labelme_path)}', conversion_fingerprint,
+                      [output_dir], lambda: convert_dataset(dataset_dir, output_dir, folds, layout, names_path),
+                      force)
+
+
+def main(argv=None):
+    """
+    Command line entry point of the dataset pipeline.
+
+    Args:
+        argv (list): The arguments, None to use sys.argv.
+    """
+    parser = argparse.ArgumentParser(description="Run the dataset pipeline, skipping the stages that are up to date.")
+    parser.add_argument('--levels', nargs='+', choices=sorted(strategies), default=['species'],
+                        help="Levels to synthesize")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes")
+    parser.add_argument('--output-format', choices=['labelme', 'yolo', 'both'], default='labelme',
+                        help="Synthesis output format")
+    parser.add_argument('--names', default=None, help="Dataset YAML file whose names give the YOLO class ids")
+    parser.add_argument('--dataset', default='../init_dataset', help="Annotated dataset directory")
+    parser.add_argument('--library', default='../crop_library', help="Crop library directory")
+    parser.add_argument('--background', nargs='+', default=['../4640_3480.jpg'], help="Background images")
+    parser.add_argument('--labelme-output', default='../labelme_output_images', help="LabelMe output directory")
+    parser.add_argument('--yolo-output', default='../yolo_output_images', help="YOLO output directory")
+    parser.add_argument('--catalog', default='../catalog.sqlite', help="Catalog file")
+    parser.add_argument('--layout', choices=['copy', 'hardlink', 'symlink', 'list'], default='hardlink',
+                        help="Fold layout of the YOLO datasets")
+    parser.add_argument('--folds', type=int, default=10, help="Number of folds of the YOLO datasets")
+    parser.add_argument('--state', default='../pipeline_state.json', help="Pipeline state file")
+    parser.add_argument('--force', action='store_true', help="Run every stage again")
+    parser.add_argument('--metrics', default=None, help="Append timers and counters to this JSON-lines file")
+    args = parser.parse_args(argv)
+
+    if args.metrics:
+        instrument.enable(args.metrics)
+
+    run_pipeline(args.levels, args.workers, args.output_format, args.names, args.dataset, args.library,
+                 tuple(args.background), args.labelme_output, args.yolo_output, args.state, args.force,
+                 args.catalog, args.layout, args.folds)
+
+
+if __name__ == "__main__":
+    main()
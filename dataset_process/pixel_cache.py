@@ -0,0 +1,210 @@
+import os
+import json
+import math
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+# A shard file holds the pixels of many images back to back, a new shard starts past this size
+shard_bytes = 2 ** 31
+
+
+def file_stat(path):
+    """
+    Get the size and mtime of a file.
+    """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def file_hash(path):
+    """
+    Hash the content of a file.
+    """
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def cached_shape(width, height, size):
+    """
+    Get the shape of a cached image the way Ultralytics resizes it: the long side at size, the aspect
+    ratio kept.
+
+    Args:
+        width (int): The image width.
+        height (int): The image height.
+        size (int): The target size, the imgsz.
+
+    Returns:
+        tuple: The (h, w, 3) shape.
+    """
+    ratio = size / max(width, height)
+    if ratio == 1:
+        return height, width, 3
+    return min(math.ceil(height * ratio), size), min(math.ceil(width * ratio), size), 3
+
+
+def decode_image(args):
+    """
+    Decode an image, resize it to the target size and write its BGR pixels into its shard slot.
+
+    Args:
+        args (tuple): The image path, the shard file, the offset and the (h, w, 3) shape.
+    """
+    image_path, shard_path, offset, shape = args
+    with Image.open(image_path) as image:
+        image = image.convert('RGB')
+        if image.size != (shape[1], shape[0]):
+            image = image.resize((shape[1], shape[0]), Image.BILINEAR)
+        # BGR, like cv2.imread() in the Ultralytics dataloader
+        pixels = np.asarray(image)[:, :, ::-1]
+    shard = np.memmap(shard_path, dtype=np.uint8, mode='r+', offset=offset, shape=shape)
+    shard[:] = pixels
+    shard.flush()
+
+
+def build_pixel_cache(image_paths, cache_dir, size, workers=1):
+    """
+    Decode images once into the memory-mapped pixel cache shared by every fold and training run.
+
+    The cache is a directory of shard files (decoded, resized uint8 BGR pixels back to back) and
+    index.json, whose entries are keyed by the content hash of the image and the target size, so
+    the same image listed by several folds or datasets is decoded once. index.json also remembers
+    the size, mtime and key of every image path and target size, so unchanged images are not hashed
+    again. New images go to a new shard: existing shards are never rewritten.
+
+    Args:
+        image_paths (list): The images to cache.
+        cache_dir (str): The cache directory.
+        size (int): The target size, the imgsz.
+        workers (int): The number of worker processes decoding the images.
+
+    Returns:
+        PixelCache: The up-to-date cache.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    index_path = os.path.join(cache_dir, 'index.json')
+    index = {'shards': [], 'entries': {}, 'files': {}}
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+
+    # Plan the slots of the images the cache does not have yet
+    shard = f'{len(index["shards"])}.bin'
+    shard_path = os.path.join(cache_dir, shard)
+    jobs = []
+    planned = set()
+    offset = 0
+    for image_path in sorted({os.path.abspath(path) for path in image_paths}):
+        stat = file_stat(image_path)
+        cached = index['files'].get(f'{size}:{image_path}')
+        if cached and cached['stat'] == stat:
+            continue
+        key = f'{file_hash(image_path)}_{size}'
+        index['files'][f'{size}:{image_path}'] = {'stat': stat, 'key': key}
+        if key in index['entries'] or key in planned:
+            continue
+        planned.add(key)
+        with Image.open(image_path) as image:
+            source_shape = [image.height, image.width]
+            shape = cached_shape(image.width, image.height, size)
+        jobs.append((key, image_path, offset, shape, source_shape))
+        offset += int(np.prod(shape))
+        if offset >= shard_bytes:
+            break
+
+    if jobs:
+        with open(shard_path, 'wb') as f:
+            f.truncate(offset)
+        decode_jobs = [(image_path, shard_path, job_offset, shape) for _, image_path, job_offset, shape, _ in jobs]
+        if workers <= 1:
+            results = map(decode_image, decode_jobs)
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            results = executor.map(decode_image, decode_jobs, chunksize=4)
+        for _ in tqdm(results, total=len(jobs), desc=f"Decoding to the pixel cache ({size})"):
+            pass
+        if workers > 1:
+            executor.shutdown()
+        index['shards'].append(shard)
+        for key, _, job_offset, shape, source_shape in jobs:
+            index['entries'][key] = {'shard': shard, 'offset': job_offset, 'shape': list(shape),
+                                     'source_shape': source_shape}
+
+    # Write then rename, so an interrupted build keeps the previous index
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_path + '.tmp', index_path)
+    if offset >= shard_bytes:
+        # The shard is full, the remaining images go to the next one
+        return build_pixel_cache(image_paths, cache_dir, size, workers)
+    return PixelCache(cache_dir)
+
+
+class PixelCache:
+    """
+    Read-only access to the images decoded by build_pixel_cache().
+    """
+
+    def __init__(self, cache_dir):
+        """
+        Args:
+            cache_dir (str): The cache directory.
+        """
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.entries = index['entries']
+        self.files = index['files']
+        self._shards = {}
+
+    def __getstate__(self):
+        # The memory maps are opened again in each dataloader worker process
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def get(self, image_path, size):
+        """
+        Get the cached pixels of an image.
+
+        Args:
+            image_path (str): The image path.
+            size (int): The target size.
+
+        Returns:
+            tuple: A read-only (h, w, 3) uint8 BGR view into the memory map and the (h, w) of the
+                source image, or (None, None) if the image is not cached at this size or changed
+                since it was cached.
+        """
+        image_path = os.path.abspath(image_path)
+        cached = self.files.get(f'{size}:{image_path}')
+        if not cached or cached['stat'] != file_stat(image_path):
+            return None, None
+        entry = self.entries[cached['key']]
+        if entry['shard'] not in self._shards:
+            self._shards[entry['shard']] = np.memmap(os.path.join(self.cache_dir, entry['shard']),
+                                                     dtype=np.uint8, mode='r')
+        shape = entry['shape']
+        pixels = self._shards[entry['shard']][entry['offset']:entry['offset'] + int(np.prod(shape))].reshape(shape)
+        return pixels, tuple(entry['source_shape'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Decode the images of a YOLO dataset once into the shared "
+                                                 "pixel cache.")
+    parser.add_argument('--images', default='../yolo_output_images/species/resized/2560_fit/images/pool',
+                        help="Image directory, e.g. the pool of a resized cache")
+    parser.add_argument('--cache', default='../pixel_cache', help="Pixel cache directory")
+    parser.add_argument('--size', type=int, default=2560, help="Target size (imgsz)")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes")
+    args = parser.parse_args()
+
+    image_paths = [os.path.join(args.images, file) for file in sorted(os.listdir(args.images))
+                   if file.lower().endswith(('.jpg', '.jpeg', '.png'))]
+    cache = build_pixel_cache(image_paths, args.cache, args.size, args.workers)
+    print(f"{len(cache.entries)} images in {args.cache}")
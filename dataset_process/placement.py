@@ -0,0 +1,260 @@
+def is_overlap(position1, size1, position2, size2):
+    """
+    Check if two rectangles overlap.
+
+    Args:
+        position1 (tuple): The position of the first rectangle (x1, y1).
+        size1 (tuple): The size of the first rectangle (w1, h1).
+        position2 (tuple): The position of the second rectangle (x2, y2).
+        size2 (tuple): The size of the second rectangle (w2, h2).
+
+    Returns:
+        bool: True if the rectangles overlap, False otherwise.
+    """
+    x1, y1 = position1
+    w1, h1 = size1
+    x2, y2 = position2
+    w2, h2 = size2
+
+    if x1 + w1 < x2 or x2 + w2 < x1:
+        return False
+    if y1 + h1 < y2 or y2 + h2 < y1:
+        return False
+
+    return True
+
+
+def tile_origins(length, tile_size, overlap):
+    """
+    Get the start positions of overlapping tiles along one image side.
+
+    Args:
+        length (int): The image side length.
+        tile_size (int): The tile side length.
+        overlap (float): The overlap between neighboring tiles, as a fraction of the tile size.
+
+    Returns:
+        list: The start positions, the last tile ends at the image border.
+    """
+    if length <= tile_size:
+        return [0]
+    stride = max(1, int(tile_size * (1 - overlap)))
+    origins = list(range(0, length - tile_size, stride))
+    return origins + [length - tile_size]
+
+
+class OccupiedPositions:
+    """
+    The positions of already pasted annotation boxes, indexed by a uniform grid hash.
+
+    It behaves like the plain list of (position, size) tuples the synthesis scripts used before,
+    but overlaps() only tests the boxes that share a grid cell with the candidate instead of every
+    box on the canvas. Boxes are treated as closed rectangles exactly like is_overlap(), so the
+    answer (and therefore every random draw of the retry loop) is identical to the linear scan.
+
+    With few boxes the scan is cheaper than the grid lookups (benchmark_placement.py), so below
+    linear_below boxes overlaps() scans them all and the grid is only built when that count is reached.
+    """
+
+    def __init__(self, cell_size=256, linear_below=100):
+        """
+        Args:
+            cell_size (int): The edge length of a grid cell in pixels, about twice the mean box edge.
+            linear_below (int): The number of boxes below which overlaps() scans every box.
+        """
+        self.cell_size = cell_size
+        self.linear_below = linear_below
+        self.positions = []
+        self.cells = {}
+
+    def _cells(self, position, size):
+        """
+        Yield the grid cells covered by a rectangle (both edges inclusive).
+
+        Args:
+            position (tuple): The position of the rectangle (x, y).
+            size (tuple): The size of the rectangle (w, h).
+        """
+        x, y = position
+        w, h = size
+        for cx in range(int(x // self.cell_size), int((x + w) // self.cell_size) + 1):
+            for cy in range(int(y // self.cell_size), int((y + h) // self.cell_size) + 1):
+                yield cx, cy
+
+    def append(self, item):
+        """
+        Add a pasted box.
+
+        Args:
+            item (tuple): The (position, size) of the pasted box.
+        """
+        self.positions.append(item)
+        if len(self.positions) == self.linear_below:
+            # The grid takes over from the scan, index the boxes so far
+            for index, box in enumerate(self.positions):
+                self._index(index, box)
+        elif len(self.positions) > self.linear_below:
+            self._index(len(self.positions) - 1, item)
+
+    def _index(self, index, item):
+        for cell in self._cells(*item):
+            self.cells.setdefault(cell, []).append(index)
+
+    def overlaps(self, position, size):
+        """
+        Check if a candidate box overlaps any already pasted box.
+
+        Args:
+            position (tuple): The position of the candidate box (x, y).
+            size (tuple): The size of the candidate box (w, h).
+
+        Returns:
+            bool: True if the candidate overlaps a pasted box, False otherwise.
+        """
+        x, y = position
+        w, h = size
+        positions = self.positions
+        if len(positions) < self.linear_below:
+            for (x2, y2), (w2, h2) in positions:
+                if not (x + w < x2 or x2 + w2 < x or y + h < y2 or y2 + h2 < y):
+                    return True
+            return False
+
+        cell_size = self.cell_size
+        cells = self.cells
+        checked = None
+        for cx in range(int(x // cell_size), int((x + w) // cell_size) + 1):
+            for cy in range(int(y // cell_size), int((y + h) // cell_size) + 1):
+                indexes = cells.get((cx, cy))
+                if not indexes:
+                    continue
+                for index in indexes:
+                    # A box spanning several cells is only tested once
+                    if checked is None:
+                        checked = set()
+                    elif index in checked:
+                        continue
+                    checked.add(index)
+                    (x2, y2), (w2, h2) = positions[index]
+                    if not (x + w < x2 or x2 + w2 < x or y + h < y2 or y2 + h2 < y):
+                        return True
+        return False
+
+    def clear(self):
+        """
+        Remove all pasted boxes, e.g. when a new background image is started.
+        """
+        self.positions.clear()
+        self.cells.clear()
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __iter__(self):
+        return iter(self.positions)
+
+
+class MaxRectsPacker:
+    """
+    A MaxRects bin packer of the boxes of one canvas.
+
+    The free space is kept as the list of the maximal free rectangles. A box goes into one of the
+    choices free rectangles that fit it best (best short side fit), picked at random, at a random
+    corner of it, so the canvas fills up densely without always packing from the top-left corner.
+
+    Boxes keep at least gap pixels between each other: every box is packed with gap pixels of margin
+    on its right and bottom sides, in a bin that is gap pixels larger than the canvas.
+    """
+
+    def __init__(self, canvas_size, gap=0, choices=3):
+        """
+        Args:
+            canvas_size (tuple): The size of the canvas (w, h).
+            gap (int): The minimum gap between two boxes in pixels, at least 1 for boxes that
+                must not overlap as closed rectangles like is_overlap().
+            choices (int): The number of best free rectangles a box is randomly placed into.
+        """
+        self.canvas_size = canvas_size
+        self.gap = gap
+        self.choices = choices
+        self.clear()
+
+    def clear(self):
+        """
+        Remove all packed boxes, e.g. when a new background image is started.
+        """
+        width, height = self.canvas_size
+        self.free = [(0, 0, width + self.gap, height + self.gap)]
+        self.area = 0
+
+    @property
+    def fill_ratio(self):
+        """
+        The area of the packed boxes over the area of the canvas.
+        """
+        return self.area / (self.canvas_size[0] * self.canvas_size[1])
+
+    def insert(self, size, rng):
+        """
+        Pack a box.
+
+        Args:
+            size (tuple): The size of the box (w, h).
+            rng (random.Random): The random generator of the canvas.
+
+        Returns:
+            tuple: The position (x, y) of the box, or None if no free rectangle fits it.
+        """
+        w, h = size
+        padded_w, padded_h = w + self.gap, h + self.gap
+        candidates = []
+        for free_x, free_y, free_w, free_h in self.free:
+            if free_w >= padded_w and free_h >= padded_h:
+                leftover_w, leftover_h = free_w - padded_w, free_h - padded_h
+                candidates.append((min(leftover_w, leftover_h), max(leftover_w, leftover_h),
+                                   (free_x, free_y, free_w, free_h)))
+        if not candidates:
+            return None
+
+        candidates.sort()
+        free_x, free_y, free_w, free_h = rng.choice(candidates[:self.choices])[2]
+        x = free_x if rng.random() < 0.5 else free_x + free_w - padded_w
+        y = free_y if rng.random() < 0.5 else free_y + free_h - padded_h
+        self._split((x, y, padded_w, padded_h))
+        self.area += w * h
+        return x, y
+
+    def _split(self, used):
+        """
+        Cut a used rectangle out of the free rectangles, keeping the maximal ones.
+
+        Args:
+            used (tuple): The used rectangle (x, y, w, h).
+        """
+        used_x, used_y, used_w, used_h = used
+        used_x2, used_y2 = used_x + used_w, used_y + used_h
+        free = []
+        for rectangle in self.free:
+            x, y, w, h = rectangle
+            x2, y2 = x + w, y + h
+            if used_x >= x2 or used_x2 <= x or used_y >= y2 or used_y2 <= y:
+                free.append(rectangle)
+                continue
+            # The parts of the free rectangle left, right, above and below the used one
+            if used_x > x:
+                free.append((x, y, used_x - x, h))
+            if used_x2 < x2:
+                free.append((used_x2, y, x2 - used_x2, h))
+            if used_y > y:
+                free.append((x, y, w, used_y - y))
+            if used_y2 < y2:
+                free.append((x, used_y2, w, y2 - used_y2))
+
+        # Drop the free rectangles contained in another one
+        free.sort(key=lambda rectangle: rectangle[2] * rectangle[3], reverse=True)
+        self.free = []
+        for rectangle in free:
+            x, y, w, h = rectangle
+            if not any(x >= ox and y >= oy and x + w <= ox + ow and y + h <= oy + oh
+                       for ox, oy, ow, oh in self.free):
+                self.free.append(rectangle)
@@ -0,0 +1,257 @@
+import os
+import json
+import hashlib
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+from PIL import Image
+from tqdm import tqdm
+
+# Resize policies: 'fit' keeps the aspect ratio with the long side at the target size, 'letterbox'
+# also pads the image to a target size square, 'stretch' resizes to a square like
+# resize_single_picture_json() in labelme2yolo_detect.py
+policies = ['fit', 'letterbox', 'stretch']
+
+
+def resized_geometry(width, height, size, policy):
+    """
+    Get the geometry of a resized image.
+
+    Args:
+        width (int): The source width.
+        height (int): The source height.
+        size (int): The target size.
+        policy (str): 'fit', 'letterbox' or 'stretch'.
+
+    Returns:
+        tuple: The resized (w, h) of the image content, the canvas (w, h) and the (x, y) padding.
+    """
+    if policy == 'stretch':
+        return (size, size), (size, size), (0, 0)
+    ratio = size / max(width, height)
+    new_size = (round(width * ratio), round(height * ratio))
+    if policy == 'fit':
+        return new_size, new_size, (0, 0)
+    return new_size, (size, size), ((size - new_size[0]) // 2, (size - new_size[1]) // 2)
+
+
+def letterbox_label_lines(lines, content_size, canvas_size, padding):
+    """
+    Move normalized YOLO boxes from the source image into a padded canvas.
+
+    Args:
+        lines (list): The YOLO label lines: class x_center y_center w h.
+        content_size (tuple): The (w, h) of the resized image content.
+        canvas_size (tuple): The (w, h) of the canvas.
+        padding (tuple): The (x, y) position of the content in the canvas.
+
+    Returns:
+        list: The label lines of the canvas.
+    """
+    sx, sy = content_size[0] / canvas_size[0], content_size[1] / canvas_size[1]
+    ox, oy = padding[0] / canvas_size[0], padding[1] / canvas_size[1]
+    new_lines = []
+    for line in lines:
+        values = line.split()
+        if not values:
+            continue
+        cls, x, y, w, h = values[0], *map(float, values[1:5])
+        new_lines.append(' '.join(str(value) for value in [cls, x * sx + ox, y * sy + oy, w * sx, h * sy]) + '\n')
+    return new_lines
+
+
+def resize_image(args):
+    """
+    Resize an image and its YOLO label file into the cache.
+
+    Args:
+        args (tuple): The source image, the source label file (may not exist), the output image,
+            the output label file, the target size and the policy.
+    """
+    image_path, label_path, out_image_path, out_label_path, size, policy = args
+    with Image.open(image_path) as image:
+        image = image.convert('RGB')
+        content_size, canvas_size, padding = resized_geometry(image.width, image.height, size, policy)
+        resized = image.resize(content_size, Image.BILINEAR)
+    if canvas_size != content_size:
+        canvas = Image.new('RGB', canvas_size, (114, 114, 114))
+        canvas.paste(resized, padding)
+        resized = canvas
+    resized.save(out_image_path, quality=95)
+
+    if not os.path.exists(label_path):
+        if os.path.exists(out_label_path):
+            os.remove(out_label_path)
+        return
+    if policy != 'letterbox':
+        # Normalized boxes do not change when the whole image is scaled
+        shutil.copy(label_path, out_label_path)
+        return
+    with open(label_path, 'r') as f:
+        lines = f.readlines()
+    with open(out_label_path, 'w') as f:
+        f.writelines(letterbox_label_lines(lines, content_size, canvas_size, padding))
+
+
+def source_hash(image_path, label_path):
+    """
+    Hash the content of an image and its label file.
+    """
+    sha1 = hashlib.sha1()
+    for path in [image_path, label_path]:
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                sha1.update(f.read())
+    return sha1.hexdigest()
+
+
+def label_path_of(image_path):
+    """
+    Get the label file of an image the way Ultralytics does: /images/ becomes /labels/.
+    """
+    head, _, tail = image_path.rpartition(f'{os.sep}images{os.sep}')
+    return os.path.splitext(os.path.join(f'{head}{os.sep}labels', tail))[0] + '.txt'
+
+
+def split_images(data, split):
+    """
+    List the images of a split of a dataset YAML file: an image directory or an image list file.
+
+    Args:
+        data (dict): The dataset YAML data, with an absolute path.
+        split (str): 'train', 'val' or 'test'.
+
+    Returns:
+        list: The absolute image paths.
+    """
+    split_path = os.path.join(data['path'], data[split])
+    if split_path.endswith('.txt'):
+        with open(split_path, 'r') as f:
+            images = [line.strip() for line in f if line.strip()]
+        return [image if os.path.isabs(image) else os.path.join(os.path.dirname(split_path), image)
+                for image in images]
+    return [os.path.join(split_path, file) for file in sorted(os.listdir(split_path))
+            if file.lower().endswith(('.jpg', '.jpeg', '.png'))]
+
+
+def fold_data(dataset_dir, k):
+    """
+    Read the dataset YAML data of a fold as labelme2yolo_detect.py wrote it, with the class names
+    of the conversion and the fold directory as path.
+
+    Args:
+        dataset_dir (str): The k-fold dataset directory.
+        k (int): The fold.
+
+    Returns:
+        dict: The dataset YAML data of the fold.
+
+    Raises:
+        FileNotFoundError: If the fold has no data.yaml.
+    """
+    fold_dir = os.path.join(dataset_dir, str(k))
+    yaml_path = os.path.join(fold_dir, 'data.yaml')
+    if not os.path.exists(yaml_path):
+        raise FileNotFoundError(f"{yaml_path} is missing, convert the dataset with labelme2yolo_detect.py")
+    with open(yaml_path, 'r') as f:
+        data = yaml.safe_load(f)
+    data['path'] = fold_dir
+    return data
+
+
+def resize_fold(yaml_path, size, policy='fit', workers=1):
+    """
+    Pre-resize the images of a k-fold dataset to the training resolution and get the YAML file of
+    the resized fold.
+
+    The resized images and labels are cached once per dataset in <dataset>/resized/<size>_<policy>
+    (images/pool and labels/pool) and the fold is written there as train.txt/val.txt/test.txt image
+    lists with its data.yaml. Images whose source did not change since the last run (same mtime or same
+    content) are not resized again.
+
+    Args:
+        yaml_path (str): The dataset YAML file of the fold, its path is the fold directory
+            <dataset>/<k>, relative paths are relative to the working directory.
+        size (int): The target size, the training imgsz.
+        policy (str): 'fit', 'letterbox' or 'stretch'.
+        workers (int): The number of worker processes.
+
+    Returns:
+        str: The dataset YAML file of the resized fold.
+    """
+    with open(yaml_path, 'r') as f:
+        data = yaml.safe_load(f)
+    data['path'] = os.path.abspath(data['path'])
+    fold_dir = data['path']
+    cache_dir = os.path.join(os.path.dirname(fold_dir), 'resized', f'{size}_{policy}')
+    for subdir in ['images', 'labels']:
+        os.makedirs(os.path.join(cache_dir, subdir, 'pool'), exist_ok=True)
+
+    index_path = os.path.join(cache_dir, 'index.json')
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+
+    # Resize the images the cache does not have yet
+    splits = {split: split_images(data, split) for split in ['train', 'val', 'test'] if data.get(split)}
+    jobs = []
+    for image_path in sorted({image for images in splits.values() for image in images}):
+        name = os.path.splitext(os.path.basename(image_path))[0]
+        label_path = label_path_of(image_path)
+        stat = [os.stat(path).st_mtime if os.path.exists(path) else None for path in [image_path, label_path]]
+        out_image_path = os.path.join(cache_dir, 'images', 'pool', f'{name}.jpg')
+        cached = index.get(name)
+        if cached and os.path.exists(out_image_path):
+            if cached['stat'] == stat:
+                continue
+            # The copy layout has one copy of the image per fold, same content but another mtime
+            content_hash = source_hash(image_path, label_path)
+            if cached['hash'] == content_hash:
+                cached['stat'] = stat
+                continue
+        index[name] = {'stat': stat, 'hash': source_hash(image_path, label_path)}
+        jobs.append((image_path, label_path, out_image_path,
+                     os.path.join(cache_dir, 'labels', 'pool', f'{name}.txt'), size, policy))
+
+    if workers <= 1:
+        results = map(resize_image, jobs)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(resize_image, jobs, chunksize=4)
+    for _ in tqdm(results, total=len(jobs), desc=f"Resizing to {size} ({policy})"):
+        pass
+    if workers > 1:
+        executor.shutdown()
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+
+    # Write the fold as lists of the resized images
+    resized_fold_dir = os.path.join(cache_dir, os.path.basename(fold_dir))
+    os.makedirs(resized_fold_dir, exist_ok=True)
+    resized_data = dict(data, path=resized_fold_dir)
+    for split, images in splits.items():
+        with open(os.path.join(resized_fold_dir, f'{split}.txt'), 'w') as f:
+            for image_path in images:
+                name = os.path.splitext(os.path.basename(image_path))[0]
+                f.write(os.path.join(cache_dir, 'images', 'pool', f'{name}.jpg') + '\n')
+        resized_data[split] = f'{split}.txt'
+    resized_yaml_path = os.path.join(resized_fold_dir, 'data.yaml')
+    with open(resized_yaml_path, 'w') as f:
+        yaml.dump(resized_data, f, allow_unicode=True)
+    return resized_yaml_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-resize the folds of a YOLO dataset to the training resolution.")
+    parser.add_argument('--dataset', default='../yolo_output_images/species', help="k-fold YOLO dataset directory")
+    parser.add_argument('--folds', type=int, default=10, help="Number of folds")
+    parser.add_argument('--size', type=int, default=2560, help="Target size (imgsz)")
+    parser.add_argument('--policy', choices=policies, default='fit', help="Aspect ratio policy")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes")
+    args = parser.parse_args()
+
+    for k in range(args.folds):
+        print(resize_fold(os.path.join(args.dataset, str(k), 'data.yaml'), args.size, args.policy, args.workers))
@@ -0,0 +1,1045 @@
+import io
+import os
+import json
+import random
+import shutil
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+import instrument
+from placement import MaxRectsPacker, OccupiedPositions
+from async_writer import AsyncWriter
+from catalog import build_catalog
+from crop_library import CropLibrary, build_crop_library
+from labelme2yolo_detect import class_ids_of, convert_shape_to_bbox, split_list_into_equal_chunks
+
+image_height = 3480
+image_width = 4640
+
+# The crop libraries and canvases opened by this process, see get_crop_library() and get_canvas()
+_crop_libraries = {}
+_canvases = {}
+
+# The write-behind writer of this process, see get_writer()
+_writer = None
+
+
+def extract_chinese_directories(path):
+    """
+    Extract directories containing Chinese characters from the given path.
+
+    Args:
+        path (str): The file path.
+
+    Returns:
+        list: A list of directories containing Chinese characters.
+    """
+    directories = path.split(os.path.sep)
+    chinese_directories = [directory for directory in directories if
+                           any('\u4e00' <= char <= '\u9fff' for char in directory)]
+    return chinese_directories
+
+
+def composite_label(jpg, relabel):
+    """
+    Get the label a pasted specimen gets in a design-mode community image.
+
+    Args:
+        jpg (str): The path of the source image.
+        relabel (str): 'family' to label by the Latin name of the Chinese family directory,
+            'order' to label by the directory three levels above the image (the original order script
+            computed this label but pasted the species label, see DesignOrderStrategy).
+
+    Returns:
+        str: The new label.
+    """
+    if relabel == 'family':
+        return extract_chinese_directories(jpg)[0].split()[1]
+    return os.path.normpath(jpg).split(os.path.sep)[-4]
+
+
+def derive_seed(seed, level, gradient, picture_id):
+    """
+    Derive the random seed of a single community image.
+
+    The seed only depends on its arguments, so each image is placed the same way whatever
+    the number of workers or the order the images are built in.
+
+    Args:
+        seed (int): The global seed of the run.
+        level (str): The synthesis level (species, family or order).
+        gradient (int): The number of taxa per image of the dataset.
+        picture_id (int): The id of the image in its dataset.
+
+    Returns:
+        int: The seed of the image.
+    """
+    key = f'{seed}:{level}:{gradient}:{picture_id}'.encode()
+    return int.from_bytes(hashlib.sha256(key).digest()[:8], 'big')
+
+
+def new_background_data():
+    """
+    Create the LabelMe JSON data of an empty background image.
+
+    Returns:
+        dict: The LabelMe JSON data.
+    """
+    return {
+        "version": "5.4.1",
+        "flags": {},
+        "shapes": [],
+        "imagePath": "background.jpg",
+        "imageData": None,
+        "imageHeight": image_height,
+        "imageWidth": image_width
+    }
+
+
+def find_position(rng, background_size, size, occupied_positions, spread_edges=True):
+    """
+    Randomly generate a new position until a non-overlapping position is found.
+
+    Args:
+        rng (random.Random): The random generator of the image.
+        background_size (tuple): The size of the background image (w, h).
+        size (tuple): The size of the box to place (w, h).
+        occupied_positions (OccupiedPositions): The already pasted boxes.
+        spread_edges (bool): Whether the first tries stick to the left and top edges.
+
+    Returns:
+        tuple: The position (x, y), or None if no position was found in 1000 tries.
+    """
+    background_width, background_height = background_size
+    width, height = size
+    trys = 1000
+    while True:
+        trys -= 1
+        if trys == 0:
+            instrument.count('placement_failures')
+            return None
+        if not spread_edges or trys <= 997:
+            random_x = rng.randint(0, background_width - width)
+            random_y = rng.randint(0, background_height - height)
+        elif trys <= 998:
+            random_x = rng.randint(0, background_width - width)
+            random_y = rng.randint(0, 100)
+        else:
+            random_x = rng.randint(0, 100)
+            random_y = rng.randint(0, background_height - height)
+
+        new_position = (random_x, random_y)
+        if not occupied_positions.overlaps(new_position, size):
+            instrument.observe('placement_attempts', 1000 - trys)
+            return new_position
+
+
+def shift_shapes(shapes, origin, new_position):
+    """
+    Move the shapes of a source image to the position its crop was pasted at.
+
+    Args:
+        shapes (list): The LabelMe shapes of the source image, updated in place.
+        origin (tuple): The top-left corner (x1, y1) of the cropped rectangle.
+        new_position (tuple): The position (x, y) the crop was pasted at.
+
+    Returns:
+        list: The moved rectangle and point shapes.
+    """
+    difference = [new_position[0] - origin[0], new_position[1] - origin[1]]
+    moved = []
+    for annotation in shapes:
+        if annotation['shape_type'] == 'rectangle':
+            cur_x2, cur_y2 = annotation['points'][1]
+            annotation['points'] = [[new_position[0], new_position[1]],
+                                    [cur_x2 + difference[0], cur_y2 + difference[1]]]
+            moved.append(annotation)
+        elif annotation['shape_type'] == 'point':
+            annotation['points'] = [[annotation['points'][0][0] + difference[0],
+                                     annotation['points'][0][1] + difference[1]]]
+            moved.append(annotation)
+    return moved
+
+
+def save_composite(canvas, background_data, job):
+    """
+    Queue the saving of a community image with its LabelMe JSON file and/or its YOLO label file.
+
+    The files are written by the write-behind writer of the process while the next image is built.
+
+    Args:
+        canvas (Canvas): The community image.
+        background_data (dict): The LabelMe JSON data.
+        job (dict): The job of the image: save_dir, picture_id, output_format ('labelme', 'yolo'
+            or 'both'), yolo_dir and class_ids (the YOLO class id of each label).
+    """
+    picture_id = job['picture_id']
+    background_data['imagePath'] = f'{picture_id}.jpg'
+    if instrument.enabled():
+        areas = [abs(x2 - x1) * abs(y2 - y1) for shape in background_data['shapes']
+                 if shape['shape_type'] == 'rectangle' for (x1, y1), (x2, y2) in [shape['points']]]
+        instrument.event('canvas', dataset=os.path.basename(os.path.normpath(job['save_dir'])),
+                         picture_id=picture_id, specimens=len(areas),
+                         fill_ratio=sum(areas) / (canvas.size[0] * canvas.size[1]))
+    get_writer().submit(write_composite, canvas.image(), background_data, job)
+
+
+def write_composite(background_image, background_data, job):
+    """
+    Save a community image with its LabelMe JSON file and/or its YOLO label file.
+
+    Args:
+        background_image (PIL.Image.Image): The community image.
+        background_data (dict): The LabelMe JSON data.
+        job (dict): The job of the image, see save_composite().
+    """
+    picture_id = job['picture_id']
+    # The JPEG is encoded in memory first, so the encoding and the disk write are timed apart
+    with instrument.timer('encode'):
+        buffer = io.BytesIO()
+        background_image.save(buffer, format='JPEG')
+    if job['output_format'] in ('labelme', 'both'):
+        write_file(os.path.join(job['save_dir'], f'{picture_id}.json'), json.dumps(background_data).encode())
+        write_file(os.path.join(job['save_dir'], f'{picture_id}.jpg'), buffer.getbuffer())
+
+    if job['output_format'] in ('yolo', 'both'):
+        # The YOLO pool shares the LabelMe image when both are written
+        yolo_image_path = os.path.join(job['yolo_dir'], 'pool', 'images', f'{picture_id}.jpg')
+        if job['output_format'] == 'both':
+            link_or_copy(os.path.join(job['save_dir'], f'{picture_id}.jpg'), yolo_image_path)
+        else:
+            write_file(yolo_image_path, buffer.getbuffer())
+
+        # An image without boxes gets an empty label file, a background image for YOLO
+        lines = yolo_label_lines(background_data, job['class_ids'])
+        write_file(os.path.join(job['yolo_dir'], 'pool', 'labels', f'{picture_id}.txt'), ''.join(lines).encode())
+
+
+def write_file(path, content):
+    """
+    Write the bytes of an output file, counting the time and the bytes written.
+
+    Args:
+        path (str): The output path.
+        content (bytes): The content.
+    """
+    with instrument.timer('write'):
+        with open(path, 'wb') as f:
+            f.write(content)
+    instrument.count('bytes_written', len(content))
+
+
+def link_or_copy(src, dst):
+    """
+    Hard-link a file, or copy it when the file system does not support hard links.
+
+    Args:
+        src (str): The source path.
+        dst (str): The destination path.
+    """
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+def yolo_label_lines(background_data, class_ids):
+    """
+    Convert the shapes of a community image to YOLO label lines, like labelme2yolo_detect.py does.
+
+    Args:
+        background_data (dict): The LabelMe JSON data.
+        class_ids (dict): The YOLO class id of each label.
+
+    Returns:
+        list: The label lines.
+    """
+    lines = []
+    for label in background_data['shapes']:
+        bbox = convert_shape_to_bbox(label['points'], background_data['imageWidth'], background_data['imageHeight'])
+        if bbox is None:
+            continue
+        line = [class_ids[label['label']]] + bbox
+        lines.append(' '.join(str(ll) for ll in line) + '\n')
+    return lines
+
+
+def prepare_yolo_dir(yolo_dir):
+    """
+    Create a YOLO output directory (pool/images and pool/labels).
+
+    Args:
+        yolo_dir (str): The YOLO output directory.
+    """
+    for subdir in ['images', 'labels']:
+        os.makedirs(os.path.join(yolo_dir, 'pool', subdir), exist_ok=True)
+
+
+def write_fold_manifest(yolo_dir, picture_ids, class_ids, folds=10):
+    """
+    Write the k-fold split of a YOLO output directory, using the split of labelme2yolo_detect.py.
+
+    Fold k tests on chunk k, validates on chunk k + 1 and trains on the other chunks.
+
+    Args:
+        yolo_dir (str): The YOLO output directory.
+        picture_ids (list): The ids of the saved images.
+        class_ids (dict): The YOLO class id of each label.
+        folds (int): The number of folds.
+    """
+    files = [f'{picture_id}.jpg' for picture_id in picture_ids]
+    k_files = split_list_into_equal_chunks(files, folds)
+    manifest = {'names': {class_id: label for label, class_id in sorted(class_ids.items(), key=lambda x: x[1])},
+                'folds': []}
+    for k in range(folds):
+        manifest['folds'].append({
+            'train': [file for i, chunk in enumerate(k_files) if i not in [k, (k + 1) % folds] for file in chunk],
+            'val': k_files[(k + 1) % folds],
+            'test': k_files[k]
+        })
+    with open(os.path.join(yolo_dir, 'folds.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def first_rectangle(data):
+    """
+    Get the rectangle annotation of a source image (check_json.py makes sure there is exactly one).
+
+    Args:
+        data (dict): The LabelMe JSON data of the source image.
+
+    Returns:
+        dict: The rectangle shape.
+    """
+    return next(annotation for annotation in data['shapes'] if annotation['shape_type'] == 'rectangle')
+
+
+class Canvas:
+    """
+    A preallocated community image, reset from a bank of decoded background images.
+
+    The backgrounds are decoded once and every new community image is started with a single
+    copy into the same buffer, so the memory and the time per image stay flat over a run.
+    """
+
+    def __init__(self, background_paths):
+        """
+        Args:
+            background_paths (tuple): The background images, resized to image_width x image_height
+                if they have another size.
+        """
+        self.backgrounds = []
+        for background_path in background_paths:
+            with instrument.timer('decode_background'):
+                background = Image.open(background_path).convert('RGB')
+                if background.size != (image_width, image_height):
+                    background = background.resize((image_width, image_height))
+            self.backgrounds.append(np.asarray(background))
+        self.pixels = np.empty_like(self.backgrounds[0])
+
+    @property
+    def size(self):
+        return self.pixels.shape[1], self.pixels.shape[0]
+
+    def reset(self, background_index=0):
+        """
+        Start a new community image from a background of the bank.
+
+        Args:
+            background_index (int): The index of the background in the bank.
+        """
+        np.copyto(self.pixels, self.backgrounds[background_index % len(self.backgrounds)])
+
+    def paste(self, crop_pixels, position):
+        """
+        Paste a crop, like PIL's Image.paste() for a crop that fits inside the canvas.
+
+        Args:
+            crop_pixels (numpy.ndarray): The (h, w, 3) crop.
+            position (tuple): The position (x, y) of the top-left corner.
+        """
+        x, y = position
+        height, width = crop_pixels.shape[:2]
+        self.pixels[y:y + height, x:x + width] = crop_pixels
+
+    def image(self):
+        """
+        Get the community image for saving.
+
+        Returns:
+            PIL.Image.Image: A copy of the image, safe to save while the canvas is reused.
+        """
+        return Image.fromarray(self.pixels.copy())
+
+
+def get_canvas(background_paths):
+    """
+    Create the canvas of a background bank once per process.
+
+    Args:
+        background_paths (tuple): The background images.
+
+    Returns:
+        Canvas: The canvas.
+    """
+    background_paths = tuple(background_paths)
+    if background_paths not in _canvases:
+        _canvases[background_paths] = Canvas(background_paths)
+    return _canvases[background_paths]
+
+
+def get_crop_library(library_path):
+    """
+    Open a crop library once per process.
+
+    Args:
+        library_path (str): The directory of the crop library.
+
+    Returns:
+        CropLibrary: The crop library.
+    """
+    if library_path not in _crop_libraries:
+        _crop_libraries[library_path] = CropLibrary(library_path)
+    return _crop_libraries[library_path]
+
+
+def paste_specimen(canvas, background_data, library, jpg, data, position):
+    """
+    Paste the rectangle annotation of a source image at the given position.
+
+    Args:
+        canvas (Canvas): The community image.
+        background_data (dict): The LabelMe JSON data of the community image.
+        library (CropLibrary): The crop library holding the source image.
+        jpg (str): The path of the source image.
+        data (dict): The LabelMe JSON data of the source image.
+        position (tuple): The position (x, y) to paste the crop at.
+    """
+    origin = first_rectangle(data)['points'][0]
+    with instrument.timer('paste'):
+        canvas.paste(library.pixels(library.key(jpg)), position)
+    background_data['shapes'].extend(shift_shapes(data['shapes'], origin, position))
+
+
+def synthesize_placed_image(job):
+    """
+    Build a community image whose positions were already chosen (random synthesis mode).
+
+    Args:
+        job (dict): background_paths, library_path, placements (a list of (jpg, position) tuples)
+            and the output keys of save_composite().
+
+    Returns:
+        int: The id of the saved image.
+    """
+    library = get_crop_library(job['library_path'])
+    canvas = get_canvas(job['background_paths'])
+    canvas.reset(job['picture_id'])
+    background_data = new_background_data()
+    for jpg, position in job['placements']:
+        paste_specimen(canvas, background_data, library, jpg, library.annotation(jpg), position)
+
+    save_composite(canvas, background_data, job)
+    return job['picture_id']
+
+
+def synthesize_design_image(job):
+    """
+    Build a community image from one specimen per selected taxon (design synthesis mode).
+
+    Args:
+        job (dict): background_paths, library_path, jpg_list, seed (the derived seed of the image),
+            relabel (None, 'family' or 'order'), spread_edges and the output keys of save_composite().
+
+    Returns:
+        int: The id of the saved image.
+    """
+    rng = random.Random(job['seed'])
+    library = get_crop_library(job['library_path'])
+    annotations = {jpg: library.annotation(jpg) for jpg in job['jpg_list']}
+
+    # Sort images by annotation box size from large to small
+    dict_areas = {}
+    for jpg, data in annotations.items():
+        (x1, y1), (x2, y2) = first_rectangle(data)['points']
+        dict_areas[jpg] = abs(x2 - x1) * abs(y2 - y1)
+    jpg_list = sorted(dict_areas, key=dict_areas.get, reverse=True)
+
+    canvas = get_canvas(job['background_paths'])
+    canvas.reset(job['picture_id'])
+    background_data = new_background_data()
+    occupied_positions = OccupiedPositions()
+    for jpg in jpg_list:
+        data = annotations[jpg]
+        if job['relabel']:
+            first_rectangle(data)['label'] = composite_label(jpg, job['relabel'])
+        size = library.crop_size(jpg)
+
+        with instrument.timer('placement'):
+            new_position = find_position(rng, canvas.size, size, occupied_positions, job['spread_edges'])
+        if new_position is None:
+            raise RuntimeError(f"Too many jpgs to create: {len(jpg_list)} {jpg_list}")
+        occupied_positions.append((new_position, size))
+
+        paste_specimen(canvas, background_data, library, jpg, data, new_position)
+
+    save_composite(canvas, background_data, job)
+    return job['picture_id']
+
+
+def get_writer():
+    """
+    Create the write-behind writer once per process.
+
+    Returns:
+        AsyncWriter: The writer.
+    """
+    global _writer
+    if _writer is None:
+        _writer = AsyncWriter()
+    return _writer
+
+
+def run_chunk(worker, jobs):
+    """
+    Build a chunk of community images, then wait until all of them are written.
+
+    Args:
+        worker (callable): The module-level function building one image from a job.
+        jobs (list): The jobs of the chunk.
+
+    Returns:
+        int: The number of images built.
+    """
+    for job in jobs:
+        worker(job)
+    get_writer().flush()
+    return len(jobs)
+
+
+def run_jobs(worker, jobs, workers=1, desc="Processing images", chunk_size=8):
+    """
+    Run composite jobs serially or spread over a process pool.
+
+    Every job carries its own seed or positions, so the saved images are byte-identical
+    whatever the number of workers. The jobs are run in chunks: the images of a chunk are
+    written behind while the next one is built, and each chunk is flushed before it is reported done.
+
+    Args:
+        worker (callable): The module-level function building one image from a job.
+        jobs (list): The jobs.
+        workers (int): The number of worker processes, 1 runs in the current process.
+        desc (str): The progress bar description.
+        chunk_size (int): The number of jobs per chunk.
+    """
+    chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+    with tqdm(total=len(jobs), desc=desc) as progress:
+        if workers <= 1:
+            for chunk in chunks:
+                progress.update(run_chunk(worker, chunk))
+            return
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for done in executor.map(run_chunk, [worker] * len(chunks), chunks):
+                progress.update(done)
+
+
+class RandomSpeciesStrategy:
+    """
+    Random synthesis mode: randomly shuffle all images and paste them onto the background image
+    until no more positions are available, then start a new background image.
+
+    With placement='pack' the positions come from a MaxRects bin packer instead of random tries:
+    every canvas takes the shuffled specimens that still fit, with a minimum gap between them,
+    until it reaches the fill target or pack_misses specimens in a row did not fit, and the
+    specimens that did not fit go first onto the next canvas. This gives fewer, denser images.
+    """
+    level = 'species'
+    worker = staticmethod(synthesize_placed_image)
+
+    def __init__(self, seed=1080, shuffle_seed=4399, placement='random', gap=10, fill_target=1.0, pack_misses=100):
+        """
+        Args:
+            seed (int): The global seed the seed of each synthesized image is derived from.
+            shuffle_seed (int): The seed shuffling the source images.
+            placement (str): 'random' for the random tries, 'pack' for the bin packer.
+            gap (int): The minimum gap in pixels between two packed boxes.
+            fill_target (float): The box area over canvas area at which a packed canvas is saved.
+            pack_misses (int): The number of specimens in a row that did not fit after which a
+                packed canvas is saved.
+        """
+        self.seed = seed
+        self.shuffle_seed = shuffle_seed
+        self.placement = placement
+        self.gap = gap
+        self.fill_target = fill_target
+        self.pack_misses = pack_misses
+
+    def label(self, jpg, catalog):
+        """
+        Get the label of a pasted specimen: its own species label.
+        """
+        return catalog.species(jpg)
+
+    def plan(self, catalog, library, background_size):
+        """
+        Choose the positions of all specimens, only the annotations are needed for that.
+
+        Args:
+            catalog (Catalog): The catalog of the dataset.
+            library (CropLibrary): The crop library.
+            background_size (tuple): The size of the background image (w, h).
+
+        Returns:
+            list: One dataset dict with name, jobs (picture_id and placements) and sources.
+        """
+        # Collect all JPG files in the species folder and randomly shuffle them
+        jpg_files = catalog.sources('species')
+        random.Random(self.shuffle_seed).shuffle(jpg_files)
+        if self.placement == 'pack':
+            return [{'name': '', 'jobs': self.pack(jpg_files, library, background_size), 'sources': jpg_files}]
+
+        jobs = []
+        placements = []
+        new_picture_id = 0
+        rng = random.Random(derive_seed(self.seed, self.level, 0, new_picture_id))
+
+        # Store the positions of already pasted annotation boxes
+        occupied_positions = OccupiedPositions()
+
+        for image_path in tqdm(jpg_files, desc="Placing specimens"):
+            size = library.crop_size(image_path)
+            if size[0] > background_size[0] or size[1] > background_size[1]:
+                raise ValueError(f"The crop of {image_path} ({size[0]}x{size[1]}) is larger than the background "
+                                 f"({background_size[0]}x{background_size[1]})")
+
+            with instrument.timer('placement'):
+                new_position = find_position(rng, background_size, size, occupied_positions)
+            if new_position is None:
+                # No more positions are available, save the current image and start a new one
+                instrument.count('canvases_full')
+                jobs.append({'picture_id': new_picture_id, 'placements': placements})
+                placements = []
+                new_picture_id += 1
+                rng = random.Random(derive_seed(self.seed, self.level, 0, new_picture_id))
+                occupied_positions.clear()
+                with instrument.timer('placement'):
+                    new_position = find_position(rng, background_size, size, occupied_positions)
+                if new_position is None:
+                    raise ValueError(f"No position found for the crop of {image_path} ({size[0]}x{size[1]}) "
+                                     f"on an empty background")
+
+            occupied_positions.append((new_position, size))
+            placements.append((image_path, new_position))
+
+        # Save the final image
+        jobs.append({'picture_id': new_picture_id, 'placements': placements})
+        return [{'name': '', 'jobs': jobs, 'sources': jpg_files}]
+
+    def pack(self, jpg_files, library, background_size):
+        """
+        Choose the positions of all specimens with the bin packer, canvas after canvas.
+
+        Args:
+            jpg_files (list): The shuffled source images.
+            library (CropLibrary): The crop library.
+            background_size (tuple): The size of the background image (w, h).
+
+        Returns:
+            list: The jobs, picture_id and placements.
+        """
+        jobs = []
+        packer = MaxRectsPacker(background_size, self.gap)
+        remaining = jpg_files
+        with tqdm(total=len(jpg_files), desc="Packing specimens") as progress:
+            while remaining:
+                picture_id = len(jobs)
+                rng = random.Random(derive_seed(self.seed, self.level, 0, picture_id))
+                packer.clear()
+                placements = []
+                deferred = []
+                misses = 0
+                for image_path in remaining:
+                    if packer.fill_ratio >= self.fill_target or misses >= self.pack_misses:
+                        deferred.append(image_path)
+                        continue
+                    size = library.crop_size(image_path)
+                    with instrument.timer('placement'):
+                        new_position = packer.insert(size, rng)
+                    if new_position is None:
+                        if not placements:
+                            raise RuntimeError(f"{image_path} ({size[0]}x{size[1]}) does not fit on the background")
+                        instrument.count('placement_failures')
+                        deferred.append(image_path)
+                        misses += 1
+                        continue
+                    misses = 0
+                    placements.append((image_path, new_position))
+
+                if misses >= self.pack_misses:
+                    instrument.count('canvases_full')
+                jobs.append({'picture_id': picture_id, 'placements': placements})
+                progress.update(len(placements))
+                remaining = deferred
+        return jobs
+
+
+class DesignFamilyStrategy:
+    """
+    Design synthesis mode for the families community datasets: for each gradient, select that many
+    family folders and paste one image of each selected family onto every background image.
+    """
+    level = 'family'
+    worker = staticmethod(synthesize_design_image)
+
+    def __init__(self, seed=4399, gradients=range(2, 7), images_per_dataset=226):
+        """
+        Args:
+            seed (int): The seed selecting the images and deriving the seed of each synthesized image.
+            gradients (iterable): The numbers of families per synthesized image, one dataset each.
+            images_per_dataset (int): The number of synthesized images per dataset.
+        """
+        self.seed = seed
+        self.gradients = gradients
+        self.images_per_dataset = images_per_dataset
+        self.relabel = self.level
+
+    def label(self, jpg, catalog):
+        """
+        Get the label of a pasted specimen, see composite_label(), or its species label without relabel.
+        """
+        return composite_label(jpg, self.relabel) if self.relabel else catalog.species(jpg)
+
+    def select(self, rng, catalog):
+        """
+        Select the images of each synthesized image.
+
+        Args:
+            rng (random.Random): The random generator of the selection.
+            catalog (Catalog): The catalog of the dataset.
+
+        Returns:
+            list: For each dataset, the list of image lists.
+        """
+        # Get all images in each family directory
+        family_list = catalog.groups('family', 1)
+
+        dataset = []
+        for num in self.gradients:
+            tmp_family_lists = [list(family) for family in family_list]
+            # Randomly select x sublists
+            selected_families = rng.sample(tmp_family_lists, num)
+
+            # Randomly select and remove one element from each list as the image to be synthesized
+            jpg_lists = []
+            for _ in range(self.images_per_dataset):
+                jpg_list = []
+                for lst in selected_families:
+                    if lst:
+                        element = lst.pop(rng.randrange(len(lst)))
+                        jpg_list.append(element)
+                jpg_lists.append(jpg_list)
+            dataset.append(jpg_lists)
+        return dataset
+
+    def plan(self, catalog, library, background_size):
+        """
+        Select the images of every synthesized image and give each image its own seed.
+
+        Args:
+            catalog (Catalog): The catalog of the dataset.
+            library (CropLibrary): The crop library.
+            background_size (tuple): The size of the background image (w, h).
+
+        Returns:
+            list: One dataset dict with name, jobs and sources per gradient.
+        """
+        datasets = []
+        gradient = 2
+        for jpg_lists in self.select(random.Random(self.seed), catalog):
+            jobs = [{'picture_id': new_picture_id,
+                     'jpg_list': jpg_list,
+                     'seed': derive_seed(self.seed, self.level, gradient, new_picture_id),
+                     'relabel': self.relabel,
+                     'spread_edges': len(jpg_lists) > 2} for new_picture_id, jpg_list in enumerate(jpg_lists)]
+            datasets.append({'name': f'{self.level}_{gradient}_{len(jpg_lists)}', 'jobs': jobs,
+                             'sources': [jpg for jpg_list in jpg_lists for jpg in jpg_list]})
+            gradient += 1
+        return datasets
+
+
+class DesignOrderStrategy(DesignFamilyStrategy):
+    """
+    Design synthesis mode for the orders community datasets: within each family, select that many
+    order folders and paste one image of each selected order onto every background image.
+    """
+    level = 'order'
+
+    def __init__(self, seed=4396, gradients=range(2, 11), images_per_dataset=100, labels='order'):
+        """
+        Args:
+            seed (int): The seed selecting the images and deriving the seed of each synthesized image.
+            gradients (iterable): The numbers of orders per synthesized image, one dataset each.
+            images_per_dataset (int): The number of synthesized images per dataset.
+            labels (str): 'order' to label the specimens by their order directory, 'species' to keep
+                their species labels like the original order script, which computed the order label
+                on a copy of the annotation and pasted the species label.
+
+        Raises:
+            ValueError: If labels is not 'order' or 'species'.
+        """
+        super().__init__(seed, gradients, images_per_dataset)
+        if labels not in ('order', 'species'):
+            raise ValueError(f"Unknown order labels {labels!r}, expected 'order' or 'species'")
+        self.relabel = 'order' if labels == 'order' else None
+
+    def select(self, rng, catalog):
+        """
+        Select the images of each synthesized image, one dataset per family and gradient.
+        """
+        # familylists structure: familylists[ family[ order[ images ] ] ]
+        familylists = catalog.groups('family', 2)
+
+        # For each family, select num orders to create a dataset with the same family but different orders
+        dataset = []
+        for num in self.gradients:
+            tmp_familylists = [[list(order) for order in family] for family in familylists]
+            for tmp_family in tmp_familylists:
+                # Skip the family if the number of orders is less than num
+                if len(tmp_family) < num:
+                    continue
+                # Randomly select x order lists
+                selected_orders = rng.sample(tmp_family, num)
+                jpg_lists = []
+                for _ in range(self.images_per_dataset):
+                    jpg_list = []
+                    for order in selected_orders:
+                        # Randomly select and remove an image from the current order list
+                        element = order.pop(rng.randrange(len(order)))
+                        jpg_list.append(element)
+                    jpg_lists.append(jpg_list)
+                dataset.append(jpg_lists)
+        return dataset
+
+
+strategies = {
+    'species': RandomSpeciesStrategy,
+    'family': DesignFamilyStrategy,
+    'order': DesignOrderStrategy,
+}
+
+
+def composite_files(job):
+    """
+    List the files a composite job writes.
+
+    Args:
+        job (dict): The job of the image.
+
+    Returns:
+        list: The output paths.
+    """
+    picture_id = job['picture_id']
+    files = []
+    if job['output_format'] in ('labelme', 'both'):
+        files += [os.path.join(job['save_dir'], f'{picture_id}.json'),
+                  os.path.join(job['save_dir'], f'{picture_id}.jpg')]
+    if job['output_format'] in ('yolo', 'both'):
+        files += [os.path.join(job['yolo_dir'], 'pool', 'images', f'{picture_id}.jpg'),
+                  os.path.join(job['yolo_dir'], 'pool', 'labels', f'{picture_id}.txt')]
+    return files
+
+
+def composite_fingerprint(job, library, background_hashes):
+    """
+    Fingerprint everything a composite job depends on: its sources' content hashes, its seed or
+    positions, the backgrounds and the output settings.
+
+    Args:
+        job (dict): The job of the image.
+        library (CropLibrary): The crop library.
+        background_hashes (list): The content hashes of the background bank.
+
+    Returns:
+        str: The SHA-1 hex digest.
+    """
+    sources = [jpg for jpg, _ in job['placements']] if 'placements' in job else job['jpg_list']
+    key = {name: value for name, value in job.items() if name not in ('background_paths', 'library_path')}
+    key['source_hashes'] = [library.entries[library.key(jpg)]['hash'] for jpg in sources]
+    key['background_hashes'] = background_hashes
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def select_stale_jobs(jobs, library, manifest_path, force=False):
+    """
+    Keep the jobs whose inputs changed since the last run, and delete the outputs of the images
+    that are no longer synthesized.
+
+    Args:
+        jobs (list): All jobs of the run.
+        library (CropLibrary): The crop library.
+        manifest_path (str): The JSON file recording the fingerprint and files of every image.
+        force (bool): Whether to rebuild every image.
+
+    Returns:
+        tuple: The jobs to run and the new manifest, to save once they are done.
+    """
+    old_manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            old_manifest = json.load(f)
+
+    background_hashes = {}
+    manifest = {}
+    stale_jobs = []
+    for job in jobs:
+        for background_path in job['background_paths']:
+            if background_path not in background_hashes:
+                with open(background_path, 'rb') as f:
+                    background_hashes[background_path] = hashlib.sha1(f.read()).hexdigest()
+        fingerprint = composite_fingerprint(job, library, [background_hashes[path] for path in job['background_paths']])
+        files = composite_files(job)
+        manifest[files[0]] = {'fingerprint': fingerprint, 'files': files}
+
+        old_entry = old_manifest.get(files[0])
+        if force or not old_entry or old_entry['fingerprint'] != fingerprint \
+                or not all(os.path.exists(file) for file in files):
+            stale_jobs.append(job)
+
+    # Delete the outputs of the images that are not synthesized anymore
+    for key, old_entry in old_manifest.items():
+        if key not in manifest:
+            for file in old_entry['files']:
+                if os.path.exists(file):
+                    os.remove(file)
+    return stale_jobs, manifest
+
+
+def synthesize(strategy, workers=1, output_format='labelme', names_path=None, dataset_path='../init_dataset',
+               library_path='../crop_library', background_paths=('../4640_3480.jpg',),
+               labelme_path='../labelme_output_images', yolo_path='../yolo_output_images', force=False,
+               catalog_path='../catalog.sqlite'):
+    """
+    Synthesize the community datasets of a sampling strategy.
+
+    The run is incremental: only the images whose sources, seed, positions, background or output
+    settings changed since the last run are synthesized again.
+
+    Args:
+        strategy: A RandomSpeciesStrategy, DesignFamilyStrategy or DesignOrderStrategy.
+        workers (int): The number of worker processes.
+        output_format (str): 'labelme' to write LabelMe JSON files, 'yolo' to write YOLO label files and
+            a fold manifest, 'both' for both.
+        names_path (str): A dataset YAML file whose names give the YOLO class ids, None to sort the labels.
+        dataset_path (str): The annotated dataset directory (init_dataset).
+        library_path (str): The crop library directory, updated before synthesizing.
+        background_paths (tuple): The background bank, image n uses background n modulo the bank size.
+        labelme_path (str): The LabelMe output directory, the datasets go to its <level> folder.
+        yolo_path (str): The YOLO output directory, the datasets go to its <level>_stream folder.
+        force (bool): Whether to synthesize every image again.
+        catalog_path (str): The catalog of the dataset, updated before synthesizing.
+    """
+    # Index the dataset once, then decode each new annotated specimen once into the crop library,
+    # the synthesized images are pasted from it
+    catalog = build_catalog(dataset_path, catalog_path, workers)
+    library = build_crop_library(dataset_path, library_path, workers, catalog)
+    background_size = (image_width, image_height)
+
+    save_root = os.path.join(labelme_path, strategy.level)
+    yolo_root = os.path.join(yolo_path, f'{strategy.level}_stream')
+
+    jobs = []
+    yolo_datasets = []
+    for dataset in strategy.plan(catalog, library, background_size):
+        save_dir = os.path.join(save_root, dataset['name'])
+        if output_format != 'yolo':
+            os.makedirs(save_dir, exist_ok=True)
+
+        # Write YOLO labels in the same pass, with the class ids of this dataset
+        yolo_dir = os.path.join(yolo_root, dataset['name'])
+        class_ids = None
+        if output_format != 'labelme':
+            prepare_yolo_dir(yolo_dir)
+            class_ids = class_ids_of([strategy.label(jpg, catalog) for jpg in dataset['sources']], names_path)
+            yolo_datasets.append((yolo_dir, [job['picture_id'] for job in dataset['jobs']], class_ids))
+
+        for job in dataset['jobs']:
+            jobs.append(dict(job, background_paths=tuple(background_paths), library_path=library_path,
+                             save_dir=save_dir, yolo_dir=yolo_dir, output_format=output_format, class_ids=class_ids))
+
+    # Synthesize the images whose inputs changed
+    os.makedirs(labelme_path, exist_ok=True)
+    manifest_path = os.path.join(labelme_path, f'{strategy.level}_composites.json')
+    stale_jobs, manifest = select_stale_jobs(jobs, library, manifest_path, force)
+    print(f"{len(jobs) - len(stale_jobs)} of {len(jobs)} {strategy.level} images are up to date")
+    run_jobs(strategy.worker, stale_jobs, workers, desc=f"Processing the {strategy.level} dataset images")
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+    for yolo_dir, picture_ids, class_ids in yolo_datasets:
+        write_fold_manifest(yolo_dir, picture_ids, class_ids)
+    instrument.flush()
+
+
+def main(argv=None):
+    """
+    Command line entry point of the synthesis engine.
+
+    Args:
+        argv (list): The arguments, None to use sys.argv.
+    """
+    parser = argparse.ArgumentParser(description="Synthesize the species, families or orders community datasets.")
+    parser.add_argument('level', choices=sorted(strategies), help="Sampling strategy")
+    parser.add_argument('--seed', type=int, default=None, help="Global random seed (default: the level's seed)")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes")
+    parser.add_argument('--output-format', choices=['labelme', 'yolo', 'both'], default='labelme',
+                        help="Write LabelMe JSON files, YOLO label files with a fold manifest, or both")
+    parser.add_argument('--names', default=None, help="Dataset YAML file whose names give the YOLO class ids")
+    parser.add_argument('--dataset', default='../init_dataset', help="Annotated dataset directory")
+    parser.add_argument('--library', default='../crop_library', help="Crop library directory")
+    parser.add_argument('--catalog', default='../catalog.sqlite', help="Catalog file")
+    parser.add_argument('--background', nargs='+', default=['../4640_3480.jpg'],
+                        help="Background images, used in turn by the synthesized images")
+    parser.add_argument('--labelme-output', default='../labelme_output_images', help="LabelMe output directory")
+    parser.add_argument('--yolo-output', default='../yolo_output_images', help="YOLO output directory")
+    parser.add_argument('--force', action='store_true', help="Synthesize every image again")
+    parser.add_argument('--metrics', default=None, help="Append timers and counters to this JSON-lines file")
+    parser.add_argument('--placement', choices=['random', 'pack'], default='random',
+                        help="Species level: place the specimens by random tries or with the bin packer")
+    parser.add_argument('--gap', type=int, default=10, help="Species level with --placement pack: "
+                                                             "minimum gap between two specimens in pixels")
+    parser.add_argument('--fill-target', type=float, default=1.0, help="Species level with --placement pack: "
+                                                                        "box area over canvas area of a full image")
+    parser.add_argument('--order-labels', choices=['order', 'species'], default='order',
+                        help="Order level: label the specimens by their order directory, or keep their species "
+                             "labels like the original order script")
+    args = parser.parse_args(argv)
+
+    if args.metrics:
+        instrument.enable(args.metrics)
+
+    options = {} if args.seed is None else {'seed': args.seed}
+    if args.level == 'species':
+        options.update(placement=args.placement, gap=args.gap, fill_target=args.fill_target)
+    elif args.placement != 'random':
+        parser.error("--placement pack is only available for the species level")
+    if args.level == 'order':
+        options.update(labels=args.order_labels)
+    elif args.order_labels != 'order':
+        parser.error("--order-labels is only available for the order level")
+    strategy = strategies[args.level](**options)
+    synthesize(strategy, workers=args.workers, output_format=args.output_format, names_path=args.names,
+               dataset_path=args.dataset, library_path=args.library, background_paths=args.background,
+               labelme_path=args.labelme_output, yolo_path=args.yolo_output, force=args.force,
+               catalog_path=args.catalog)
+
+
+if __name__ == "__main__":
+    main()
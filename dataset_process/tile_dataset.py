@@ -0,0 +1,169 @@
+import os
+import json
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+from tqdm import tqdm
+
+from labelme2yolo_detect import convert_dataset, list_labelme_files
+from placement import tile_origins
+
+
+def group_specimens(shapes):
+    """
+    Group the shapes of a community image by specimen: each rectangle with the points after it.
+
+    Args:
+        shapes (list): The LabelMe shapes, every rectangle followed by its points as the synthesis
+            scripts write them.
+
+    Returns:
+        list: (rectangle, points) pairs.
+    """
+    specimens = []
+    for shape in shapes:
+        if shape['shape_type'] == 'rectangle':
+            specimens.append((shape, []))
+        elif shape['shape_type'] == 'point' and specimens:
+            specimens[-1][1].append(shape)
+    return specimens
+
+
+def tile_shapes(specimens, origin, tile_size, min_visibility):
+    """
+    Clip the specimens of a community image to a tile.
+
+    A rectangle is kept when at least min_visibility of its area is inside the tile, clipped to the
+    tile. Its points inside the clipped rectangle are kept, the others are dropped with it.
+
+    Args:
+        specimens (list): (rectangle, points) pairs, see group_specimens().
+        origin (tuple): The top-left corner (x, y) of the tile.
+        tile_size (int): The tile size.
+        min_visibility (float): The minimum visible fraction of a rectangle.
+
+    Returns:
+        list: The LabelMe shapes of the tile, in tile coordinates.
+    """
+    x0, y0 = origin
+    shapes = []
+    for rectangle, points in specimens:
+        (x1, y1), (x2, y2) = rectangle['points']
+        cx1, cy1 = max(x1, x0), max(y1, y0)
+        cx2, cy2 = min(x2, x0 + tile_size), min(y2, y0 + tile_size)
+        area = (x2 - x1) * (y2 - y1)
+        if cx2 <= cx1 or cy2 <= cy1 or area <= 0 or (cx2 - cx1) * (cy2 - cy1) / area < min_visibility:
+            continue
+        shapes.append(dict(rectangle, points=[[cx1 - x0, cy1 - y0], [cx2 - x0, cy2 - y0]]))
+        for point in points:
+            px, py = point['points'][0]
+            if cx1 <= px <= cx2 and cy1 <= py <= cy2:
+                shapes.append(dict(point, points=[[px - x0, py - y0]]))
+    return shapes
+
+
+def tile_image(args):
+    """
+    Cut a community image and its LabelMe JSON file into tiles.
+
+    Args:
+        args (tuple): The file without extension, the output directory, the tile size, the overlap,
+            the minimum visibility and whether to keep the tiles without specimens.
+
+    Returns:
+        int: The number of tiles written.
+    """
+    file, output_path, tile_size, overlap, min_visibility, keep_empty = args
+    with open(file + '.json', 'r') as f:
+        data = json.load(f)
+    specimens = group_specimens(data['shapes'])
+    image = Image.open(file + '.jpg')
+    image.load()
+
+    name = os.path.basename(file)
+    count = 0
+    for y in tile_origins(data['imageHeight'], tile_size, overlap):
+        for x in tile_origins(data['imageWidth'], tile_size, overlap):
+            shapes = tile_shapes(specimens, (x, y), tile_size, min_visibility)
+            if not shapes and not keep_empty:
+                continue
+            tile_name = f'{name}_{x}_{y}'
+            tile = image.crop((x, y, x + tile_size, y + tile_size))
+            tile.save(os.path.join(output_path, f'{tile_name}.jpg'), quality=95)
+            tile_data = dict(data, shapes=shapes, imagePath=f'{tile_name}.jpg',
+                             imageWidth=tile.width, imageHeight=tile.height)
+            with open(os.path.join(output_path, f'{tile_name}.json'), 'w') as f:
+                json.dump(tile_data, f)
+            count += 1
+    return count
+
+
+def tile_dataset(dataset_path, output_path, tile_size=1024, overlap=0.2, min_visibility=0.5, keep_empty=False,
+                 workers=1):
+    """
+    Cut the community images of a LabelMe dataset into overlapping training tiles.
+
+    The tiles are written as a LabelMe dataset named <image>_<x>_<y>, so labelme2yolo_detect.py
+    converts them to the k-fold layout like full images.
+
+    Args:
+        dataset_path (str): The directory of the LabelMe JSON and JPG files.
+        output_path (str): The output directory of the tiles.
+        tile_size (int): The tile size, the training imgsz.
+        overlap (float): The overlap between neighboring tiles, as a fraction of the tile size.
+        min_visibility (float): The minimum visible fraction of a rectangle to keep it in a tile.
+        keep_empty (bool): Whether to keep the tiles without specimens as background images.
+        workers (int): The number of worker processes.
+
+    Returns:
+        int: The number of tiles.
+    """
+    # Recursively delete all files and folders in the target output folder
+    shutil.rmtree(output_path, ignore_errors=True)
+    os.makedirs(output_path)
+
+    jobs = [(file, output_path, tile_size, overlap, min_visibility, keep_empty)
+            for file in list_labelme_files(dataset_path)]
+    if workers <= 1:
+        results = map(tile_image, jobs)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(tile_image, jobs)
+    count = sum(tqdm(results, total=len(jobs), desc=f"Tiling {dataset_path}"))
+    if workers > 1:
+        executor.shutdown()
+    return count
+
+
+def source_image_of(tile_name):
+    """
+    Get the community image a tile was cut from, so all its tiles land in the same fold.
+    """
+    return tile_name.rsplit('_', 2)[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cut community images into training tiles and build their k-fold YOLO datasets.")
+    parser.add_argument('--dataset', default='../labelme_output_images/species', help="LabelMe dataset directory")
+    parser.add_argument('--output', default='../labelme_output_images/species_tiles', help="Tile output directory")
+    parser.add_argument('--yolo-output', default='../yolo_output_images/species_tiles',
+                        help="k-fold YOLO output directory, empty to skip the conversion")
+    parser.add_argument('--tile-size', type=int, default=1024, help="Tile size")
+    parser.add_argument('--overlap', type=float, default=0.2, help="Overlap between neighboring tiles")
+    parser.add_argument('--min-visibility', type=float, default=0.5,
+                        help="Minimum visible fraction of a box to keep it in a tile")
+    parser.add_argument('--keep-empty', action='store_true', help="Keep the tiles without specimens")
+    parser.add_argument('--layout', choices=['copy', 'hardlink', 'symlink', 'list'], default='hardlink',
+                        help="Fold layout of the YOLO datasets")
+    parser.add_argument('--names', default=None, help="Dataset YAML file whose names give the class ids")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes")
+    args = parser.parse_args()
+
+    count = tile_dataset(args.dataset, args.output, args.tile_size, args.overlap, args.min_visibility,
+                         args.keep_empty, args.workers)
+    print(f"{count} tiles in {args.output}")
+    if args.yolo_output:
+        convert_dataset(args.output, args.yolo_output, layout=args.layout, names_path=args.names,
+                        group_of=source_image_of, groups_path=args.dataset)
@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+from tqdm import tqdm
+from ultralytics import YOLO
+
+from predict import TableWriter, batched, iter_images, prefetch_images
+from tiled_val import predict_tiled
+
+stages = ['detect', 'crop', 'classify']
+result_columns = ['image', 'detect_species', 'detect_conf', 'species', 'classify_conf', 'x1', 'y1', 'x2', 'y2']
+
+
+def crop_boxes(image, boxes):
+    """
+    Crop the detected boxes out of a decoded image, without copying the pixels.
+
+    Args:
+        image (numpy.ndarray): The BGR image.
+        boxes (numpy.ndarray): The xyxy boxes (n, 4) in image coordinates.
+
+    Returns:
+        list: The (h, w, 3) crops, views into the image.
+    """
+    height, width = image.shape[:2]
+    crops = []
+    for x1, y1, x2, y2 in boxes.tolist():
+        x1, y1 = min(max(int(x1), 0), width - 1), min(max(int(y1), 0), height - 1)
+        x2, y2 = max(min(int(round(x2)), width), x1 + 1), max(min(int(round(y2)), height), y1 + 1)
+        crops.append(image[y1:y2, x1:x2])
+    return crops
+
+
+def detect_classify(detector, classifier, images, imgsz=2560, cls_imgsz=224, conf=0.25, iou=0.6, max_det=30,
+                    cls_batch=32, device=None, tile_size=None, overlap=0.2):
+    """
+    Detect the specimens of decoded images, crop them in memory and classify the crops.
+
+    Args:
+        detector (YOLO): The detection model.
+        classifier (YOLO): The classification model, e.g. a yolov8m-cls trained by cls_train.py.
+        images (list): The BGR images.
+        imgsz (int): The detection image size, ignored with tile_size.
+        cls_imgsz (int): The classification image size.
+        conf (float): The detection confidence threshold.
+        iou (float): The detection NMS IoU threshold.
+        max_det (int): The maximum number of detections per image.
+        cls_batch (int): The number of crops per forward pass of the classifier.
+        device: The device, None for the Ultralytics default.
+        tile_size (int): Detect on overlapping tiles of this size at full resolution, or None.
+        overlap (float): The overlap between neighboring tiles.
+
+    Returns:
+        tuple: For every image a dict of boxes, detect_classes, detect_confs, classes and classify_confs
+            (NumPy arrays, class ids of the detector and of the classifier), and the seconds of each stage.
+    """
+    times = dict.fromkeys(stages, 0.0)
+
+    start = time.perf_counter()
+    if tile_size:
+        detections = [predict_tiled(detector, image, tile_size, overlap, conf=conf, iou=iou, max_det=max_det,
+                                    device=device)
+                      for image in images]
+    else:
+        detections = []
+        for prediction in detector.predict(images, imgsz=imgsz, conf=conf, iou=iou, max_det=max_det,
+                                           device=device, verbose=False):
+            boxes = prediction.boxes.cpu().numpy()
+            detections.append((boxes.xyxy, boxes.conf, boxes.cls))
+    times['detect'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    crops = [crop for image, (boxes, _, _) in zip(images, detections) for crop in crop_boxes(image, boxes)]
+    times['crop'] = time.perf_counter() - start
+
+    # The crops of all images go through the classifier together, in batches of cls_batch
+    start = time.perf_counter()
+    classes, confs = [], []
+    for chunk in batched(crops, cls_batch):
+        for prediction in classifier.predict(chunk, imgsz=cls_imgsz, device=device, verbose=False):
+            classes.append(prediction.probs.top1)
+            confs.append(float(prediction.probs.top1conf))
+    times['classify'] = time.perf_counter() - start
+
+    results = []
+    offset = 0
+    for boxes, detect_confs, detect_classes in detections:
+        n = len(boxes)
+        results.append({'boxes': boxes, 'detect_classes': detect_classes, 'detect_confs': detect_confs,
+                        'classes': np.array(classes[offset:offset + n], dtype=int),
+                        'classify_confs': np.array(confs[offset:offset + n])})
+        offset += n
+    return results, times
+
+
+def latency_report(latencies, images, crops, classify_seconds):
+    """
+    Summarize the stage latencies of a run.
+
+    Args:
+        latencies (dict): For every stage and 'total', the seconds per image of every batch.
+        images (int): The number of images.
+        crops (int): The number of classified crops.
+        classify_seconds (float): The time spent classifying them.
+
+    Returns:
+        dict: The mean and p95 ms per image of every stage and end to end, and the crops per second
+            of the classifier.
+    """
+    report = {'images': images, 'crops': crops}
+    for stage, values in latencies.items():
+        report[f'{stage}_ms'] = float(np.mean(values) * 1000) if values else 0.0
+        report[f'{stage}_p95_ms'] = float(np.percentile(values, 95) * 1000) if values else 0.0
+    report['crops_per_second'] = crops / classify_seconds if classify_seconds else 0.0
+    return report
+
+
+def detect_classify_directory(detector_weights, classifier_weights, source, output_path, batch=4, cls_batch=32,
+                              threads=2, prefetch=8, output_format='csv', **kwargs):
+    """
+    Run the detect -> crop -> classify pipeline over a directory tree of images and write one row per
+    specimen with the species of both models and both confidences.
+
+    Args:
+        detector_weights (str): The detection model weights.
+        classifier_weights (str): The classification model weights.
+        source (str): The image directory.
+        output_path (str): The output directory of results.csv (or .parquet) and latency.json.
+        batch (int): The number of images per detection forward pass.
+        cls_batch (int): The number of crops per classification forward pass.
+        threads (int): The number of decoding threads.
+        prefetch (int): The maximum number of decoded images waiting for the models.
+        output_format (str): 'csv' or 'parquet'.
+        **kwargs: The other parameters of detect_classify().
+
+    Returns:
+        dict: The latency report, see latency_report().
+    """
+    os.makedirs(output_path, exist_ok=True)
+    detector, classifier = YOLO(detector_weights), YOLO(classifier_weights)
+    writer = TableWriter(os.path.join(output_path, 'results'), result_columns, output_format)
+    latencies = {stage: [] for stage in stages + ['total']}
+    images = crops = 0
+    classify_seconds = 0.0
+    try:
+        decoded = prefetch_images(iter_images(source), threads, prefetch)
+        with tqdm(desc=f"Detecting and classifying {source}", unit='image') as progress:
+            for chunk in batched(((path, image) for path, image in decoded if image is not None), batch):
+                results, times = detect_classify(detector, classifier, [image for _, image in chunk],
+                                                 cls_batch=cls_batch, **kwargs)
+                for (path, _), result in zip(chunk, results):
+                    writer.write([[os.path.relpath(path, source), detector.names[int(detect_cls)],
+                                   round(float(detect_conf), 4), classifier.names[int(cls)], round(float(cls_conf), 4),
+                                   *[round(value, 1) for value in box]]
+                                  for box, detect_cls, detect_conf, cls, cls_conf in
+                                  zip(result['boxes'].tolist(), result['detect_classes'], result['detect_confs'],
+                                      result['classes'], result['classify_confs'])])
+                    crops += len(result['boxes'])
+                for stage in stages:
+                    latencies[stage].append(times[stage] / len(chunk))
+                latencies['total'].append(sum(times.values()) / len(chunk))
+                classify_seconds += times['classify']
+                images += len(chunk)
+                progress.update(len(chunk))
+    finally:
+        writer.close()
+
+    report = latency_report(latencies, images, crops, classify_seconds)
+    with open(os.path.join(output_path, 'latency.json'), 'w') as f:
+        json.dump(report, f, indent=1)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Detect the Collembola of a directory of images and classify "
+                                                 "every detection with the crop classifier.")
+    parser.add_argument('--detector', required=True, help="Detection weights, e.g. runs/detect/.../weights/best.pt")
+    parser.add_argument('--classifier', default='runs/cls/crop_224x224/train4/weights/best.pt',
+                        help="Classification weights")
+    parser.add_argument('--source', required=True, help="Image directory, searched recursively")
+    parser.add_argument('--output', default='runs/detect_classify', help="Output directory")
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv', help="Output format")
+    parser.add_argument('--batch', type=int, default=4, help="Images per detection forward pass")
+    parser.add_argument('--cls-batch', type=int, default=32, help="Crops per classification forward pass")
+    parser.add_argument('--imgsz', type=int, default=2560, help="Detection image size")
+    parser.add_argument('--cls-imgsz', type=int, default=224, help="Classification image size")
+    parser.add_argument('--conf', type=float, default=0.25, help="Detection confidence threshold")
+    parser.add_argument('--device', default=None, help="Device, e.g. 0 or cpu")
+    parser.add_argument('--tile-size', type=int, default=None, help="Detect on full-resolution tiles of this size")
+    args = parser.parse_args()
+
+    report = detect_classify_directory(args.detector, args.classifier, args.source, args.output, args.batch,
+                                       args.cls_batch, output_format=args.format, imgsz=args.imgsz,
+                                       cls_imgsz=args.cls_imgsz, conf=args.conf, device=args.device,
+                                       tile_size=args.tile_size)
+    print(json.dumps(report, indent=1))
@@ -1,56 +1,333 @@
 import os
+import json
 import time
+import tempfile
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import torch
-from ultralytics import YOLO
 import yaml
-import shutil
+from ultralytics import YOLO
+from ultralytics.data import YOLODataset
+from ultralytics.models.yolo.detect import DetectionTrainer
 
-if __name__ == '__main__':
-    # List of model names to train
-    model_list = ['yolov8n', 'yolov8s', 'yolov8m']
+from dataset_process.pixel_cache import PixelCache, build_pixel_cache
+from dataset_process.resize_dataset import fold_data, resize_fold, split_images
+from eval_grid import experiment_of, level_datasets, levels, limit_threads
+
+# The run directory of a model on a fold, as runs/detect/<model>/<experiment><k>/<run_name>
+run_name = '2batch50epochs2560imgsz2dims50close_mosaic4points'
+
+# The training parameters of every job, the device is replaced by the GPU of the worker slot, see init_worker()
+train_params = {'save_period': 10, 'batch': 2, 'imgsz': 2560, 'close_mosaic': 50, 'seed': 4399, 'epochs': 50,
+                'device': 0, 'pretrained': True, 'optimizer': 'auto', 'scale': 0.0, 'dropout': 0.2, 'workers': 1}
+
+# The GPU of the worker process, set by init_worker()
+worker_device = None
+
+
+class PixelCacheDataset(YOLODataset):
+    """
+    A YOLODataset reading the decoded images from the pixel cache, see dataset_process/pixel_cache.py.
+    The images the cache does not have are decoded as usual.
+    """
+
+    pixel_cache = None
+
+    def load_image(self, i, rect_mode=True):
+        if self.ims[i] is None and rect_mode and self.pixel_cache is not None:
+            pixels, source_shape = self.pixel_cache.get(self.im_files[i], self.imgsz)
+            if pixels is not None:
+                # A copy, the augmentations modify the image in place
+                im = pixels.copy()
+                if self.augment:
+                    # The bookkeeping of BaseDataset.load_image(): Mosaic draws its other images from the buffer
+                    self.ims[i], self.im_hw0[i], self.im_hw[i] = im, source_shape, im.shape[:2]
+                    self.buffer.append(i)
+                    if 1 < len(self.buffer) >= self.max_buffer_length:
+                        j = self.buffer.pop(0)
+                        if self.cache != 'ram':
+                            self.ims[j], self.im_hw0[j], self.im_hw[j] = None, None, None
+                return im, source_shape, im.shape[:2]
+        return super().load_image(i, rect_mode)
+
+
+class PixelCacheTrainer(DetectionTrainer):
+    """
+    A DetectionTrainer whose train and val datasets read from the pixel cache in cache_dir.
+    """
+
+    cache_dir = None
+
+    def build_dataset(self, img_path, mode='train', batch=None):
+        dataset = super().build_dataset(img_path, mode, batch)
+        if self.cache_dir:
+            # Keep the dataset Ultralytics built with all its arguments, only the image loading changes
+            dataset.__class__ = PixelCacheDataset
+            dataset.pixel_cache = PixelCache(self.cache_dir)
+        return dataset
+
+
+class TrainingState:
+    """
+    The state of every training job between runs: pending, running, done or failed, with the
+    parameters it was trained with, so an interrupted scheduler knows what to skip and what to resume.
+    """
+
+    def __init__(self, state_path):
+        """
+        Args:
+            state_path (str): The JSON file of the state.
+        """
+        self.state_path = state_path
+        self.jobs = {}
+        if os.path.exists(state_path):
+            with open(state_path, 'r') as f:
+                self.jobs = json.load(f)
+
+    def update(self, job_id, **values):
+        self.jobs[job_id] = dict(self.jobs.get(job_id, {}), updated=time.time(), **values)
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+        # Write then rename, so a killed scheduler never leaves a truncated state file
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(self.jobs, f, indent=1)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+
+def finished_epochs(run_dir):
+    """
+    Get the number of epochs a run finished, from its results.csv.
+    """
+    results_path = os.path.join(run_dir, 'results.csv')
+    if not os.path.exists(results_path):
+        return 0
+    with open(results_path, 'r') as f:
+        return max(sum(1 for line in f if line.strip()) - 1, 0)
+
+
+def plan_jobs(models, folds, levels, params, workers=1, pixel_cache_dir=None):
+    """
+    Build the training jobs of the grid models x levels x datasets x folds.
+
+    The folds are pre-resized here, once, so the parallel jobs only read the cache. With a pixel
+    cache, their train and val images are also decoded here, once for all folds and models.
+
+    Args:
+        models (list): The model names, e.g. ['yolov8n', 'yolov8s', 'yolov8m'].
+        folds (list): The folds to train.
+        levels (list): The levels: species, family and/or order.
+        params (dict): The training parameters, imgsz gives the resized cache.
+        workers (int): The number of worker processes resizing and decoding the folds.
+        pixel_cache_dir (str): The pixel cache directory, or None to decode the images in every epoch.
 
-    for model_name in model_list:
-        for k in range(10):
-            # Skip the first two folds for yolov8m
-            if model_name == 'yolov8m' and k < 2:
+    Returns:
+        list: One job dict per model, level, dataset and fold.
+    """
+    jobs = []
+    for level in levels:
+        for dataset_dir, _ in level_datasets(level):
+            experiment = experiment_of(level, dataset_dir)
+            for k in folds:
+                # Each fold gets a YAML file of its own with the class names its conversion wrote, the
+                # fold's data.yaml is never modified, and the resized data.yaml the runs train on stays
+                # in the cache for resuming
+                data = fold_data(dataset_dir, k)
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    fold_yaml_path = os.path.join(tmp_dir, 'data.yaml')
+                    with open(fold_yaml_path, 'w') as f:
+                        yaml.dump(data, f, allow_unicode=True)
+                    train_yaml_path = resize_fold(fold_yaml_path, params['imgsz'], policy='fit', workers=workers)
+                if pixel_cache_dir:
+                    with open(train_yaml_path, 'r') as f:
+                        train_data = yaml.safe_load(f)
+                    build_pixel_cache([image for split in ['train', 'val']
+                                       for image in split_images(train_data, split)],
+                                      pixel_cache_dir, params['imgsz'], workers)
+
+                for model in models:
+                    project = os.path.join('runs/detect', model, f'{experiment}{k}')
+                    jobs.append({'id': f'{model}/{level}/{os.path.basename(dataset_dir)}/{k}', 'model': model,
+                                 'project': project, 'run_dir': os.path.join(project, run_name),
+                                 'yaml_path': train_yaml_path, 'pixel_cache_dir': pixel_cache_dir})
+    return jobs
+
+
+def job_action(job, state, params):
+    """
+    Decide what to do with a job: 'skip' a finished run, 'resume' an interrupted one from its
+    last.pt, or 'train' it from the pretrained weights.
+
+    Runs trained before the scheduler existed have no state; they count as finished when their
+    results.csv has all the epochs. A job with a state is only finished when its last run ended
+    with the same parameters, and only resumed when its interrupted run had the same parameters.
+    """
+    record = state.jobs.get(job['id'])
+    if record is None:
+        if finished_epochs(job['run_dir']) >= params['epochs'] and \
+                os.path.exists(os.path.join(job['run_dir'], 'weights', 'best.pt')):
+            return 'skip'
+        run_params = params
+    else:
+        if record.get('status') == 'done' and record.get('params') == params:
+            return 'skip'
+        run_params = record.get('run_params', record.get('params'))
+    if run_params == params and os.path.exists(os.path.join(job['run_dir'], 'weights', 'last.pt')):
+        return 'resume'
+    return 'train'
+
+
+def set_aside(run_dir):
+    """
+    Rename the directory of an earlier run before training the job from scratch, so its results.csv
+    and weights are not mixed with those of the new run. Runs are never deleted.
+
+    Returns:
+        str: The new directory of the earlier run, or None if there was none.
+    """
+    if not os.path.exists(run_dir):
+        return None
+    old_dir = f"{run_dir}_replaced_{time.strftime('%Y%m%d%H%M%S')}"
+    os.rename(run_dir, old_dir)
+    return old_dir
+
+
+def init_worker(threads, devices, slots):
+    """
+    Process pool initializer of the training jobs: limit the CPU threads of a job and give every
+    worker slot a GPU of its own, round-robin over the devices.
+
+    Args:
+        threads (int): The number of CPU threads per job.
+        devices (list): The CUDA devices, or an empty list to train on the device of the parameters.
+        slots (multiprocessing.Value): The number of worker processes started so far, shared by the pool.
+    """
+    global worker_device
+    limit_threads(threads)
+    if devices:
+        with slots.get_lock():
+            slot = slots.value
+            slots.value += 1
+        worker_device = devices[slot % len(devices)]
+
+
+def train_job(job, action, params):
+    """
+    Train or resume a job, in its own process.
+
+    Args:
+        job (dict): The job of plan_jobs().
+        action (str): 'train' or 'resume'.
+        params (dict): The training parameters.
+
+    Returns:
+        int: The number of finished epochs.
+    """
+    PixelCacheTrainer.cache_dir = job['pixel_cache_dir']
+    # The job trains on the GPU of its worker slot, the parameters in the state keep their device
+    device = params['device'] if worker_device is None else worker_device
+    if action == 'resume':
+        # The checkpoint keeps the arguments of the run, its data.yaml and its optimizer state
+        model = YOLO(os.path.join(job['run_dir'], 'weights', 'last.pt'))
+        model.train(trainer=PixelCacheTrainer, resume=True, device=device)
+    else:
+        set_aside(job['run_dir'])
+        # exist_ok writes into the run directory instead of creating <name>2
+        model = YOLO(f"{job['model']}.pt")
+        model.train(trainer=PixelCacheTrainer, project=job['project'], name=run_name, exist_ok=True,
+                    data=job['yaml_path'], **dict(params, device=device))
+    return finished_epochs(job['run_dir'])
+
+
+def run_jobs(jobs, params, state_path='runs/detect/train_state.json', parallel=1, threads=4, force=False,
+             devices=()):
+    """
+    Run the training jobs that are not finished, `parallel` at a time, each in a new process so its
+    GPU and CPU memory is released when it ends. A failed job is recorded and the others go on.
+
+    The worker slots are spread round-robin over the devices, so `parallel` jobs on as many GPUs do
+    not all train on the first one.
+
+    Args:
+        jobs (list): The jobs of plan_jobs().
+        params (dict): The training parameters.
+        state_path (str): The JSON file of the job states.
+        parallel (int): The number of jobs trained at the same time.
+        threads (int): The number of CPU threads per job.
+        force (bool): Whether to train the finished jobs again, from the pretrained weights.
+        devices (list): The CUDA devices of the worker slots, or empty to train on the device of the params.
+
+    Returns:
+        dict: The jobs that failed, with their error.
+    """
+    state = TrainingState(state_path)
+    actions = {job['id']: 'train' if force else job_action(job, state, params) for job in jobs}
+    for job in jobs:
+        if actions[job['id']] == 'skip' and state.jobs.get(job['id'], {}).get('status') != 'done':
+            state.update(job['id'], status='done', params=params, epochs=finished_epochs(job['run_dir']))
+    pending = [job for job in jobs if actions[job['id']] != 'skip']
+    print(f"{len(jobs) - len(pending)} of {len(jobs)} jobs already trained, "
+          f"{sum(actions[job['id']] == 'resume' for job in pending)} to resume")
+
+    failed = {}
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=parallel, mp_context=context, initializer=init_worker,
+                             initargs=(threads, list(devices), context.Value('i', 0))) as executor:
+        futures = {}
+        for job in pending:
+            action = actions[job['id']]
+            print(f"{job['id']}: {action}")
+            # The parameters of the job only change once the run has completed, see job_action()
+            state.update(job['id'], status='running', action=action, run_params=params)
+            futures[executor.submit(train_job, job, action, params)] = job
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                epochs = future.result()
+            except Exception as e:
+                failed[job['id']] = repr(e)
+                state.update(job['id'], status='failed', error=repr(e),
+                             epochs=finished_epochs(job['run_dir']))
+                print(f"{job['id']}: failed, {e!r}")
                 continue
+            state.update(job['id'], status='done', epochs=epochs, params=params)
+            print(f"{job['id']}: done, {epochs} epochs")
+    return failed
+
+
+def parallel_jobs(cpus, threads, memory_gb, job_memory_gb):
+    """
+    Get the number of jobs that fit in the CPU and memory budget, at least one.
+    """
+    return max(1, min(cpus // threads, int(memory_gb // job_memory_gb)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train the models on the k-fold datasets, resuming interrupted "
+                                                 "runs and skipping finished ones.")
+    parser.add_argument('--models', nargs='+', default=['yolov8n', 'yolov8s', 'yolov8m'], help="Model names")
+    parser.add_argument('--folds', type=int, nargs='+', default=list(range(10)), help="Folds")
+    parser.add_argument('--levels', nargs='+', choices=levels, default=['species'], help="Levels")
+    parser.add_argument('--cpus', type=int, default=os.cpu_count(), help="CPU budget of all jobs")
+    parser.add_argument('--threads', type=int, default=4, help="CPU threads per job")
+    parser.add_argument('--memory', type=float, default=16, help="Memory budget of all jobs (GB)")
+    parser.add_argument('--job-memory', type=float, default=16, help="Memory of one job (GB)")
+    parser.add_argument('--devices', type=int, nargs='+', default=None,
+                        help="CUDA devices the parallel jobs are spread over (default: all visible devices)")
+    parser.add_argument('--pixel-cache', default='../pixel_cache',
+                        help="Decoded pixel cache shared by all runs, empty to decode in every epoch")
+    parser.add_argument('--state', default='runs/detect/train_state.json', help="Job state file")
+    parser.add_argument('--force', action='store_true', help="Train the finished jobs again")
+    args = parser.parse_args()
 
-            print(f"{model_name} - species: {k} dataset training:")
-
-            # Load the YAML configuration file
-            yaml_path = 'yaml/detect_different_species.yaml'
-            with open(yaml_path, 'r') as file:
-                data = yaml.safe_load(file)
-
-            # Modify the path in the YAML configuration
-            data['path'] = os.path.join(
-                '../yolo_output_images/species', str(k))
-
-            # Write the modified data back to the YAML file
-            with open(yaml_path, 'w') as file:
-                yaml.dump(data, file)
-
-            # Load the YOLO model
-            model = YOLO(f'{model_name}.pt')
-
-            # Define the training run directory
-            run_dir = os.path.join(
-                'runs/detect', model_name, f'51kinds_4640x3480_different_species{k}',
-                '2batch50epochs2560imgsz2dims50close_mosaic4points')
-
-            # Remove the existing run directory if it exists
-            if os.path.exists(run_dir):
-                shutil.rmtree(run_dir)
-
-            # Train the model
-            results = model.train(
-                project=os.path.join('runs/detect', model_name, f'51kinds_4640x3480_different_species{k}'),
-                name='2batch50epochs2560imgsz2dims50close_mosaic4points',
-                save_period=10, batch=2, imgsz=2560, close_mosaic=50,
-                data=yaml_path, seed=4399, epochs=50,
-                device=0, pretrained=True, optimizer='auto', scale=0.0, dropout=0.2, workers=1)
-
-            # Free up memory
-            del model
-            torch.cuda.empty_cache()
-            time.sleep(5)
\ No newline at end of file
+    jobs = plan_jobs(args.models, args.folds, args.levels, train_params, workers=8,
+                     pixel_cache_dir=args.pixel_cache or None)
+    parallel = parallel_jobs(args.cpus, args.threads, args.memory, args.job_memory)
+    devices = args.devices if args.devices is not None else list(range(torch.cuda.device_count()))
+    print(f"{len(jobs)} jobs, {parallel} at a time on devices {devices or [train_params['device']]}")
+    failed = run_jobs(jobs, train_params, args.state, parallel, args.threads, args.force, devices)
+    for job_id, error in failed.items():
+        print(f"{job_id}: {error}")
@@ -0,0 +1,231 @@
+import os
+import tempfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+import yaml
+
+from dataset_process.resize_dataset import fold_data, resize_fold
+from results_store import ResultsStore, evaluation_key, summarize_metrics
+
+# The levels of the grid
+levels = ('species', 'family', 'order')
+
+# The YOLO output directory of the dataset pipeline (dataset_process/pipeline.py)
+yolo_output_path = '../yolo_output_images'
+
+# The training run of a model on a fold, see detect_train.py
+weights_template = os.path.join('runs/detect', '{model}', '{experiment}{k}',
+                                '2batch50epochs2560imgsz2dims50close_mosaic4points', 'weights', 'best.pt')
+
+
+def level_datasets(level, yolo_path=yolo_output_path):
+    """
+    List the k-fold datasets of a level in the output layout of pipeline.py: <yolo>/species, and
+    <yolo>/<level>/<level>_<gradient>_<images> for the design levels, in gradient order.
+
+    The YAML files in yaml/ are not used: their paths point at another machine and at an older naming
+    of the datasets, and their names are not numbered like the conversion numbers the labels.
+
+    Args:
+        level (str): species, family or order.
+        yolo_path (str): The YOLO output directory of the pipeline.
+
+    Returns:
+        list: (dataset directory, class names) pairs, the names of fold 0's data.yaml.
+
+    Raises:
+        FileNotFoundError: If a dataset of the level was not built.
+    """
+    if level == 'species':
+        dataset_dirs = [os.path.join(yolo_path, 'species')]
+    else:
+        level_dir = os.path.join(yolo_path, level)
+        dataset_names = [name for name in os.listdir(level_dir) if name.startswith(f'{level}_')] \
+            if os.path.isdir(level_dir) else []
+        dataset_names.sort(key=lambda name: [int(part) for part in name.split('_')[1:] if part.isdigit()])
+        dataset_dirs = [os.path.join(level_dir, name) for name in dataset_names]
+        if not dataset_dirs:
+            raise FileNotFoundError(f"No {level} dataset in {level_dir}, "
+                                    f"build them with dataset_process/pipeline.py --levels {level}")
+
+    datasets = []
+    for dataset_dir in dataset_dirs:
+        names_path = os.path.join(dataset_dir, '0', 'data.yaml')
+        if not os.path.isdir(dataset_dir) or not os.path.exists(names_path):
+            raise FileNotFoundError(f"The {level} dataset {dataset_dir} was not built ({names_path} is missing), "
+                                    f"build it with dataset_process/pipeline.py --levels {level}")
+        with open(names_path, 'r') as f:
+            datasets.append((os.path.normpath(dataset_dir), yaml.safe_load(f)['names']))
+    return datasets
+
+
+def experiment_of(level, dataset_dir):
+    """
+    Get the experiment name of the training runs on a dataset.
+    """
+    return '51kinds_4640x3480_different_species' if level == 'species' else os.path.basename(dataset_dir)
+
+
+def plan_jobs(models, folds, levels, imgsz=2560, workers=1):
+    """
+    Build the evaluation jobs of the grid models x levels x datasets x folds.
+
+    The folds are pre-resized here, once, so the parallel jobs only read the cache.
+
+    Args:
+        models (list): The model names, e.g. ['yolov8n', 'yolov8s', 'yolov8m'].
+        folds (list): The folds to evaluate.
+        levels (list): The levels: species, family and/or order.
+        imgsz (int): The evaluation image size.
+        workers (int): The number of worker processes resizing the folds.
+
+    Returns:
+        list: One job dict per model, level, dataset and fold whose weights exist.
+    """
+    jobs = []
+    for level in levels:
+        for dataset_dir, _ in level_datasets(level):
+            for k in folds:
+                weights = {model: weights_template.format(model=model, experiment=experiment_of(level, dataset_dir),
+                                                          k=k) for model in models}
+                weights = {model: path for model, path in weights.items() if os.path.exists(path)}
+                if not weights:
+                    continue
+
+                # Each fold gets a YAML file of its own with the class names its conversion wrote, which
+                # the models were trained with, the fold's data.yaml is never modified
+                data = fold_data(dataset_dir, k)
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    fold_yaml_path = os.path.join(tmp_dir, 'data.yaml')
+                    with open(fold_yaml_path, 'w') as f:
+                        yaml.dump(data, f, allow_unicode=True)
+                    resized_yaml_path = resize_fold(fold_yaml_path, imgsz, policy='fit', workers=workers)
+
+                for model, path in weights.items():
+                    jobs.append({'model': model, 'level': level, 'dataset': os.path.basename(dataset_dir), 'fold': k,
+                                 'weights': path, 'yaml_path': resized_yaml_path, 'names': data['names']})
+    return jobs
+
+
+def limit_threads(threads):
+    """
+    Process pool initializer: limit the CPU threads of a job.
+    """
+    for name in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[name] = str(threads)
+    import torch
+    torch.set_num_threads(threads)
+
+
+def evaluate_job(job, params, device=None, loader_workers=1):
+    """
+    Evaluate the weights of a job on its fold.
+
+    Args:
+        job (dict): The job of plan_jobs().
+        params (dict): The val parameters: split, imgsz, batch and max_det.
+        device: The device, None for the Ultralytics default.
+        loader_workers (int): The number of dataloader workers.
+
+    Returns:
+        tuple: The summary and per-class metrics, see summarize_metrics().
+    """
+    from ultralytics import YOLO
+
+    with open(job['yaml_path'], 'r') as f:
+        data = yaml.safe_load(f)
+    # A temporary dataset YAML file per job, so parallel jobs never share one
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        yaml_path = os.path.join(tmp_dir, 'data.yaml')
+        with open(yaml_path, 'w') as f:
+            yaml.dump(data, f, allow_unicode=True)
+
+        model = YOLO(job['weights'])
+        # Note: Do not set --save-hybrid to True, as it will write true and predicted values to the annotation file *.txt
+        metrics = model.val(data=yaml_path, seed=4399, plots=False, workers=loader_workers, device=device,
+                            verbose=False, project='runs/val/grid', exist_ok=True,
+                            name=f"{job['model']}_{job['dataset']}_{job['fold']}", **params)
+    return summarize_metrics(metrics, job['images'])
+
+
+def evaluate_grid(jobs, params, parallel=2, threads=4, store_path='runs/val/results.sqlite', **kwargs):
+    """
+    Evaluate the jobs in a process pool and merge the results.
+
+    The results store is looked up first: jobs whose weights, label set and parameters were already
+    evaluated are not run again.
+
+    Args:
+        jobs (list): The jobs of plan_jobs().
+        params (dict): The val parameters: split, imgsz, batch and max_det.
+        parallel (int): The number of jobs evaluated at the same time.
+        threads (int): The number of CPU threads per job.
+        store_path (str): The SQLite file of the results store.
+        **kwargs: The other parameters of evaluate_job().
+
+    Returns:
+        tuple: The summary and per-class DataFrames, empty when there are no jobs.
+    """
+    store = ResultsStore(store_path)
+    summaries, per_class = [], []
+
+    def add(job, summary, rows):
+        key = {name: job[name] for name in ['model', 'level', 'dataset', 'fold']}
+        print(f"{job['model']} {job['dataset']} {job['fold']}: mAP50 {summary['map50']:.4f}")
+        summaries.append(dict(key, **summary))
+        per_class.extend(dict(key, **row) for row in rows)
+
+    pending = []
+    for job in jobs:
+        job['key'], job['images'] = evaluation_key(job['weights'], job['yaml_path'], params)
+        cached = store.get(job['key'])
+        if cached:
+            add(job, *cached)
+        else:
+            pending.append(job)
+    print(f"{len(jobs) - len(pending)} of {len(jobs)} jobs already evaluated")
+
+    with ProcessPoolExecutor(max_workers=parallel, initializer=limit_threads, initargs=(threads,)) as executor:
+        futures = {executor.submit(evaluate_job, job, params, **kwargs): job for job in pending}
+        for future in as_completed(futures):
+            job = futures[future]
+            summary, rows = future.result()
+            store.put(job['key'], job, params, summary, rows)
+            add(job, summary, rows)
+    store.close()
+
+    def frame(rows, columns):
+        # Without weights or jobs there are no rows, and no columns to sort by
+        return pd.DataFrame(rows).sort_values(columns, ignore_index=True) if rows else pd.DataFrame(columns=columns)
+
+    order = ['model', 'level', 'dataset', 'fold']
+    return frame(summaries, order), frame(per_class, order + ['cls'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Evaluate the grid of models x levels x folds in parallel.")
+    parser.add_argument('--models', nargs='+', default=['yolov8n', 'yolov8s', 'yolov8m'], help="Model names")
+    parser.add_argument('--folds', type=int, nargs='+', default=list(range(10)), help="Folds")
+    parser.add_argument('--levels', nargs='+', choices=levels, default=['species'], help="Levels")
+    parser.add_argument('--imgsz', type=int, default=2560, help="Image size")
+    parser.add_argument('--batch', type=int, default=2, help="Batch size")
+    parser.add_argument('--device', default=None, help="Device, e.g. 0 or cpu")
+    parser.add_argument('--parallel', type=int, default=2, help="Jobs evaluated at the same time")
+    parser.add_argument('--threads', type=int, default=4, help="CPU threads per job")
+    parser.add_argument('--store', default='runs/val/results.sqlite', help="Results store")
+    parser.add_argument('--output', default='runs/val/grid/results.xlsx', help="Result table")
+    args = parser.parse_args()
+
+    jobs = plan_jobs(args.models, args.folds, args.levels, args.imgsz, workers=args.parallel * args.threads)
+    print(f"{len(jobs)} jobs")
+    params = {'split': 'test', 'imgsz': args.imgsz, 'batch': args.batch, 'max_det': 30}
+    summary, per_class = evaluate_grid(jobs, params, args.parallel, args.threads, args.store, device=args.device)
+    cross_fold = ResultsStore(args.store).aggregate()
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with pd.ExcelWriter(args.output) as writer:
+        summary.to_excel(writer, sheet_name='summary', index=False)
+        per_class.to_excel(writer, sheet_name='per_class', index=False)
+        cross_fold.to_excel(writer, sheet_name='cross_fold', index=False)
+    print(summary.to_string(index=False))
@@ -0,0 +1,281 @@
+import os
+import csv
+import queue
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+from tqdm import tqdm
+from ultralytics import YOLO
+
+from tiled_val import predict_tiled
+
+detection_columns = ['image', 'cls', 'species', 'conf', 'x1', 'y1', 'x2', 'y2']
+
+
+def iter_images(source):
+    """
+    List the images of a directory tree lazily, in a stable order.
+
+    Args:
+        source (str): The root directory.
+
+    Yields:
+        str: The image paths.
+    """
+    for root, dirs, files in os.walk(source):
+        dirs.sort()
+        for file in sorted(files):
+            if file.lower().endswith(('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')):
+                yield os.path.join(root, file)
+
+
+def prefetch_images(paths, threads=2, prefetch=16):
+    """
+    Decode images in a thread pool ahead of the caller, at most prefetch at a time.
+
+    Args:
+        paths (iterable): The image paths.
+        threads (int): The number of decoding threads.
+        prefetch (int): The maximum number of decoded or decoding images waiting for the caller.
+
+    Yields:
+        tuple: The image path and the BGR image, None if it could not be decoded, in the order of paths.
+    """
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for path in paths:
+            pending.append((path, executor.submit(cv2.imread, path)))
+            if len(pending) >= prefetch:
+                path, future = pending.popleft()
+                yield path, future.result()
+        while pending:
+            path, future = pending.popleft()
+            yield path, future.result()
+
+
+def batched(items, batch):
+    """
+    Group an iterable into lists of batch items, the last one may be shorter.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == batch:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class TableWriter:
+    """
+    Append rows to a CSV or Parquet file as they come. Parquet rows are buffered into row groups of
+    row_group rows, so the memory held stays bounded.
+    """
+
+    def __init__(self, path, columns, output_format='csv', row_group=10000):
+        """
+        Args:
+            path (str): The output file without extension.
+            columns (list): The column names.
+            output_format (str): 'csv' or 'parquet'.
+            row_group (int): The number of rows per Parquet row group.
+        """
+        self.columns = columns
+        self.output_format = output_format
+        self.row_group = row_group
+        self.rows = []
+        if output_format == 'parquet':
+            import pyarrow.parquet as pq
+            self.writer = None
+            self.path = f'{path}.parquet'
+            self.pq = pq
+        else:
+            self.file = open(f'{path}.csv', 'w', newline='', encoding='utf-8')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(columns)
+
+    def write(self, rows):
+        """
+        Append rows, each a list of values in the order of the columns.
+        """
+        if self.output_format != 'parquet':
+            self.writer.writerows(rows)
+            return
+        self.rows.extend(rows)
+        if len(self.rows) >= self.row_group:
+            self._write_row_group()
+
+    def _write_row_group(self):
+        import pyarrow as pa
+        table = pa.table({name: [row[i] for row in self.rows] for i, name in enumerate(self.columns)})
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+        if self.output_format != 'parquet':
+            self.file.close()
+            return
+        if self.rows or self.writer is None:
+            self._write_row_group()
+        self.writer.close()
+
+
+def write_results(results, output_path, names, output_format='csv', max_det=None):
+    """
+    Post-process the detections of a queue until it gets None: write every detection and the
+    per-species counts of every image, and return the total counts.
+
+    Args:
+        results (queue.Queue): (image, boxes, confidences, classes) tuples, boxes None for an image
+            that could not be decoded.
+        output_path (str): The output directory.
+        names (dict): The class names of the model.
+        output_format (str): 'csv' or 'parquet'.
+        max_det (int): The maximum number of detections per image of the model, to count the images
+            whose counts it may have cut, or None.
+
+    Returns:
+        dict: The number of images, unreadable images, images with max_det detections (truncated)
+            and specimens per species.
+    """
+    species = [names[i] for i in sorted(names)]
+    detections = TableWriter(os.path.join(output_path, 'detections'), detection_columns, output_format)
+    counts = TableWriter(os.path.join(output_path, 'counts'), ['image', 'total'] + species, output_format)
+    totals = {'images': 0, 'unreadable': 0, 'truncated': 0}
+    totals.update({name: 0 for name in species})
+    try:
+        while True:
+            item = results.get()
+            if item is None:
+                break
+            image, boxes, confidences, classes = item
+            totals['images'] += 1
+            if boxes is None:
+                totals['unreadable'] += 1
+                continue
+            if max_det and len(boxes) >= max_det:
+                totals['truncated'] += 1
+            image_counts = [0] * len(species)
+            rows = []
+            for (x1, y1, x2, y2), confidence, cls in zip(boxes.tolist(), confidences.tolist(), classes.tolist()):
+                cls = int(cls)
+                image_counts[cls] += 1
+                rows.append([image, cls, names[cls], round(confidence, 4),
+                             round(x1, 1), round(y1, 1), round(x2, 1), round(y2, 1)])
+            detections.write(rows)
+            counts.write([[image, sum(image_counts)] + image_counts])
+            for name, count in zip(species, image_counts):
+                totals[name] += count
+    finally:
+        detections.close()
+        counts.close()
+    return totals
+
+
+def predict_directory(weights, source, output_path, batch=8, imgsz=2560, conf=0.25, iou=0.6, max_det=300,
+                      device=None, tile_size=None, overlap=0.2, threads=2, prefetch=16, output_format='csv'):
+    """
+    Detect and count the specimens of every image of a directory tree.
+
+    Decoding (a thread pool, prefetch images ahead), inference (batches of images, or of tiles with
+    tile_size) and writing (a thread behind a bounded queue) overlap, and every result is written
+    as soon as it is known, so the memory use does not grow with the number of images.
+
+    Args:
+        weights (str): The detection model weights.
+        source (str): The image directory.
+        output_path (str): The output directory of detections.csv and counts.csv (or .parquet).
+        batch (int): The number of images per forward pass, of tiles with tile_size.
+        imgsz (int): The inference image size, ignored with tile_size.
+        conf (float): The confidence threshold.
+        iou (float): The NMS IoU threshold.
+        max_det (int): The maximum number of detections per image, above the number of specimens an
+            image can hold or its counts are cut (the images reaching it are counted as truncated).
+        device: The device, None for the Ultralytics default.
+        tile_size (int): Detect on overlapping tiles of this size at full resolution, see tiled_val.py,
+            or None to detect on the whole resized image.
+        overlap (float): The overlap between neighboring tiles.
+        threads (int): The number of decoding threads.
+        prefetch (int): The maximum number of decoded images waiting for inference.
+        output_format (str): 'csv' or 'parquet'.
+
+    Returns:
+        dict: The number of images, unreadable images, truncated images and specimens per species.
+    """
+    os.makedirs(output_path, exist_ok=True)
+    model = YOLO(weights)
+    results = queue.Queue(maxsize=prefetch)
+    totals = {}
+    errors = []
+
+    def write():
+        try:
+            totals.update(write_results(results, output_path, model.names, output_format, max_det))
+        except Exception as e:
+            errors.append(e)
+            # Keep taking the results, so the inference loop never blocks on a full queue
+            while results.get() is not None:
+                pass
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    try:
+        images = prefetch_images(iter_images(source), threads, prefetch)
+        with tqdm(desc=f"Predicting {source}", unit='image') as progress:
+            for chunk in batched(images, 1 if tile_size else batch):
+                paths = [os.path.relpath(path, source) for path, _ in chunk]
+                decoded = [(path, image) for path, (_, image) in zip(paths, chunk) if image is not None]
+                for path, (_, image) in zip(paths, chunk):
+                    if image is None:
+                        results.put((path, None, None, None))
+                if tile_size and decoded:
+                    path, image = decoded[0]
+                    results.put((path, *predict_tiled(model, image, tile_size, overlap, batch, conf, iou, max_det,
+                                                      device)))
+                elif decoded:
+                    predictions = model.predict([image for _, image in decoded], imgsz=imgsz, conf=conf, iou=iou,
+                                                max_det=max_det, device=device, verbose=False)
+                    for (path, _), prediction in zip(decoded, predictions):
+                        boxes = prediction.boxes.cpu().numpy()
+                        results.put((path, boxes.xyxy, boxes.conf, boxes.cls))
+                progress.update(len(chunk))
+    finally:
+        results.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+    return totals
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Detect and count the Collembola of a directory of field images.")
+    parser.add_argument('--weights', required=True, help="Model weights, e.g. runs/detect/.../weights/best.pt")
+    parser.add_argument('--source', required=True, help="Image directory, searched recursively")
+    parser.add_argument('--output', default='runs/predict', help="Output directory")
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv', help="Output format")
+    parser.add_argument('--batch', type=int, default=8, help="Images (or tiles) per forward pass")
+    parser.add_argument('--imgsz', type=int, default=2560, help="Image size")
+    parser.add_argument('--conf', type=float, default=0.25, help="Confidence threshold")
+    parser.add_argument('--max-det', type=int, default=300, help="Maximum detections per image")
+    parser.add_argument('--device', default=None, help="Device, e.g. 0 or cpu")
+    parser.add_argument('--tile-size', type=int, default=None, help="Detect on full-resolution tiles of this size")
+    parser.add_argument('--threads', type=int, default=2, help="Decoding threads")
+    parser.add_argument('--prefetch', type=int, default=16, help="Decoded images waiting for inference")
+    args = parser.parse_args()
+
+    totals = predict_directory(args.weights, args.source, args.output, args.batch, args.imgsz, args.conf,
+                               max_det=args.max_det, device=args.device, tile_size=args.tile_size,
+                               threads=args.threads, prefetch=args.prefetch, output_format=args.format)
+    print(f"{totals['images']} images, {totals['unreadable']} unreadable")
+    if totals['truncated']:
+        print(f"Warning: {totals['truncated']} images reached --max-det {args.max_det} detections, "
+              f"their counts may be cut, run again with a higher --max-det")
+    for name, count in totals.items():
+        if name not in ['images', 'unreadable', 'truncated'] and count:
+            print(f"{name}: {count}")
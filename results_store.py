@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+import pandas as pd
+import yaml
+
+from dataset_process.resize_dataset import label_path_of, split_images
+
+summary_columns = ['mp', 'mr', 'map50', 'map', 'preprocess_ms', 'inference_ms', 'postprocess_ms', 'images']
+class_columns = ['cls', 'p', 'r', 'ap50', 'ap']
+
+
+def file_sha1(path):
+    """
+    Hash the content of a file, e.g. best.pt.
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def labels_fingerprint(yaml_path, split='test'):
+    """
+    Fingerprint the label set of a split: its image names, label files and class names.
+
+    Args:
+        yaml_path (str): The dataset YAML file.
+        split (str): The split.
+
+    Returns:
+        tuple: The SHA-1 hex digest and the number of images.
+    """
+    with open(yaml_path, 'r') as f:
+        data = yaml.safe_load(f)
+    data['path'] = os.path.abspath(data['path'])
+    sha1 = hashlib.sha1(json.dumps(data['names'], sort_keys=True).encode())
+    images = split_images(data, split)
+    for image_path in sorted(images, key=os.path.basename):
+        sha1.update(os.path.basename(image_path).encode())
+        label_path = label_path_of(image_path)
+        if os.path.exists(label_path):
+            with open(label_path, 'rb') as f:
+                sha1.update(f.read())
+    return sha1.hexdigest(), len(images)
+
+
+def evaluation_key(weights, yaml_path, params):
+    """
+    Get the key of an evaluation: the hash of the weights, of the label set and of the val parameters.
+
+    Args:
+        weights (str): The model weights, e.g. best.pt.
+        yaml_path (str): The dataset YAML file.
+        params (dict): The parameters of model.val() that change the metrics (split, imgsz, ...).
+
+    Returns:
+        tuple: The key and the number of images of the split.
+    """
+    labels_hash, images = labels_fingerprint(yaml_path, params.get('split', 'test'))
+    key = json.dumps([file_sha1(weights), labels_hash, params], sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest(), images
+
+
+def summarize_metrics(metrics, images):
+    """
+    Get the summary and per-class metrics of a model.val() result.
+
+    Args:
+        metrics (DetMetrics): The result of model.val().
+        images (int): The number of evaluated images.
+
+    Returns:
+        tuple: The summary dict and the per-class dicts.
+    """
+    summary = {'mp': metrics.box.mp, 'mr': metrics.box.mr, 'map50': metrics.box.map50, 'map': metrics.box.map,
+               'preprocess_ms': metrics.speed['preprocess'], 'inference_ms': metrics.speed['inference'],
+               'postprocess_ms': metrics.speed['postprocess'], 'images': images}
+    per_class = [{'cls': metrics.names[int(c)], 'p': metrics.box.p[i], 'r': metrics.box.r[i],
+                  'ap50': metrics.box.ap50[i], 'ap': metrics.box.ap[i]}
+                 for i, c in enumerate(metrics.box.ap_class_index)]
+    return summary, per_class
+
+
+class ResultsStore:
+    """
+    A local SQLite store of evaluation results, keyed by evaluation_key(), so an unchanged
+    combination of weights, labels and parameters is never evaluated twice.
+    """
+
+    def __init__(self, store_path='runs/val/results.sqlite'):
+        """
+        Args:
+            store_path (str): The SQLite file of the store.
+        """
+        os.makedirs(os.path.dirname(store_path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(store_path)
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS evaluations (key PRIMARY KEY, model, level, dataset, "
+                                f"fold, params, created, {', '.join(summary_columns)})")
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS class_metrics (key, {', '.join(class_columns)})")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS class_metrics_key ON class_metrics (key)")
+
+    def get(self, key):
+        """
+        Get the stored result of an evaluation.
+
+        Args:
+            key (str): The key of evaluation_key().
+
+        Returns:
+            tuple: The summary dict and the per-class dicts, or None if it was never evaluated.
+        """
+        row = self.connection.execute(f"SELECT {', '.join(summary_columns)} FROM evaluations WHERE key = ?",
+                                      (key,)).fetchone()
+        if row is None:
+            return None
+        rows = self.connection.execute(f"SELECT {', '.join(class_columns)} FROM class_metrics WHERE key = ? "
+                                       "ORDER BY rowid", (key,)).fetchall()
+        return dict(zip(summary_columns, row)), [dict(zip(class_columns, values)) for values in rows]
+
+    def put(self, key, job, params, summary, per_class):
+        """
+        Store the result of an evaluation.
+
+        Args:
+            key (str): The key of evaluation_key().
+            job (dict): The model, level, dataset and fold of the evaluation.
+            params (dict): The val parameters.
+            summary (dict): The summary metrics, see summarize_metrics().
+            per_class (list): The per-class metrics.
+        """
+        self.connection.execute("DELETE FROM class_metrics WHERE key = ?", (key,))
+        placeholders = ', '.join('?' * (7 + len(summary_columns)))
+        self.connection.execute(f"INSERT OR REPLACE INTO evaluations VALUES ({placeholders})",
+                                [key, job['model'], job['level'], job['dataset'], job['fold'],
+                                 json.dumps(params, sort_keys=True), time.time()] +
+                                [float(summary[name]) for name in summary_columns])
+        self.connection.executemany(f"INSERT INTO class_metrics VALUES ({', '.join('?' * (1 + len(class_columns)))})",
+                                    [[key, row['cls']] + [float(row[name]) for name in class_columns[1:]]
+                                     for row in per_class])
+        self.connection.commit()
+
+    def aggregate(self, level=None):
+        """
+        Aggregate the stored results across folds: mean and standard deviation per model and dataset,
+        using the latest evaluation of every fold.
+
+        Args:
+            level (str): Only aggregate this level, or None for all levels.
+
+        Returns:
+            pandas.DataFrame: One row per model, level and dataset.
+        """
+        where, params = ("WHERE level = ?", (level,)) if level else ('', ())
+        df = pd.read_sql_query(f"SELECT * FROM evaluations {where} ORDER BY created", self.connection, params=params)
+        df = df.drop_duplicates(['model', 'level', 'dataset', 'fold', 'params'], keep='last')
+        metrics = ['mp', 'mr', 'map50', 'map', 'inference_ms']
+        result = df.groupby(['model', 'level', 'dataset', 'params'])[metrics].agg(['mean', 'std'])
+        result.columns = [f'{metric}_{stat}' for metric, stat in result.columns]
+        result['folds'] = df.groupby(['model', 'level', 'dataset', 'params']).size()
+        return result.reset_index()
+
+    def close(self):
+        self.connection.close()
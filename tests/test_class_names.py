@@ -0,0 +1,48 @@
+import os
+import sys
+import json
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dataset_process'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from labelme2yolo_detect import convert_dataset
+from dataset_process.resize_dataset import fold_data
+
+# Not in sorted order, like yaml/detect_different_species.yaml
+labels = ['Sinella curviseta', 'Ceratophysella sinensis', 'Arrhopalites nanjingensis']
+
+
+def write_labelme(dataset_dir, stem, label):
+    Image.new('RGB', (64, 48)).save(os.path.join(dataset_dir, f'{stem}.jpg'))
+    data = {'shapes': [{'label': label, 'points': [[8, 8], [40, 32]], 'shape_type': 'rectangle'}],
+            'imagePath': f'{stem}.jpg', 'imageWidth': 64, 'imageHeight': 48}
+    with open(os.path.join(dataset_dir, f'{stem}.json'), 'w') as f:
+        json.dump(data, f)
+
+
+def test_trainer_reads_the_class_names_of_the_conversion(tmp_path):
+    dataset_dir = tmp_path / 'species'
+    output_dir = tmp_path / 'yolo' / 'species'
+    dataset_dir.mkdir()
+    for i in range(9):
+        write_labelme(dataset_dir, str(i), labels[i % len(labels)])
+
+    # The defaults of pipeline.py: hardlink layout, no names file
+    convert_dataset(str(dataset_dir), str(output_dir), folds=3, layout='hardlink', names_path=None)
+
+    for k in range(3):
+        # The fold data detect_train.py, eval_grid.py and val.py train and evaluate with
+        data = fold_data(str(output_dir), k)
+        assert data['path'] == os.path.join(str(output_dir), str(k))
+        assert data['names'] == dict(enumerate(sorted(labels)))
+
+        # Every label file the converter wrote names its box with the JSON label
+        for split in ['train', 'val', 'test']:
+            labels_dir = os.path.join(data['path'], 'labels', split)
+            for file in os.listdir(labels_dir):
+                with open(os.path.join(labels_dir, file), 'r') as f:
+                    class_id = int(f.read().split()[0])
+                stem = os.path.splitext(file)[0]
+                assert data['names'][class_id] == labels[int(stem) % len(labels)]
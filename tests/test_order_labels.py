@@ -0,0 +1,52 @@
+import os
+import sys
+import json
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dataset_process'))
+
+from catalog import build_catalog
+from crop_library import build_crop_library
+from synthesis import DesignOrderStrategy, run_chunk, synthesize_design_image
+
+# family/<family>/<order>/<genus>/<species>/<image>: the order is the directory three levels above the image
+sources = {os.path.join('family', '科 Fam', 'OrdA', 'GenA', 'GenA spa', '0.jpg'): 'GenA spa',
+           os.path.join('family', '科 Fam', 'OrdB', 'GenB', 'GenB spb', '0.jpg'): 'GenB spb'}
+
+
+def write_labelme(jpg, label):
+    os.makedirs(os.path.dirname(jpg))
+    Image.new('RGB', (200, 160), (90, 60, 30)).save(jpg)
+    data = {'shapes': [{'label': label, 'points': [[20, 20], [120, 100]], 'shape_type': 'rectangle'}],
+            'imagePath': os.path.basename(jpg), 'imageWidth': 200, 'imageHeight': 160}
+    with open(f'{os.path.splitext(jpg)[0]}.json', 'w') as f:
+        json.dump(data, f)
+
+
+@pytest.mark.parametrize('labels, expected', [('order', {'OrdA', 'OrdB'}), ('species', {'GenA spa', 'GenB spb'})])
+def test_order_level_labels(tmp_path, labels, expected):
+    dataset_dir = str(tmp_path / 'init_dataset')
+    for source, label in sources.items():
+        write_labelme(os.path.join(dataset_dir, source), label)
+    background_path = str(tmp_path / 'background.jpg')
+    Image.new('RGB', (464, 348), (200, 200, 200)).save(background_path)
+    library_path = str(tmp_path / 'crop_library')
+    build_crop_library(dataset_dir, library_path)
+    catalog = build_catalog(dataset_dir, str(tmp_path / 'catalog.sqlite'))
+
+    strategy = DesignOrderStrategy(labels=labels)
+    jpgs = [os.path.join(dataset_dir, source) for source in sources]
+    save_dir = str(tmp_path / 'order')
+    os.makedirs(save_dir)
+    job = {'picture_id': 0, 'jpg_list': jpgs, 'seed': 4396, 'relabel': strategy.relabel, 'spread_edges': False,
+           'background_paths': (background_path,), 'library_path': library_path, 'save_dir': save_dir,
+           'output_format': 'labelme'}
+    run_chunk(synthesize_design_image, [job])
+
+    with open(os.path.join(save_dir, '0.json'), 'r') as f:
+        data = json.load(f)
+    assert {shape['label'] for shape in data['shapes'] if shape['shape_type'] == 'rectangle'} == expected
+    # The YOLO class ids are numbered from the same labels
+    assert {strategy.label(jpg, catalog) for jpg in jpgs} == expected
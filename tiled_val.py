@@ -0,0 +1,225 @@
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+import pandas as pd
+import torch
+import torchvision
+import yaml
+from ultralytics import YOLO
+from ultralytics.utils.metrics import ap_per_class
+
+from dataset_process.placement import tile_origins
+from dataset_process.resize_dataset import label_path_of, split_images
+
+
+def predict_tiled(model, image, tile_size=1024, overlap=0.2, batch=8, conf=0.25, iou=0.6, max_det=30, device=None):
+    """
+    Detect on overlapping tiles of a full-resolution image and merge the boxes in image coordinates.
+
+    Args:
+        model (YOLO): The detection model.
+        image (numpy.ndarray): The BGR image.
+        tile_size (int): The tile size, also the inference imgsz.
+        overlap (float): The overlap between neighboring tiles, as a fraction of the tile size.
+        batch (int): The number of tiles per forward pass.
+        conf (float): The confidence threshold.
+        iou (float): The IoU threshold of the NMS, within tiles and when merging tiles.
+        max_det (int): The maximum number of detections per image.
+        device: The device, None for the Ultralytics default.
+
+    Returns:
+        tuple: The xyxy boxes (n, 4), confidences (n,) and classes (n,) as NumPy arrays.
+    """
+    height, width = image.shape[:2]
+    origins = [(x, y) for y in tile_origins(height, tile_size, overlap)
+               for x in tile_origins(width, tile_size, overlap)]
+
+    boxes, scores, classes = [], [], []
+    for start in range(0, len(origins), batch):
+        batch_origins = origins[start:start + batch]
+        tiles = [image[y:y + tile_size, x:x + tile_size] for x, y in batch_origins]
+        results = model.predict(tiles, imgsz=tile_size, conf=conf, iou=iou, device=device, verbose=False)
+        for (x, y), result in zip(batch_origins, results):
+            boxes.append(result.boxes.xyxy.cpu() + torch.tensor([x, y, x, y], dtype=torch.float32))
+            scores.append(result.boxes.conf.cpu())
+            classes.append(result.boxes.cls.cpu())
+
+    boxes, scores, classes = torch.cat(boxes), torch.cat(scores), torch.cat(classes)
+    # Class-aware NMS removes the duplicates of the specimens seen by several tiles
+    keep = torchvision.ops.batched_nms(boxes, scores, classes.long(), iou)[:max_det]
+    return boxes[keep].numpy(), scores[keep].numpy(), classes[keep].numpy()
+
+
+def box_iou(boxes1, boxes2):
+    """
+    Get the IoU of every pair of xyxy boxes.
+
+    Returns:
+        numpy.ndarray: The (len(boxes1), len(boxes2)) IoU matrix.
+    """
+    top_left = np.maximum(boxes1[:, None, :2], boxes2[None, :, :2])
+    bottom_right = np.minimum(boxes1[:, None, 2:], boxes2[None, :, 2:])
+    inter = np.clip(bottom_right - top_left, 0, None).prod(2)
+    area1 = (boxes1[:, 2:] - boxes1[:, :2]).prod(1)
+    area2 = (boxes2[:, 2:] - boxes2[:, :2]).prod(1)
+    return inter / (area1[:, None] + area2[None, :] - inter + 1e-9)
+
+
+def match_predictions(pred_boxes, pred_classes, true_boxes, true_classes, iouv):
+    """
+    Mark the predictions matching a ground truth box of their class, like the Ultralytics validator.
+
+    Args:
+        pred_boxes (numpy.ndarray): The predicted xyxy boxes (n, 4).
+        pred_classes (numpy.ndarray): The predicted classes (n,).
+        true_boxes (numpy.ndarray): The ground truth xyxy boxes (m, 4).
+        true_classes (numpy.ndarray): The ground truth classes (m,).
+        iouv (numpy.ndarray): The IoU thresholds.
+
+    Returns:
+        numpy.ndarray: The (n, len(iouv)) boolean matrix of true positives.
+    """
+    correct = np.zeros((len(pred_boxes), len(iouv)), dtype=bool)
+    if not len(pred_boxes) or not len(true_boxes):
+        return correct
+    iou = box_iou(true_boxes, pred_boxes) * (true_classes[:, None] == pred_classes[None, :])
+    for i, threshold in enumerate(iouv):
+        matches = np.array(np.nonzero(iou >= threshold)).T
+        if matches.shape[0]:
+            if matches.shape[0] > 1:
+                # One prediction per ground truth box and one ground truth box per prediction, best IoU first
+                matches = matches[iou[matches[:, 0], matches[:, 1]].argsort()[::-1]]
+                matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
+                matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
+            correct[matches[:, 1], i] = True
+    return correct
+
+
+def read_labels(image_path, width, height):
+    """
+    Read the YOLO label file of an image as xyxy pixel boxes.
+
+    Returns:
+        tuple: The boxes (m, 4) and classes (m,).
+    """
+    label_path = label_path_of(image_path)
+    if not os.path.exists(label_path):
+        return np.zeros((0, 4)), np.zeros(0)
+    labels = np.loadtxt(label_path, ndmin=2)
+    if not len(labels):
+        return np.zeros((0, 4)), np.zeros(0)
+    xywh = labels[:, 1:5] * [width, height, width, height]
+    boxes = np.concatenate([xywh[:, :2] - xywh[:, 2:] / 2, xywh[:, :2] + xywh[:, 2:] / 2], 1)
+    return boxes, labels[:, 0]
+
+
+def peak_rss_mb():
+    """
+    Get the peak resident memory of this process in MB.
+    """
+    if sys.platform == 'win32':
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 2 ** 20
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB on Linux
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def evaluate_tiled(weights, yaml_path, split='test', tile_size=1024, overlap=0.2, batch=8, conf=0.001, iou=0.6,
+                   max_det=30, threads=None, device=None):
+    """
+    Evaluate a detection model with tiled inference on the full-resolution images of a dataset.
+
+    Args:
+        weights (str): The model weights, e.g. best.pt.
+        yaml_path (str): The dataset YAML file.
+        split (str): The split to evaluate.
+        tile_size (int): The tile size.
+        overlap (float): The overlap between neighboring tiles.
+        batch (int): The number of tiles per forward pass.
+        conf (float): The confidence threshold.
+        iou (float): The NMS IoU threshold.
+        max_det (int): The maximum number of detections per image.
+        threads (int): The number of CPU threads of torch, None for its default.
+        device: The device, e.g. 0 or 'cpu', None for the Ultralytics default.
+
+    Returns:
+        dict: P, R, mAP50, mAP50-95, per-class AP50, mean and p95 latency per image (ms) and peak RSS (MB).
+    """
+    if threads:
+        torch.set_num_threads(threads)
+    with open(yaml_path, 'r') as f:
+        data = yaml.safe_load(f)
+    data['path'] = os.path.abspath(data['path'])
+    model = YOLO(weights)
+    iouv = np.linspace(0.5, 0.95, 10)
+
+    stats = []
+    latencies = []
+    for image_path in split_images(data, split):
+        image = cv2.imread(image_path)
+        start = time.perf_counter()
+        boxes, scores, classes = predict_tiled(model, image, tile_size, overlap, batch, conf, iou, max_det,
+                                               device)
+        latencies.append(time.perf_counter() - start)
+
+        true_boxes, true_classes = read_labels(image_path, image.shape[1], image.shape[0])
+        stats.append((match_predictions(boxes, classes, true_boxes, true_classes, iouv), scores, classes, true_classes))
+
+    correct, scores, classes, true_classes = [np.concatenate(values, 0) for values in zip(*stats)]
+    _, _, p, r, _, ap, unique_classes = ap_per_class(correct, scores, classes, true_classes)[:7]
+    names = data['names']
+    return {'tile_size': tile_size, 'overlap': overlap, 'images': len(latencies),
+            'mp': p.mean(), 'mr': r.mean(), 'map50': ap[:, 0].mean(), 'map': ap.mean(),
+            'ap50': {names[int(c)]: ap50 for c, ap50 in zip(unique_classes, ap[:, 0])},
+            'latency_ms': np.mean(latencies) * 1000, 'latency_p95_ms': np.percentile(latencies, 95) * 1000,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def compare_tile_sizes(weights, yaml_path, tile_sizes=(640, 1024), **kwargs):
+    """
+    Evaluate several tile sizes, each in a new process so its peak RSS is its own.
+
+    Args:
+        weights (str): The model weights.
+        yaml_path (str): The dataset YAML file.
+        tile_sizes (tuple): The tile sizes to compare.
+        **kwargs: The other parameters of evaluate_tiled().
+
+    Returns:
+        pandas.DataFrame: One row per tile size.
+    """
+    rows = []
+    # A forked child would inherit the torch state of this process
+    context = multiprocessing.get_context('spawn')
+    for tile_size in tile_sizes:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            rows.append(executor.submit(evaluate_tiled, weights, yaml_path, tile_size=tile_size, **kwargs).result())
+    return pd.DataFrame(rows).drop(columns=['ap50'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Evaluate a detection model with tiled inference.")
+    parser.add_argument('--weights', required=True, help="Model weights, e.g. runs/detect/.../weights/best.pt")
+    parser.add_argument('--data', required=True, help="Dataset YAML file of the fold")
+    parser.add_argument('--split', default='test', help="Split to evaluate")
+    parser.add_argument('--tile-sizes', type=int, nargs='+', default=[640, 1024], help="Tile sizes to compare")
+    parser.add_argument('--overlap', type=float, default=0.2, help="Overlap between neighboring tiles")
+    parser.add_argument('--batch', type=int, default=8, help="Tiles per forward pass")
+    parser.add_argument('--threads', type=int, default=None, help="CPU threads")
+    parser.add_argument('--device', default=None, help="Device, e.g. 0 or cpu")
+    parser.add_argument('--output', default='runs/val/tiled/results.xlsx', help="Result table")
+    args = parser.parse_args()
+
+    df = compare_tile_sizes(args.weights, args.data, args.tile_sizes, split=args.split, overlap=args.overlap,
+                            batch=args.batch, threads=args.threads, device=args.device)
+    print(df.to_string(index=False))
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    df.to_excel(args.output, index=False)
@@ -3,28 +3,32 @@ import time
 import torch
 import yaml
 import os.path
+import tempfile
 import pandas as pd
 import numpy as np
 
+from dataset_process.resize_dataset import fold_data, resize_fold
+from tiled_val import compare_tile_sizes
+
 
 if __name__ == '__main__':
     # List of model names to evaluate
     model_list = ['yolov8n', 'yolov8s', 'yolov8m']
+    # Tile sizes to also evaluate with tiled inference on the CPU at full resolution, e.g. [640, 1024]
+    tile_sizes = []
 
     for model_name in model_list:
         for k in range(6, 7):
-            # Load the YAML configuration file
-            yaml_path = 'yaml/detect_different_species.yaml'
-            with open(yaml_path, 'r') as file:
-                data = yaml.safe_load(file)
-
-            # Modify the path in the YAML configuration
-            data['path'] = os.path.join(
-                '../yolo_output_images/species', str(k))
+            # Load the fold's YAML configuration with the class names its conversion wrote
+            data = fold_data('../yolo_output_images/species', k)
 
-            # Write the modified data back to the YAML file
+            # Write it to a YAML file of its own, the fold's data.yaml is never modified
+            yaml_path = os.path.join(tempfile.mkdtemp(), 'data.yaml')
             with open(yaml_path, 'w') as file:
-                yaml.dump(data, file)
+                yaml.dump(data, file, allow_unicode=True)
+
+            # Evaluate on the images pre-resized to imgsz, cached next to the fold pool
+            val_yaml_path = resize_fold(yaml_path, 2560, policy='fit', workers=8)
 
             # Load the custom model
             model_path = os.path.join(
@@ -36,7 +40,7 @@ if __name__ == '__main__':
             # Note: Do not set --save-hybrid to True, as it will write true and predicted values to the annotation file *.txt,
             # causing P R mAP@.5 to become extremely high.
             metrics = model.val(
-                data=yaml_path,  # Dataset configuration
+                data=val_yaml_path,  # Dataset configuration
                 batch=2,  # Batch size
                 split='test',  # Split to evaluate (test set)
                 imgsz=2560,  # Image size for evaluation
@@ -64,6 +68,12 @@ if __name__ == '__main__':
             output_path = os.path.join('runs/val/species', model_name, f'{1}_{k}_results.xlsx')
             df.to_excel(output_path, index=False)
 
+            # Tiled inference metrics, per-image latency and peak RSS next to the results above
+            if tile_sizes:
+                tiled_df = compare_tile_sizes(model_path, yaml_path, tile_sizes, max_det=30)
+                print(tiled_df.to_string(index=False))
+                tiled_df.to_excel(output_path.replace('_results.xlsx', '_tiled_results.xlsx'), index=False)
+
             # Free up memory
             del model
             torch.cuda.empty_cache()